@@ -0,0 +1,56 @@
+import os
+import struct
+import timeit
+from checksum import calculate_checksum, update_checksum
+
+# payload sizes of a pure ack, a small request and a full segment
+PAYLOAD_SIZES = [20, 41, 576, 1479, 1500]
+ITERATIONS = 20000
+
+
+# the pure python loop which was used by utils.calculate_checksum before
+def legacy_checksum(data):
+    if len(data) % 2 == 1:
+        data += struct.pack('B', 0)
+
+    csum = 0
+    for i in range(0, len(data), 2):
+        w = ord(data[i]) + (ord(data[i + 1]) << 8)
+        csum += w
+
+    csum = (csum >> 16) + (csum & 0xffff)
+    csum += (csum >> 16)
+    csum = ~csum & 0xffff
+    return csum
+
+
+def _time_per_call(func, *args):
+    return timeit.timeit(lambda: func(*args), number=ITERATIONS) / ITERATIONS * 1e6
+
+
+def run():
+    print "%-8s %12s %12s %12s %10s" % ("bytes", "legacy(us)", "engine(us)", "memview(us)", "speedup")
+    for size in PAYLOAD_SIZES:
+        data = os.urandom(size)
+        view = memoryview(bytearray(data))
+        assert legacy_checksum(data) == calculate_checksum(data) == calculate_checksum(view)
+        legacy_time = _time_per_call(legacy_checksum, data)
+        engine_time = _time_per_call(calculate_checksum, data)
+        view_time = _time_per_call(calculate_checksum, view)
+        print "%-8d %12.2f %12.2f %12.2f %9.1fx" % (size, legacy_time, engine_time, view_time,
+                                                    legacy_time / engine_time)
+
+    # changing the sequence and acknowledge numbers of a full segment
+    data = bytearray(os.urandom(1480))
+    checksum = calculate_checksum(data)
+    old_fields = str(data[4:12])
+    new_fields = struct.pack("!LL", 123456789, 987654321)
+    full_time = _time_per_call(calculate_checksum, data)
+    incremental_time = _time_per_call(update_checksum, checksum, old_fields, new_fields)
+    data[4:12] = new_fields
+    assert update_checksum(checksum, old_fields, new_fields) == calculate_checksum(data)
+    print "seq/ack update of 1480 bytes: full %.2f us, incremental %.2f us" % (full_time, incremental_time)
+
+
+if __name__ == "__main__":
+    run()
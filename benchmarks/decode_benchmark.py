@@ -0,0 +1,358 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from pcap_file import read_frames, write_pcap
+
+DEFAULT_COUNT = 20000
+DEFAULT_MIX = "mixed"
+SEED = 1
+# each layer is timed this many times over all of its inputs, the best pass counts
+REPEAT = 5
+PTYPE_IPV4 = 0x0800
+IPPROTO_TCP = 6
+# the root of the tree which holds this benchmark
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LayerResult:
+    def __init__(self, name, packets, rejected, ns_per_packet, objects, size, mismatches=None):
+        '''
+        the measurements of one layer function over the recorded frames
+
+        packets       : inputs which were timed
+        rejected      : inputs which the function could not handle, e.g. frames with a
+                        checksum left to the NIC, they are not timed
+        ns_per_packet : nanoseconds per call in the best pass
+        objects       : objects per call held by the result and not by the input
+        size          : bytes per call of those objects
+        mismatches    : encoded outputs which differ from the recorded bytes, None for
+                        a decode layer
+        '''
+        self.name = name
+        self.packets = packets
+        self.rejected = rejected
+        self.ns_per_packet = ns_per_packet
+        self.objects = objects
+        self.size = size
+        self.mismatches = mismatches
+
+
+# import the layers of the tree at code_path instead of this one, so that another
+# revision can be measured with the same benchmark
+def _load_stack(code_path):
+    sys.path.insert(0, os.path.abspath(code_path))
+    from ethernet import ethernet_frame
+    from ip import datagram
+    from tcp import segment
+    try:
+        import packet_decoder
+    except ImportError:
+        # older trees decode with the dissemble functions only
+        packet_decoder = None
+    return ethernet_frame, datagram, segment, packet_decoder
+
+
+# call func with the arguments, return None if it raises
+def _call(func, args):
+    try:
+        return func(*args)
+    except Exception:
+        return None
+
+
+# nanoseconds per call of func in the best of repeat passes over the inputs
+def _time_calls(func, inputs, repeat):
+    gc_was_enabled = gc.isenabled()
+    # a collection in the middle of a pass would be charged to the layer which
+    # happens to run, the results are freed by reference counting anyway
+    gc.disable()
+    try:
+        best = None
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            for args in inputs:
+                func(*args)
+            elapsed = timeit.default_timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return best / len(inputs) * 1e9
+
+
+# count the objects of a result graph which are not shared with the input
+# python 2.7 has no allocation counter like tracemalloc, so the temporary objects
+# of a call are not counted, only what it leaves behind for the next layer
+def _retained(result, args):
+    seen = set(id(arg) for arg in args)
+    objects = 0
+    size = 0
+    pending = [result]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or _is_cached(obj):
+            continue
+        seen.add(id(obj))
+        objects += 1
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple)):
+            pending.extend(obj)
+        elif isinstance(obj, dict):
+            # the keys are the interned attribute names
+            pending.extend(obj.values())
+        elif hasattr(obj, "__dict__"):
+            pending.append(obj.__dict__)
+        elif hasattr(obj, "__slots__"):
+            pending.extend(getattr(obj, name) for name in obj.__slots__ if hasattr(obj, name))
+    return objects, size
+
+
+# None, the small integers and the empty and single character strings are shared
+# by the interpreter and never allocated
+def _is_cached(obj):
+    if obj is None or isinstance(obj, bool):
+        return True
+    if isinstance(obj, (int, long)):
+        return -5 <= obj <= 256
+    if isinstance(obj, str):
+        return len(obj) <= 1
+    return False
+
+
+def _measure(name, func, prepared, rejected, repeat, expected=None):
+    inputs = [args for args, _ in prepared]
+    if not inputs:
+        return LayerResult(name, 0, rejected, None, None, None)
+    ns_per_packet = _time_calls(func, inputs, repeat)
+    objects = 0
+    size = 0
+    for args, result in prepared:
+        result_objects, result_size = _retained(result, args)
+        objects += result_objects
+        size += result_size
+    mismatches = None
+    if expected is not None:
+        mismatches = sum(1 for (args, result), expected_bytes in zip(prepared, expected)
+                         if str(result) != expected_bytes)
+    return LayerResult(name, len(inputs), rejected, ns_per_packet, float(objects) / len(inputs),
+                       float(size) / len(inputs), mismatches)
+
+
+def _noop(*args):
+    pass
+
+
+# run the frames through each layer of the stack at code_path, return a list of
+# LayerResults, the first one is the cost of the loop itself
+def measure(frames, code_path=ROOT, encode=False, repeat=REPEAT):
+    ethernet_frame, datagram, segment, packet_decoder = _load_stack(code_path)
+    # (arguments, result) of each layer and the inputs it rejects
+    ethernet_prepared, ip_prepared, tcp_prepared = [], [], []
+    ethernet_rejected = ip_rejected = tcp_rejected = 0
+    # the frames which every layer accepts
+    stack_inputs = []
+    # the frames are decoded once before timing, the errors of the rejected frames
+    # are expected and not logged
+    logging.disable(logging.ERROR)
+    try:
+        for frame in frames:
+            ethernet = _call(ethernet_frame.dissemble, (frame,))
+            if ethernet is None:
+                ethernet_rejected += 1
+                continue
+            ethernet_prepared.append(((frame,), ethernet))
+            if ethernet.type_num == PTYPE_IPV4:
+                ip = _call(datagram.dissemble, (ethernet.data,))
+                if ip is None:
+                    ip_rejected += 1
+                    continue
+                ip_prepared.append(((ethernet.data,), ip))
+                # the fragments of a datagram cannot be decoded on their own
+                if ip.protocol == IPPROTO_TCP and not ip.fragment_offset and not ip.flag_mf:
+                    tcp_args = (ip.data, ip.src_ip, ip.dest_ip)
+                    tcp = _call(segment.dissemble, tcp_args)
+                    if tcp is None:
+                        tcp_rejected += 1
+                        continue
+                    tcp_prepared.append((tcp_args, tcp))
+            stack_inputs.append((frame,))
+        if packet_decoder is not None:
+            stack_prepared = [(args, packet_decoder.decode(*args)) for args in stack_inputs]
+    finally:
+        logging.disable(logging.NOTSET)
+
+    results = [_measure("(loop)", _noop, [((frame,), None) for frame in frames], 0, repeat),
+               _measure("decode ethernet", ethernet_frame.dissemble, ethernet_prepared,
+                        ethernet_rejected, repeat),
+               _measure("decode ip", datagram.dissemble, ip_prepared, ip_rejected, repeat),
+               _measure("decode tcp", segment.dissemble, tcp_prepared, tcp_rejected, repeat)]
+    if packet_decoder is not None:
+        results.append(_measure("decode stack", packet_decoder.decode, stack_prepared,
+                                len(frames) - len(stack_inputs), repeat))
+    if encode:
+        # the decoded objects are encoded again and compared with the recorded bytes
+        ethernet_expected = [args[0] for args, _ in ethernet_prepared]
+        ip_expected = [args[0][:ip.total_length] for args, ip in ip_prepared]
+        tcp_expected = [args[0] for args, _ in tcp_prepared]
+        for (_, src_ip, dest_ip), tcp in tcp_prepared:
+            tcp.src_ip = src_ip
+            tcp.dest_ip = dest_ip
+        results.append(_measure_encode("encode ethernet", ethernet_frame.assemble,
+                                       ethernet_prepared, ethernet_expected, repeat))
+        results.append(_measure_encode("encode ip", datagram.assemble, ip_prepared, ip_expected,
+                                       repeat))
+        results.append(_measure_encode("encode tcp", segment.assemble, tcp_prepared,
+                                       tcp_expected, repeat))
+    return results
+
+
+def _measure_encode(name, func, decoded, expected, repeat):
+    prepared = []
+    rejected = 0
+    kept_expected = []
+    for (_, decoded_object), expected_bytes in zip(decoded, expected):
+        encoded = _call(func, (decoded_object,))
+        if encoded is None:
+            rejected += 1
+            continue
+        prepared.append(((decoded_object,), encoded))
+        kept_expected.append(str(expected_bytes))
+    return _measure(name, func, prepared, rejected, repeat, kept_expected)
+
+
+def _format(value, pattern):
+    return "-" if value is None else pattern % value
+
+
+def print_results(results, out=sys.stdout):
+    out.write("%-16s %8s %8s %10s %9s %10s %10s\n" % (
+        "layer", "packets", "rejected", "ns/pkt", "objs/pkt", "bytes/pkt", "mismatches"))
+    for result in results:
+        out.write("%-16s %8d %8d %10s %9s %10s %10s\n" % (
+            result.name, result.packets, result.rejected,
+            _format(result.ns_per_packet, "%.0f"), _format(result.objects, "%.2f"),
+            _format(result.size, "%.0f"), _format(result.mismatches, "%d")))
+
+
+# measure the same frames with the tree of revision and with this tree, each one in
+# its own interpreter, and print them side by side
+def compare(frames, revision, encode=False, repeat=REPEAT, out=sys.stdout):
+    work_dir = tempfile.mkdtemp(prefix="decode_benchmark")
+    try:
+        capture_path = os.path.join(work_dir, "frames.pcap")
+        write_pcap(capture_path, frames)
+        revision_path = os.path.join(work_dir, "tree")
+        os.mkdir(revision_path)
+        _export_revision(revision, revision_path)
+        base = _measure_in_subprocess(capture_path, revision_path, "the revision " + revision,
+                                      encode, repeat)
+        current = _measure_in_subprocess(capture_path, ROOT, "this tree", encode, repeat)
+    finally:
+        shutil.rmtree(work_dir)
+    out.write("%-16s %12s %12s %8s %12s %12s %12s %12s\n" % (
+        "layer", revision[:12] + "(ns)", "tree(ns)", "change", revision[:8] + "(objs)",
+        "tree(objs)", revision[:8] + "(rej)", "tree(rej)"))
+    base_by_name = dict((result["name"], result) for result in base)
+    for result in current:
+        base_result = base_by_name.get(result["name"], {})
+        base_ns = base_result.get("ns_per_packet")
+        current_ns = result["ns_per_packet"]
+        change = None
+        if base_ns and current_ns:
+            change = (current_ns - base_ns) / base_ns * 100
+        out.write("%-16s %12s %12s %8s %12s %12s %12s %12d\n" % (
+            result["name"], _format(base_ns, "%.0f"), _format(current_ns, "%.0f"),
+            _format(change, "%+.1f%%"), _format(base_result.get("objects"), "%.2f"),
+            _format(result["objects"], "%.2f"), _format(base_result.get("rejected"), "%d"),
+            result["rejected"]))
+
+
+def _export_revision(revision, path):
+    archive = subprocess.Popen(["git", "archive", "--format=tar", revision], cwd=ROOT,
+                               stdout=subprocess.PIPE)
+    extract = subprocess.Popen(["tar", "-x", "-C", path], stdin=archive.stdout)
+    archive.stdout.close()
+    if extract.wait() != 0 or archive.wait() != 0:
+        raise ValueError("cannot export the revision " + revision)
+
+
+def _measure_in_subprocess(capture_path, code_path, name, encode, repeat):
+    script = os.path.join(ROOT, "benchmarks", "decode_benchmark.py")
+    command = [sys.executable, script, "--pcap", capture_path, "--code-path", code_path,
+               "--repeat", str(repeat), "--json"]
+    if encode:
+        command.append("--encode")
+    try:
+        return json.loads(subprocess.check_output(command))
+    except subprocess.CalledProcessError:
+        raise ValueError("cannot measure " + name + ", see the error above")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time the decode and encode functions of each layer over recorded frames")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--pcap", metavar="FILE",
+                        help="replay the Ethernet frames of a pcap or pcapng file")
+    source.add_argument("--mix", default=DEFAULT_MIX,
+                        help="replay generated frames of this traffic mix, see traffic_mix.MIXES")
+    parser.add_argument("-n", "--count", type=int, default=DEFAULT_COUNT,
+                        help="number of frames to generate")
+    parser.add_argument("--seed", type=int, default=SEED, help="seed of the generated frames")
+    parser.add_argument("-e", "--encode", action="store_true",
+                        help="encode the decoded frames again and time that as well")
+    parser.add_argument("-r", "--repeat", type=int, default=REPEAT,
+                        help="passes over the frames per layer, the best one counts")
+    parser.add_argument("--save", metavar="FILE", help="write the frames to a pcap file")
+    parser.add_argument("--compare", metavar="REV",
+                        help="compare this tree with the tree of the git revision REV")
+    parser.add_argument("--code-path", default=ROOT, help=argparse.SUPPRESS)
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.pcap is not None:
+        try:
+            frames = read_frames(args.pcap)
+        except (IOError, ValueError), e:
+            parser.error(str(e))
+        source_name = args.pcap
+    elif args.code_path != ROOT:
+        parser.error("the frames of another tree are replayed from a pcap file")
+    else:
+        # the generator assembles the frames with the layers of this tree, it is only
+        # imported here so that a --code-path run loads the layers of its own tree
+        sys.path.insert(0, ROOT)
+        from traffic_mix import generate_frames
+        try:
+            frames = generate_frames(args.mix, args.count, args.seed)
+        except ValueError, e:
+            parser.error(str(e))
+        source_name = "the %s mix" % args.mix
+    if not frames:
+        parser.error("there are no Ethernet frames to replay")
+    if args.save is not None:
+        write_pcap(args.save, frames)
+
+    if args.compare is not None:
+        print "%d frames of %s" % (len(frames), source_name)
+        try:
+            compare(frames, args.compare, args.encode, args.repeat)
+        except ValueError, e:
+            parser.exit(1, str(e) + "\n")
+    elif args.json:
+        results = measure(frames, args.code_path, args.encode, args.repeat)
+        print json.dumps([result.__dict__ for result in results])
+    else:
+        print "%d frames of %s" % (len(frames), source_name)
+        print_results(measure(frames, args.code_path, args.encode, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import struct
+
+# magic numbers of a pcap file with microsecond and nanosecond timestamps
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_HEADER_LENGTH = 24
+PCAP_RECORD_HEADER_LENGTH = 16
+PCAP_VERSION = (2, 4)
+PCAP_SNAPLEN = 65535
+# block types of pcapng, see draft-ietf-opsawg-pcapng
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_OBSOLETE_PACKET = 0x00000002
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+# link types, see http://www.tcpdump.org/linktypes.html
+LINKTYPE_ETHERNET = 1
+LINKTYPE_LINUX_SLL = 113
+# the cooked header of "tcpdump -i any" in front of the network layer
+LINUX_SLL_HEADER_LENGTH = 16
+ETHERNET_HEADER = struct.Struct("!6s6sH")
+
+
+# read the Ethernet frames of a pcap or pcapng file into a list of strings, the
+# frames of a "tcpdump -i any" capture get an Ethernet header in place of their
+# cooked header, the frames of other link types are skipped
+# raise ValueError if the file is neither pcap nor pcapng
+def read_frames(path):
+    with open(path, "rb") as capture:
+        data = capture.read()
+    if len(data) < 4:
+        raise ValueError(path + " is not a pcap or pcapng file")
+    if struct.unpack_from("<L", data)[0] == PCAPNG_SECTION_HEADER:
+        return _read_pcapng(data)
+    for byte_order in ("<", ">"):
+        if struct.unpack_from(byte_order + "L", data)[0] in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            return _read_pcap(data, byte_order)
+    raise ValueError(path + " is not a pcap or pcapng file")
+
+
+# write the frames to a little-endian pcap file of Ethernet frames, the
+# timestamps are all 0
+def write_pcap(path, frames):
+    with open(path, "wb") as capture:
+        capture.write(struct.pack("<LHHlLLL", PCAP_MAGIC_USEC, PCAP_VERSION[0], PCAP_VERSION[1],
+                                  0, 0, PCAP_SNAPLEN, LINKTYPE_ETHERNET))
+        for frame in frames:
+            capture.write(struct.pack("<LLLL", 0, 0, len(frame), len(frame)))
+            capture.write(frame)
+
+
+def _read_pcap(data, byte_order):
+    link_type = struct.unpack_from(byte_order + "L", data, 20)[0]
+    record_header = struct.Struct(byte_order + "LLLL")
+    frames = []
+    position = PCAP_HEADER_LENGTH
+    while position + PCAP_RECORD_HEADER_LENGTH <= len(data):
+        captured_length = record_header.unpack_from(data, position)[2]
+        position += PCAP_RECORD_HEADER_LENGTH
+        # a capture cut off in the middle of a record ends with it
+        if position + captured_length > len(data):
+            break
+        _append_frame(frames, link_type, data[position: position + captured_length])
+        position += captured_length
+    return frames
+
+
+def _read_pcapng(data):
+    frames = []
+    byte_order = "<"
+    # link type of each interface of the current section
+    link_types = []
+    position = 0
+    while position + 12 <= len(data):
+        block_type = struct.unpack_from(byte_order + "L", data, position)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # each section has its own byte order and interfaces
+            magic = struct.unpack_from("<L", data, position + 8)[0]
+            byte_order = "<" if magic == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            link_types = []
+        block_length = struct.unpack_from(byte_order + "L", data, position + 4)[0]
+        if block_length < 12 or position + block_length > len(data):
+            break
+        body = position + 8
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            link_types.append(struct.unpack_from(byte_order + "H", data, body)[0])
+        elif block_type in (PCAPNG_ENHANCED_PACKET, PCAPNG_OBSOLETE_PACKET):
+            # the obsolete block has a 16-bit interface id and a 16-bit drops count
+            # where the enhanced block has a 32-bit interface id
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                interface_id = struct.unpack_from(byte_order + "L", data, body)[0]
+            else:
+                interface_id = struct.unpack_from(byte_order + "H", data, body)[0]
+            captured_length = struct.unpack_from(byte_order + "L", data, body + 12)[0]
+            if interface_id < len(link_types):
+                _append_frame(frames, link_types[interface_id],
+                              data[body + 20: body + 20 + captured_length])
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            # the frame is cut to the snaplen of the first interface, the block is padded
+            original_length = struct.unpack_from(byte_order + "L", data, body)[0]
+            captured_length = min(original_length, block_length - 16)
+            if link_types:
+                _append_frame(frames, link_types[0], data[body + 4: body + 4 + captured_length])
+        position += block_length
+    return frames
+
+
+def _append_frame(frames, link_type, frame):
+    if link_type == LINKTYPE_ETHERNET:
+        frames.append(frame)
+    elif link_type == LINKTYPE_LINUX_SLL and len(frame) >= LINUX_SLL_HEADER_LENGTH:
+        # the cooked header holds the source address and the protocol, the
+        # destination is unknown
+        address_length = struct.unpack_from("!H", frame, 4)[0]
+        src_mac = frame[6: 6 + min(address_length, 6)].ljust(6, "\x00")
+        protocol = struct.unpack_from("!H", frame, 14)[0]
+        frames.append(ETHERNET_HEADER.pack("\x00" * 6, src_mac, protocol)
+                      + frame[LINUX_SLL_HEADER_LENGTH:])
@@ -0,0 +1,57 @@
+import time
+from ethernet import ethernet_frame
+from ethernet.ethernet_frame import EthernetFrame
+from ip import datagram
+from ip.datagram import IPDatagram
+from tcp import segment
+from tcp.segment import TCPSegmentFactory
+from packet_encoder import FrameTemplate
+import packet_decoder
+
+SRC_MAC = "\x02\x00\x00\x00\x00\x01"
+DEST_MAC = "\x02\x00\x00\x00\x00\x02"
+SRC_IP = "10.0.0.1"
+DEST_IP = "10.0.0.2"
+SRC_PORT = 40000
+DEST_PORT = 80
+# a pure ack and a full segment
+PAYLOAD_SIZES = [0, 1460]
+DURATION = 1.0
+
+
+# the per-layer path used by TCPSocket._send_segment before the frame template
+def layered_assemble(tcp_segment):
+    ip_datagram = IPDatagram(SRC_IP, DEST_IP, segment.assemble(tcp_segment))
+    ethernet_frm = EthernetFrame(SRC_MAC, DEST_MAC, packet_decoder.PTYPE_IPV4,
+                                 datagram.assemble(ip_datagram))
+    return ethernet_frame.assemble(ethernet_frm)
+
+
+def _packets_per_second(assemble, segments):
+    count = 0
+    start = time.time()
+    while time.time() - start < DURATION:
+        for tcp_segment in segments:
+            assemble(tcp_segment)
+        count += len(segments)
+    return count / (time.time() - start)
+
+
+def run():
+    factory = TCPSegmentFactory(SRC_IP, SRC_PORT, DEST_IP, DEST_PORT)
+    template = FrameTemplate(SRC_MAC, DEST_MAC, SRC_IP, DEST_IP, SRC_PORT, DEST_PORT)
+    print "%-8s %14s %14s %8s" % ("payload", "layered(pps)", "template(pps)", "speedup")
+    for size in PAYLOAD_SIZES:
+        segments = [factory.create_psh_ack(seq_num, 1, "x" * size)
+                    for seq_num in range(1000, 1000 + 100 * max(size, 1), max(size, 1))]
+        # both paths should produce frames which decode to the same segment
+        for frame in (layered_assemble(segments[0]), template.assemble(segments[0])):
+            packet = packet_decoder.decode_fast(frame)
+            assert packet.seq_num == segments[0].seq_num and len(packet.data) == size
+        layered_pps = _packets_per_second(layered_assemble, segments)
+        template_pps = _packets_per_second(template.assemble, segments)
+        print "%-8d %14.0f %14.0f %7.1fx" % (size, layered_pps, template_pps, template_pps / layered_pps)
+
+
+if __name__ == "__main__":
+    run()
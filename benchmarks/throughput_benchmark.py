@@ -0,0 +1,153 @@
+import argparse
+import os
+import time
+from simulation.network import SimulatedNetwork
+from simulation.link import LinkProfile
+from http.http_client import do_get, do_get_async
+from event_loop import get_event_loop
+
+# one-way impairments, the same in both directions
+PROFILES = [
+    ("lan", LinkProfile(delay=0.0005)),
+    ("wan", LinkProfile(delay=0.02, bandwidth=10 << 20, queue_limit=256 << 10)),
+    ("lossy", LinkProfile(delay=0.01, loss=0.01)),
+    ("reorder", LinkProfile(delay=0.005, jitter=0.002, reorder=0.05, duplicate=0.01)),
+]
+# the http clients to time, see http.http_client
+MODES = ("sync", "async")
+FILE_SIZES = [16 << 10, 256 << 10, 4 << 20]
+# each file is downloaded until this many bytes or MAX_DOWNLOADS downloads are done
+BYTES_PER_RUN = 4 << 20
+MIN_DOWNLOADS = 3
+MAX_DOWNLOADS = 20
+# the downloads of the async mode run this many at a time
+ASYNC_CONCURRENCY = 4
+SEED = 1
+PATH = "/file.bin"
+
+
+class RunResult:
+    def __init__(self, size, downloads, elapsed, cpu_time, packets, latencies, retransmissions):
+        '''
+        the measurements of the downloads of one file over one link profile
+
+        elapsed    : wall clock seconds of all downloads
+        cpu_time   : user and system seconds of the process, including the simulated peer
+        packets    : frames sent over the link in both directions
+        latencies  : seconds from the request to the whole body of each download, sorted
+        '''
+        self.size = size
+        self.downloads = downloads
+        self.elapsed = elapsed
+        self.cpu_time = cpu_time
+        self.packets = packets
+        self.latencies = sorted(latencies)
+        self.retransmissions = retransmissions
+
+    def goodput(self):
+        return self.size * self.downloads / self.elapsed / (1 << 20)
+
+    def cpu_per_mb(self):
+        return self.cpu_time / (float(self.size * self.downloads) / (1 << 20))
+
+    def packet_rate(self):
+        return self.packets / self.elapsed
+
+    def percentile(self, fraction):
+        return self.latencies[min(int(fraction * len(self.latencies)), len(self.latencies) - 1)]
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _download_count(size):
+    return max(MIN_DOWNLOADS, min(MAX_DOWNLOADS, BYTES_PER_RUN // size))
+
+
+def _run_sync(network, body, count):
+    latencies = []
+    for index in range(count):
+        start = time.time()
+        if do_get(network.url(PATH)) != body:
+            raise AssertionError("the body of a simulated download is corrupted")
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def _run_async(network, body, count):
+    latencies = []
+    state = {"started": 0, "active": 0}
+    loop = get_event_loop()
+
+    def start_next():
+        state["started"] += 1
+        state["active"] += 1
+        start = time.time()
+
+        def on_response(status_code, http_body):
+            if http_body != body:
+                raise AssertionError("the body of a simulated download is corrupted")
+            latencies.append(time.time() - start)
+            state["active"] -= 1
+            if state["started"] < count:
+                start_next()
+
+        do_get_async(network.url(PATH), on_response)
+
+    while state["started"] < min(count, ASYNC_CONCURRENCY):
+        start_next()
+    loop.run_until(lambda: len(latencies) == count)
+    return latencies
+
+
+# download a file of size bytes over a link with the given profile, mode is
+# "sync" for TCPSocket or "async" for TCPTransport
+def run_profile(profile, size, mode="sync", seed=SEED):
+    body = os.urandom(size)
+    network = SimulatedNetwork({PATH: body}, to_peer=profile, to_host=profile, seed=seed)
+    network.install()
+    try:
+        count = _download_count(size)
+        cpu_start = _cpu_time()
+        start = time.time()
+        if mode == "async":
+            latencies = _run_async(network, body, count)
+        else:
+            latencies = _run_sync(network, body, count)
+        elapsed = time.time() - start
+        cpu_time = _cpu_time() - cpu_start
+    finally:
+        network.uninstall()
+    packets = network.link.uplink.sent_count + network.link.downlink.sent_count
+    return RunResult(size, count, elapsed, cpu_time, packets, latencies,
+                     network.peer.stats.retransmissions)
+
+
+def run(modes=MODES):
+    print "%-8s %-6s %8s %6s %9s %11s %9s %9s %9s %8s" % (
+        "profile", "mode", "size", "runs", "MB/s", "cpu(ms/MB)", "pps", "p50(ms)", "p99(ms)",
+        "retrans")
+    for name, profile in PROFILES:
+        for mode in modes:
+            for size in FILE_SIZES:
+                result = run_profile(profile, size, mode)
+                print "%-8s %-6s %7dK %6d %9.2f %11.1f %9.0f %9.1f %9.1f %8d" % (
+                    name, mode, size >> 10, result.downloads, result.goodput(),
+                    result.cpu_per_mb() * 1000, result.packet_rate(),
+                    result.percentile(0.5) * 1000, result.percentile(0.99) * 1000,
+                    result.retransmissions)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="download files over simulated links and report the throughput")
+    parser.add_argument("-m", "--mode", action="append", choices=MODES, dest="modes",
+                        help="time this http client, may be repeated, all of them by default")
+    args = parser.parse_args()
+    run(args.modes or MODES)
+
+
+if __name__ == "__main__":
+    main()
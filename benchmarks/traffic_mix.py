@@ -0,0 +1,136 @@
+import random
+from packet_encoder import FrameTemplate
+from tcp import segment
+from ethernet import arp_packet, ethernet_frame
+
+CLIENT_IP = "10.0.0.1"
+CLIENT_MAC = "\x02\x00\x00\x00\x00\x01"
+SERVER_MAC = "\x02\x00\x00\x00\x01\x01"
+SERVER_IPS = ["10.0.1.%d" % number for number in range(1, 5)]
+SERVER_PORT = 80
+FLOW_COUNT = 16
+FIRST_CLIENT_PORT = 40000
+MSS = 1460
+# the payload of a segment which carries timestamps
+MSS_WITH_TIMESTAMPS = MSS - 12
+REQUEST_SIZE = 300
+WINDOW_SIZE = 29200
+# frames shorter than this are padded by the sender, like by a NIC
+MIN_FRAME_SIZE = 60
+HTYPE_ARP = 0x0806
+BROADCAST_MAC = "\xff" * 6
+# flags of the tcp header
+FIN = 0x01
+SYN = 0x02
+PSH = 0x08
+ACK = 0x10
+
+# the share of each kind of frame in a mix
+MIXES = {
+    # a bulk download as seen by the receiver, full segments and the acks of them
+    "download": {"data": 60, "ack": 35, "sack": 3, "syn": 1, "fin": 1},
+    # the return path of an upload
+    "acks": {"ack": 90, "sack": 10},
+    # many short connections
+    "web": {"syn": 10, "request": 20, "data": 30, "ack": 30, "fin": 10},
+    "mixed": {"syn": 5, "request": 10, "data": 30, "bulk": 15, "ack": 25, "sack": 5, "fin": 5,
+              "arp": 5},
+}
+
+
+class Flow:
+    def __init__(self, client_port, server_ip):
+        '''
+        a connection between the client and a server, the frames of each direction
+        are assembled from a FrameTemplate
+
+        to_server   : template of the frames sent by the client
+        to_client   : template of the frames sent by the server
+        client_seq  : next sequence number of the client
+        server_seq  : next sequence number of the server
+        '''
+        self.server_ip = server_ip
+        self.to_server = FrameTemplate(CLIENT_MAC, SERVER_MAC, CLIENT_IP, server_ip, client_port,
+                                       SERVER_PORT)
+        self.to_client = FrameTemplate(SERVER_MAC, CLIENT_MAC, server_ip, CLIENT_IP, SERVER_PORT,
+                                       client_port)
+        # the templates start from a random ip id, fixed ones keep the frames the same
+        # for the same seed, like the sequence numbers
+        self.to_server.ip_id = client_port
+        self.to_client.ip_id = 3 * client_port & 0xffff
+        self.client_seq = 1000 * client_port
+        self.server_seq = 7000 * client_port
+
+
+# a list of count Ethernet frames of the given mix, the same seed gives the same frames
+def generate_frames(mix="mixed", count=10000, seed=1):
+    if mix not in MIXES:
+        raise ValueError("unknown traffic mix: " + mix)
+    rng = random.Random(seed)
+    kinds = []
+    for kind, weight in sorted(MIXES[mix].items()):
+        kinds.extend([kind] * weight)
+    flows = [Flow(FIRST_CLIENT_PORT + index, SERVER_IPS[index % len(SERVER_IPS)])
+             for index in range(FLOW_COUNT)]
+    # the payloads are slices of one random block, drawn from rng as well so that
+    # the same seed gives the same payload bytes
+    payload_block = "".join(chr(rng.randrange(256)) for _ in range(4 * MSS))
+    frames = []
+    for index in range(count):
+        kind = rng.choice(kinds)
+        flow = rng.choice(flows)
+        # a timestamp clock of 1 ms
+        timestamps = (segment.OPTION_TIMESTAMPS, (index, index - 1))
+        frame = _make_frame(kind, flow, timestamps, rng, payload_block)
+        frames.append(frame.ljust(MIN_FRAME_SIZE, "\x00"))
+    return frames
+
+
+def _make_frame(kind, flow, timestamps, rng, payload_block):
+    if kind == "arp":
+        request = arp_packet.ARPPacket(SERVER_MAC, flow.server_ip, BROADCAST_MAC, CLIENT_IP)
+        return ethernet_frame.assemble(ethernet_frame.EthernetFrame(
+            SERVER_MAC, BROADCAST_MAC, HTYPE_ARP, arp_packet.assemble(request)))
+    if kind == "syn":
+        options = [(segment.OPTION_MSS, MSS), (segment.OPTION_SACK_PERMITTED, None), timestamps,
+                   (segment.OPTION_WINDOW_SCALE, 7)]
+        return flow.to_server.assemble_fields(flow.client_seq, 0, SYN, WINDOW_SIZE, "",
+                                              segment.encode_options(options))
+    if kind == "ack":
+        return flow.to_server.assemble_fields(flow.client_seq, flow.server_seq, ACK, WINDOW_SIZE,
+                                              "", segment.encode_options([timestamps]))
+    if kind == "sack":
+        # a duplicate ack after a loss, two blocks above the hole
+        blocks = [(flow.server_seq + 2 * MSS, flow.server_seq + 4 * MSS),
+                  (flow.server_seq + 5 * MSS, flow.server_seq + 6 * MSS)]
+        options = [timestamps, (segment.OPTION_SACK, blocks)]
+        return flow.to_server.assemble_fields(flow.client_seq, flow.server_seq, ACK, WINDOW_SIZE,
+                                              "", segment.encode_options(options))
+    if kind == "request":
+        data = _payload(payload_block, REQUEST_SIZE, rng)
+        frame = flow.to_server.assemble_fields(flow.client_seq, flow.server_seq, PSH | ACK,
+                                               WINDOW_SIZE, data,
+                                               segment.encode_options([timestamps]))
+        flow.client_seq = (flow.client_seq + REQUEST_SIZE) & 0xffffffff
+        return frame
+    if kind == "data":
+        data = _payload(payload_block, MSS_WITH_TIMESTAMPS, rng)
+        frame = flow.to_client.assemble_fields(flow.server_seq, flow.client_seq, ACK, WINDOW_SIZE,
+                                               data, segment.encode_options([timestamps]))
+        flow.server_seq = (flow.server_seq + MSS_WITH_TIMESTAMPS) & 0xffffffff
+        return frame
+    if kind == "bulk":
+        data = _payload(payload_block, MSS, rng)
+        frame = flow.to_client.assemble_fields(flow.server_seq, flow.client_seq, ACK, WINDOW_SIZE,
+                                               data)
+        flow.server_seq = (flow.server_seq + MSS) & 0xffffffff
+        return frame
+    if kind == "fin":
+        return flow.to_client.assemble_fields(flow.server_seq, flow.client_seq, FIN | ACK,
+                                              WINDOW_SIZE, "", segment.encode_options([timestamps]))
+    raise ValueError("unknown kind of frame: " + kind)
+
+
+def _payload(payload_block, size, rng):
+    start = rng.randrange(len(payload_block) - size)
+    return payload_block[start: start + size]
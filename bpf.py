@@ -0,0 +1,86 @@
+import socket
+import ctypes
+from struct import pack, unpack
+
+# classic BPF opcodes, see linux/filter.h
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xb1
+BPF_JMP_JEQ_K = 0x15
+BPF_JMP_JSET_K = 0x45
+BPF_RET_K = 0x06
+
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+
+HTYPE_ARP = 0x0806
+PTYPE_IPV4 = 0x0800
+# bytes of the frame passed to the socket when it is accepted
+ACCEPT_LENGTH = 0x40000
+DROP_LENGTH = 0
+
+# offsets in the ethernet frame
+TYPE_OFFSET = 12
+IP_HEADER_OFFSET = 14
+IP_FLAGS_FRAGMENT_OFFSET = IP_HEADER_OFFSET + 6
+IP_PROTOCOL_OFFSET = IP_HEADER_OFFSET + 9
+IP_SRC_OFFSET = IP_HEADER_OFFSET + 12
+IP_DEST_OFFSET = IP_HEADER_OFFSET + 16
+# more fragments flag and fragment offset
+FRAGMENT_MASK = 0x3fff
+
+
+# build a program which accepts the tcp segments of the given connections, and
+# arp frames if allow_arp is True, everything else is dropped in the kernel
+# each connection is a (local_ip, local_port, remote_ip, remote_port) tuple
+# the program is a list of (code, jt, jf, k) instructions
+def build_filter(connections, allow_arp=False):
+    program = []
+    if allow_arp:
+        program += [(BPF_LD_H_ABS, 0, 0, TYPE_OFFSET),
+                    (BPF_JMP_JEQ_K, 0, 1, HTYPE_ARP),
+                    (BPF_RET_K, 0, 0, ACCEPT_LENGTH)]
+    # only unfragmented ipv4 tcp datagrams, the jumps skip the following drop
+    program += [(BPF_LD_H_ABS, 0, 0, TYPE_OFFSET),
+                (BPF_JMP_JEQ_K, 1, 0, PTYPE_IPV4),
+                (BPF_RET_K, 0, 0, DROP_LENGTH),
+                (BPF_LD_B_ABS, 0, 0, IP_PROTOCOL_OFFSET),
+                (BPF_JMP_JEQ_K, 1, 0, socket.IPPROTO_TCP),
+                (BPF_RET_K, 0, 0, DROP_LENGTH),
+                (BPF_LD_H_ABS, 0, 0, IP_FLAGS_FRAGMENT_OFFSET),
+                (BPF_JMP_JSET_K, 0, 1, FRAGMENT_MASK),
+                (BPF_RET_K, 0, 0, DROP_LENGTH),
+                # X = ip header length
+                (BPF_LDX_B_MSH, 0, 0, IP_HEADER_OFFSET)]
+    # one block per connection, a mismatch jumps to the next block
+    for local_ip, local_port, remote_ip, remote_port in sorted(connections):
+        program += [(BPF_LD_W_ABS, 0, 0, IP_SRC_OFFSET),
+                    (BPF_JMP_JEQ_K, 0, 7, _ip_to_int(remote_ip)),
+                    (BPF_LD_W_ABS, 0, 0, IP_DEST_OFFSET),
+                    (BPF_JMP_JEQ_K, 0, 5, _ip_to_int(local_ip)),
+                    (BPF_LD_H_IND, 0, 0, IP_HEADER_OFFSET),
+                    (BPF_JMP_JEQ_K, 0, 3, remote_port),
+                    (BPF_LD_H_IND, 0, 0, IP_HEADER_OFFSET + 2),
+                    (BPF_JMP_JEQ_K, 0, 1, local_port),
+                    (BPF_RET_K, 0, 0, ACCEPT_LENGTH)]
+    program.append((BPF_RET_K, 0, 0, DROP_LENGTH))
+    return program
+
+
+# attach the program to the socket, an attached program is replaced atomically
+def attach_filter(sock, program):
+    instructions = "".join(pack("=HBBI", code, jt, jf, k) for code, jt, jf, k in program)
+    instruction_buf = ctypes.create_string_buffer(instructions, len(instructions))
+    # struct sock_fprog: number of instructions and a pointer to them
+    fprog = pack("HL", len(program), ctypes.addressof(instruction_buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def detach_filter(sock):
+    sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+
+def _ip_to_int(ip):
+    return unpack("!L", socket.inet_aton(ip))[0]
@@ -0,0 +1,46 @@
+from socket_logger import error_log
+
+# large enough for a frame coalesced by GRO on the receive side
+DEFAULT_BUFFER_SIZE = 65536
+DEFAULT_BUFFER_COUNT = 32
+
+
+class BufferPool:
+    def __init__(self, buffer_count=DEFAULT_BUFFER_COUNT, buffer_size=DEFAULT_BUFFER_SIZE):
+        '''
+        buffer_count    : number of preallocated buffers
+        buffer_size     : size of each buffer
+        free_buffers    : buffers which can be handed out
+        leased_ids      : ids of the pooled buffers handed out and not released yet
+        exhausted_count : how many times a buffer was requested while none was free
+        '''
+        self.buffer_count = buffer_count
+        self.buffer_size = buffer_size
+        self.free_buffers = [bytearray(buffer_size) for i in range(buffer_count)]
+        # ids of the buffers owned by the pool, temporary buffers are not taken back
+        self._pooled_ids = set(id(buf) for buf in self.free_buffers)
+        self.leased_ids = set()
+        self.exhausted_count = 0
+
+    def acquire(self):
+        if self.free_buffers:
+            buf = self.free_buffers.pop()
+            self.leased_ids.add(id(buf))
+            return buf
+        # all buffers are in use, report it and fall back to a temporary buffer
+        self.exhausted_count += 1
+        error_log("buffer pool exhausted (" + str(self.buffer_count) + " buffers in use, "
+                  + str(self.exhausted_count) + " times), allocating a temporary buffer")
+        return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        if id(buf) not in self._pooled_ids:
+            return
+        # a buffer released twice would be handed out to two owners at once
+        if id(buf) not in self.leased_ids:
+            raise ValueError("buffer released twice")
+        self.leased_ids.remove(id(buf))
+        self.free_buffers.append(buf)
+
+    def is_exhausted(self):
+        return len(self.free_buffers) == 0
@@ -0,0 +1,73 @@
+import sys
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# buffers shorter than this are summed with array/struct, numpy only pays off
+# for larger buffers because of its per-call overhead
+NUMPY_MIN_LENGTH = 512
+# the odd trailing byte is the low-order byte of a native word on little-endian
+# hosts and the high-order byte on big-endian hosts
+ODD_BYTE_SHIFT = 0 if sys.byteorder == "little" else 8
+
+# cache of precompiled word structs keyed by the number of 16-bit words
+_word_structs = {}
+
+
+# one's complement checksum of the given data, see RFC 1071
+# data can be a string, a bytearray or a memoryview, it is never copied
+def calculate_checksum(data):
+    return finish_checksum(partial_sum(data))
+
+
+# sum the 16-bit words of the data in host byte order without folding,
+# the result can be accumulated with other partial sums and then passed
+# to finish_checksum
+def partial_sum(data, initial=0):
+    length = len(data)
+    word_count = length >> 1
+    total = initial
+    if word_count:
+        total += _sum_words(data, word_count)
+    # pad the odd byte virtually instead of copying the whole buffer
+    if length & 1:
+        total += struct.unpack_from("B", data, length - 1)[0] << ODD_BYTE_SHIFT
+    return total
+
+
+# fold the carries of a partial sum and take the one's complement
+def finish_checksum(total):
+    total = (total >> 16) + (total & 0xffff)
+    total += (total >> 16)
+    return ~total & 0xffff
+
+
+# incrementally update a checksum after some fields have been changed, see RFC 1624
+# old_data and new_data are the old and new bytes of the changed fields, they should
+# have the same even length and start at an even offset of the checksummed data
+def update_checksum(checksum, old_data, new_data):
+    if len(old_data) != len(new_data) or len(old_data) & 1:
+        raise ValueError("old and new data should have the same even length")
+    # HC' = ~(~HC + ~m + m'), where ~m is the sum of the complement of each old word
+    total = (~checksum & 0xffff) + 0xffff * (len(old_data) >> 1) - partial_sum(old_data)
+    total += partial_sum(new_data)
+    return finish_checksum(total)
+
+
+def _sum_words(data, word_count):
+    if numpy is not None and word_count * 2 >= NUMPY_MIN_LENGTH:
+        words = numpy.frombuffer(data, dtype=numpy.uint16, count=word_count)
+        return int(words.sum(dtype=numpy.uint64))
+    if isinstance(data, str):
+        words = array("H")
+        words.fromstring(buffer(data, 0, word_count * 2))
+        return sum(words)
+    word_struct = _word_structs.get(word_count)
+    if word_struct is None:
+        word_struct = struct.Struct("=%dH" % word_count)
+        _word_structs[word_count] = word_struct
+    return sum(word_struct.unpack_from(data))
@@ -0,0 +1,466 @@
+import errno
+import random
+import socket
+import struct
+from collections import OrderedDict
+from event_loop import get_event_loop
+from socket_logger import debug_log
+
+DNS_PORT = 53
+RESOLV_CONF = "/etc/resolv.conf"
+HOSTS_FILE = "/etc/hosts"
+# seconds to wait for an answer, and how many times each nameserver is asked
+QUERY_TIMEOUT = 2.0
+QUERY_ATTEMPTS = 2
+# an answer is cached at most this long, whatever its ttl
+MAX_TTL = 3600
+# a name which does not exist is remembered this long if the answer gives no ttl
+NEGATIVE_TTL = 60
+# a lookup which got no answer is only remembered for a short time
+FAILURE_TTL = 5
+# ttl of the addresses of the hosts file and of the system resolver, which have none
+DEFAULT_TTL = 60
+MAX_CACHE_SIZE = 1024
+# record types, class and response codes, see RFC 1035
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_SOA = 6
+CLASS_IN = 1
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+HEADER_FORMAT = "!HHHHHH"
+HEADER_LENGTH = 12
+# recursion desired
+FLAG_RD = 0x0100
+FLAG_QR = 0x8000
+
+_resolver = None
+
+
+# the resolver shared by all connections of the process
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver()
+    return _resolver
+
+
+# replace the resolver of the process, e.g. by one with a stub upstream, and
+# return the one it replaces
+def set_resolver(resolver):
+    global _resolver
+    previous, _resolver = _resolver, resolver
+    return previous
+
+
+class Resolver:
+    def __init__(self, upstream=None, loop=None, max_ttl=MAX_TTL, max_cache_size=MAX_CACHE_SIZE):
+        '''
+        resolves host names to ipv4 addresses and caches the answers for their ttl,
+        a name which cannot be resolved is cached as well, with the ttl of the
+        negative answer
+
+        upstream  : answers the names which are not cached, the hosts file, then the
+                    nameservers of resolv.conf and then the resolver of the system by
+                    default
+        cache     : (addresses, expires) by name, oldest first, the addresses are
+                    empty for a name which cannot be resolved
+        in_flight : the callbacks waiting for the lookup of each name, resolve_async
+                    only asks for a name once at a time
+        '''
+        self.loop = loop if loop is not None else get_event_loop()
+        self.upstream = upstream if upstream is not None else \
+            HostsFileUpstream(HOSTS_FILE, DNSUpstream(loop=self.loop,
+                                                      next_upstream=SystemUpstream()))
+        self.max_ttl = max_ttl
+        self.max_cache_size = max_cache_size
+        self.cache = OrderedDict()
+        self.in_flight = {}
+
+    # return the first address of name, raise socket.gaierror like gethostbyname
+    # if it cannot be resolved
+    def resolve(self, name):
+        addresses = self.resolve_all(name)
+        if not addresses:
+            raise socket.gaierror(socket.EAI_NONAME, "cannot resolve " + name)
+        return addresses[0]
+
+    # return all addresses of name, empty if it cannot be resolved, the caller waits
+    # for the upstream if the name is not cached
+    def resolve_all(self, name):
+        key = _cache_key(name)
+        if _is_ip_address(key):
+            return [key]
+        addresses = self._lookup_cached(key)
+        if addresses is not None:
+            return addresses
+        # an asynchronous lookup of the name may be on the way, it is not waited for,
+        # the loop must not run inside a synchronous call, which may itself be made
+        # from a callback of the loop, the name is asked again instead and the
+        # callbacks waiting for it get this answer
+        self.in_flight.setdefault(key, [])
+        try:
+            addresses, ttl = self.upstream.query(key)
+        except socket.error, e:
+            # e.g. no route to the nameservers, the name is answered as a failed
+            # lookup so that it leaves in_flight and the waiting callbacks are called
+            debug_log("cannot resolve %s: %s" % (key, e))
+            addresses, ttl = [], FAILURE_TTL
+        self._on_answer(key, addresses, ttl)
+        return addresses
+
+    # call callback with the addresses of name once they are known, it is called
+    # right away if the name is cached
+    def resolve_async(self, name, callback):
+        key = _cache_key(name)
+        if _is_ip_address(key):
+            callback([key])
+            return
+        addresses = self._lookup_cached(key)
+        if addresses is not None:
+            callback(addresses)
+            return
+        if key in self.in_flight:
+            self.in_flight[key].append(callback)
+            return
+        self.in_flight[key] = [callback]
+        try:
+            self.upstream.query_async(key,
+                                      lambda addresses, ttl: self._on_answer(key, addresses, ttl))
+        except socket.error, e:
+            debug_log("cannot resolve %s: %s" % (key, e))
+            self._on_answer(key, [], FAILURE_TTL)
+
+    # resolve the names in parallel and wait for all of them, so that the connections
+    # opened afterwards find them in the cache
+    def prefetch(self, names):
+        pending = set(_cache_key(name) for name in names)
+        for key in list(pending):
+            self.resolve_async(key, lambda addresses, key=key: pending.discard(key))
+        self.loop.run_until(lambda: not pending)
+
+    def clear(self):
+        self.cache.clear()
+
+    def _lookup_cached(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        addresses, expires = entry
+        if expires <= self.loop.time():
+            del self.cache[key]
+            return None
+        return addresses
+
+    def _on_answer(self, key, addresses, ttl):
+        ttl = min(ttl, self.max_ttl)
+        debug_log("resolved %s to %s, ttl %ds" % (key, addresses, ttl))
+        self.cache.pop(key, None)
+        if ttl > 0:
+            self.cache[key] = (addresses, self.loop.time() + ttl)
+            if len(self.cache) > self.max_cache_size:
+                self.cache.popitem(last=False)
+        for callback in self.in_flight.pop(key, []):
+            callback(addresses)
+
+
+class Upstream:
+    # return (addresses, ttl) of name, the addresses are empty if it does not exist
+    def query(self, name):
+        return [], NEGATIVE_TTL
+
+    # call callback(addresses, ttl) once the answer is known
+    def query_async(self, name, callback):
+        callback(*self.query(name))
+
+
+class StubUpstream(Upstream):
+    def __init__(self, addresses, ttl=DEFAULT_TTL):
+        '''
+        answers from a dict of address lists by name, without any network access
+
+        query_count : names asked for so far
+        '''
+        self.addresses = dict((_cache_key(name), list(name_addresses))
+                              for name, name_addresses in addresses.items())
+        self.ttl = ttl
+        self.query_count = 0
+
+    def query(self, name):
+        self.query_count += 1
+        if name not in self.addresses:
+            return [], NEGATIVE_TTL
+        return self.addresses[name], self.ttl
+
+
+class HostsFileUpstream(StubUpstream):
+    def __init__(self, path=HOSTS_FILE, next_upstream=None, ttl=DEFAULT_TTL):
+        '''
+        answers from a hosts file, the names which are not in it are passed to
+        next_upstream
+        '''
+        StubUpstream.__init__(self, read_hosts_file(path), ttl)
+        self.next_upstream = next_upstream
+
+    def query(self, name):
+        if name in self.addresses or self.next_upstream is None:
+            return StubUpstream.query(self, name)
+        return self.next_upstream.query(name)
+
+    def query_async(self, name, callback):
+        if name in self.addresses or self.next_upstream is None:
+            StubUpstream.query_async(self, name, callback)
+        else:
+            self.next_upstream.query_async(name, callback)
+
+
+class SystemUpstream(Upstream):
+    def __init__(self, ttl=DEFAULT_TTL):
+        '''
+        asks the resolver of the system, which blocks and gives no ttl
+        '''
+        self.ttl = ttl
+
+    def query(self, name):
+        try:
+            return socket.gethostbyname_ex(name)[2], self.ttl
+        except socket.gaierror:
+            return [], FAILURE_TTL
+
+
+class DNSUpstream(Upstream):
+    def __init__(self, nameservers=None, timeout=QUERY_TIMEOUT, attempts=QUERY_ATTEMPTS,
+                 loop=None, next_upstream=None):
+        '''
+        asks the nameservers for the a records of a name over udp, the ttl of the
+        answer is the lowest ttl of its records
+
+        nameservers   : ip addresses of the nameservers, those of resolv.conf by default,
+                        they are asked in turn until one answers
+        next_upstream : answers the names the nameservers do not resolve, e.g. a name
+                        which needs the search domains of resolv.conf, or one of
+                        another source of the system such as mdns
+        '''
+        self.nameservers = nameservers if nameservers is not None else read_nameservers()
+        self.timeout = timeout
+        self.attempts = attempts
+        self.loop = loop if loop is not None else get_event_loop()
+        self.next_upstream = next_upstream
+
+    def query(self, name):
+        addresses, ttl = self._query_nameservers(name)
+        if addresses or self.next_upstream is None:
+            return addresses, ttl
+        return self.next_upstream.query(name)
+
+    def query_async(self, name, callback):
+        def on_answer(addresses, ttl):
+            if addresses or self.next_upstream is None:
+                callback(addresses, ttl)
+            else:
+                self.next_upstream.query_async(name, callback)
+
+        DNSQuery(self, name, on_answer).send()
+
+    def _query_nameservers(self, name):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for nameserver in self.nameservers * self.attempts:
+                query_id = random.randint(0, 0xffff)
+                try:
+                    sock.sendto(build_query(query_id, name), (nameserver, DNS_PORT))
+                except socket.error, e:
+                    # e.g. no route to this nameserver, ask the next one
+                    debug_log("cannot ask %s for %s: %s" % (nameserver, name, e))
+                    continue
+                deadline = self.loop.time() + self.timeout
+                while self.loop.time() < deadline:
+                    sock.settimeout(deadline - self.loop.time())
+                    try:
+                        data, address = sock.recvfrom(4096)
+                    except socket.timeout:
+                        break
+                    answer = parse_response(data, query_id)
+                    if address[0] == nameserver and answer is not False:
+                        if answer is not None:
+                            return answer
+                        # this nameserver cannot answer, ask the next one
+                        break
+        finally:
+            sock.close()
+        debug_log("no nameserver has answered for " + name)
+        return [], FAILURE_TTL
+
+
+class DNSQuery:
+    def __init__(self, upstream, name, callback):
+        '''
+        a lookup on the event loop, the nameservers are asked in turn, each one
+        for the timeout of the upstream
+
+        remaining : the nameservers still to ask, one entry per attempt
+        query_id  : id of the query sent last
+        '''
+        self.upstream = upstream
+        self.loop = upstream.loop
+        self.name = name
+        self.callback = callback
+        self.remaining = upstream.nameservers * upstream.attempts
+        self.nameserver = None
+        self.query_id = None
+        self.timer = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    # ask the next nameserver, finish without addresses if all have been asked
+    def send(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if not self.remaining:
+            debug_log("no nameserver has answered for " + self.name)
+            self._finish([], FAILURE_TTL)
+            return
+        self.nameserver = self.remaining.pop(0)
+        self.query_id = random.randint(0, 0xffff)
+        try:
+            self.sock.sendto(build_query(self.query_id, self.name), (self.nameserver, DNS_PORT))
+        except socket.error, e:
+            # e.g. no route to this nameserver, ask the next one right away
+            debug_log("cannot ask %s for %s: %s" % (self.nameserver, self.name, e))
+            self.send()
+            return
+        self.timer = self.loop.call_later(self.upstream.timeout, self.send)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(4096)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                # an icmp error for an unreachable nameserver
+                self.send()
+                return
+            answer = parse_response(data, self.query_id)
+            if address[0] != self.nameserver or answer is False:
+                continue
+            if answer is None:
+                self.send()
+            else:
+                self._finish(*answer)
+            return
+
+    def _finish(self, addresses, ttl):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.callback(addresses, ttl)
+
+
+# a query for the a records of name, with recursion desired
+def build_query(query_id, name):
+    question = "".join(chr(len(label)) + label for label in name.split(".") if label)
+    return struct.pack(HEADER_FORMAT, query_id, FLAG_RD, 1, 0, 0, 0) + question + "\x00" + \
+        struct.pack("!HH", TYPE_A, CLASS_IN)
+
+
+# return (addresses, ttl) of a response, addresses is empty if the name does not
+# exist or has no a record, None if the nameserver could not answer and False if
+# the data is not a response to query_id, see RFC 1035 and RFC 2308 for the ttl of
+# a negative answer
+def parse_response(data, query_id):
+    if len(data) < HEADER_LENGTH:
+        return False
+    response_id, flags, question_count, answer_count, authority_count, _ = \
+        struct.unpack(HEADER_FORMAT, data[:HEADER_LENGTH])
+    if response_id != query_id or not flags & FLAG_QR:
+        return False
+    rcode = flags & 0xf
+    if rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return None
+    try:
+        offset = HEADER_LENGTH
+        for _ in range(question_count):
+            offset = _skip_name(data, offset) + 4
+        addresses = []
+        ttl = None
+        for _ in range(answer_count):
+            record_type, record_ttl, rdata, offset = _parse_record(data, offset)
+            if record_type == TYPE_A and len(rdata) == 4:
+                addresses.append(socket.inet_ntoa(rdata))
+            if record_type in (TYPE_A, TYPE_CNAME):
+                ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        if addresses and rcode == RCODE_NOERROR:
+            return addresses, ttl
+        negative_ttl = NEGATIVE_TTL
+        for _ in range(authority_count):
+            record_type, record_ttl, rdata, offset = _parse_record(data, offset)
+            if record_type == TYPE_SOA and len(rdata) >= 4:
+                negative_ttl = min(record_ttl, struct.unpack("!I", rdata[-4:])[0])
+        return [], negative_ttl
+    except (struct.error, IndexError):
+        return None
+
+
+# return (type, ttl, rdata, offset of the next record)
+def _parse_record(data, offset):
+    offset = _skip_name(data, offset)
+    record_type, _, ttl, rdata_length = struct.unpack("!HHIH", data[offset: offset + 10])
+    offset += 10
+    return record_type, ttl, data[offset: offset + rdata_length], offset + rdata_length
+
+
+# return the offset after the name at offset, a compressed name ends with a pointer
+def _skip_name(data, offset):
+    while True:
+        length = ord(data[offset])
+        if length == 0:
+            return offset + 1
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += length + 1
+
+
+def read_nameservers(path=RESOLV_CONF):
+    nameservers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                columns = line.split()
+                if len(columns) >= 2 and columns[0] == "nameserver" and _is_ip_address(columns[1]):
+                    nameservers.append(columns[1])
+    except IOError:
+        pass
+    return nameservers or ["127.0.0.1"]
+
+
+# the ipv4 addresses of each name in a hosts file
+def read_hosts_file(path=HOSTS_FILE):
+    addresses = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                columns = line.split("#", 1)[0].split()
+                if len(columns) < 2 or not _is_ip_address(columns[0]):
+                    continue
+                for name in columns[1:]:
+                    addresses.setdefault(_cache_key(name), []).append(columns[0])
+    except IOError:
+        pass
+    return addresses
+
+
+def _cache_key(name):
+    return name.lower().rstrip(".")
+
+
+def _is_ip_address(name):
+    if name.count(".") != 3:
+        return False
+    try:
+        socket.inet_aton(name)
+    except socket.error:
+        return False
+    return True
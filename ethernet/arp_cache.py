@@ -0,0 +1,121 @@
+from raw_socket import open_link
+from event_loop import get_event_loop
+from socket_logger import debug_log
+import arp_packet
+import ethernet_frame
+
+HTYPE_ARP = 0x0806
+BROADCAST_MAC = "\xff" * 6
+# an entry is used for this many seconds after it was resolved
+ARP_CACHE_TTL = 60.0
+# an entry which has been used is resolved again in the background this many
+# seconds before it expires, so that connections never wait for the gateway
+ARP_REFRESH_AHEAD = 10.0
+# seconds to wait for the reply of a background request
+ARP_REPLY_TIMEOUT = 1.0
+
+
+class ArpEntry:
+    def __init__(self, mac, expires):
+        '''
+        mac     : hardware address of the neighbour
+        expires : when the entry stops being used
+        used    : the entry has been looked up since it was resolved
+        '''
+        self.mac = mac
+        self.expires = expires
+        self.used = False
+
+
+class ArpCache:
+    def __init__(self, device, src_ip, src_mac, ttl=ARP_CACHE_TTL, event_loop=None):
+        '''
+        the hardware addresses of the neighbours on an interface, shared by all
+        sockets of the process, the entries are refreshed on the event loop
+
+        entries    : ArpEntry by ip address
+        timers     : refresh timer of each entry
+        requests   : the raw socket and the timeout timer of each background request
+        '''
+        self.device = device
+        self.src_ip = src_ip
+        self.src_mac = src_mac
+        self.ttl = ttl
+        self.event_loop = event_loop if event_loop is not None else get_event_loop()
+        self.entries = {}
+        self.timers = {}
+        self.requests = {}
+
+    # the mac of ip, None if it has not been resolved or its entry has expired
+    def lookup(self, ip):
+        entry = self.entries.get(ip)
+        if entry is None:
+            return None
+        if entry.expires <= self.event_loop.time():
+            self._remove(ip)
+            return None
+        entry.used = True
+        return entry.mac
+
+    def add(self, ip, mac):
+        entry = ArpEntry(mac, self.event_loop.time() + self.ttl)
+        self.entries[ip] = entry
+        self._cancel_timer(ip)
+        self.timers[ip] = self.event_loop.call_at(entry.expires - ARP_REFRESH_AHEAD,
+                                                  self._refresh, ip)
+
+    # forget all entries, the neighbours are resolved again when they are looked up
+    def clear(self):
+        for ip in list(self.entries):
+            self._remove(ip)
+        for ip in list(self.requests):
+            self._end_request(ip)
+
+    def _remove(self, ip):
+        self.entries.pop(ip, None)
+        self._cancel_timer(ip)
+
+    def _cancel_timer(self, ip):
+        timer = self.timers.pop(ip, None)
+        if timer is not None:
+            timer.cancel()
+
+    # send a request for an entry about to expire, an entry which has not been used
+    # since it was resolved is left to expire
+    def _refresh(self, ip):
+        self.timers.pop(ip, None)
+        entry = self.entries.get(ip)
+        if entry is None or not entry.used or ip in self.requests:
+            return
+        debug_log("refresh the arp entry of " + ip)
+        raw_socket = open_link(self.device, event_loop=self.event_loop)
+        raw_socket.allow_arp()
+        request = arp_packet.ARPPacket(self.src_mac, self.src_ip, BROADCAST_MAC, ip)
+        frame = ethernet_frame.EthernetFrame(self.src_mac, BROADCAST_MAC, HTYPE_ARP,
+                                             arp_packet.assemble(request))
+        raw_socket.send(ethernet_frame.assemble(frame))
+        timer = self.event_loop.call_later(ARP_REPLY_TIMEOUT, self._end_request, ip)
+        self.requests[ip] = (raw_socket, timer)
+        self.event_loop.add_reader(raw_socket.fileno(), lambda: self._on_readable(ip))
+
+    def _on_readable(self, ip):
+        raw_socket = self.requests[ip][0]
+        while True:
+            frame = raw_socket.receive_nowait()
+            if frame is None:
+                return
+            received_frame = ethernet_frame.dissemble(frame)
+            if received_frame.type_num != HTYPE_ARP:
+                continue
+            reply = arp_packet.dissemble(received_frame.data)
+            if reply.optr == arp_packet.OPTR_REPLY and reply.spa == ip:
+                self.add(ip, reply.sha)
+                self._end_request(ip)
+                return
+
+    # without a reply the entry expires and the next socket asks for it again
+    def _end_request(self, ip):
+        raw_socket, timer = self.requests.pop(ip)
+        timer.cancel()
+        self.event_loop.remove_reader(raw_socket.fileno())
+        raw_socket.close()
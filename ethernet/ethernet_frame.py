@@ -15,8 +15,9 @@ def assemble(ethernet_frame):
 def dissemble(full_frame):
     ethernet_frame = EthernetFrame()
     header = unpack(ETHERNET_FRAME_FORMAT, full_frame[0:HEADER_LENGTH])
-    ethernet_frame.src_mac = header[0]
-    ethernet_frame.dest_mac = header[1]
+    # the destination comes first, like in assemble
+    ethernet_frame.dest_mac = header[0]
+    ethernet_frame.src_mac = header[1]
     ethernet_frame.type_num = header[2]
     ethernet_frame.data = full_frame[HEADER_LENGTH:]
     return ethernet_frame
@@ -1,6 +1,8 @@
 from ethernet_frame import EthernetFrame
-from raw_socket import RawSocket
-from utils import get_local_mac, get_mac_addr_from_str, get_default_iface
+from raw_socket import open_link
+from buffer_pool import BufferPool
+from utils import get_mac_addr_from_str
+from network_context import get_network_context
 from socket_logger import debug_log
 import arp_packet
 import ethernet_frame
@@ -10,27 +12,73 @@ PTYPE_IPV4 = 0x0800
 
 
 class EthernetSocket:
-    def __init__(self, src_ip, gateway_ip):
-        network_device_name = get_default_iface()
-        self.raw_socket = RawSocket(network_device_name)
-        self.src_mac = get_local_mac()
-        # temp dest mac address FF:FF:FF:FF:FF:FF
-        # ARP can get the real gateway mac address by broadcast
-        self.dest_mac = get_mac_addr_from_str("FF:FF:FF:FF:FF:FF")
-        self.dest_mac = self._get_remote_mac(src_ip, self.src_mac, gateway_ip)
-        self.raw_socket = RawSocket()
+    def __init__(self, src_ip, gateway_ip, zero_copy=False, rx_ring=False):
+        # the interface, its mac and the gateway mac are looked up once per process
+        network_context = get_network_context()
+        network_device_name = network_context.device
+        # receive frames into preallocated buffers in zero-copy mode
+        buffer_pool = BufferPool() if zero_copy else None
+        self.raw_socket = open_link(network_device_name, buffer_pool)
+        self.event_loop = self.raw_socket.event_loop
+        # or read them out of a memory-mapped ring
+        if rx_ring:
+            self.raw_socket.enable_rx_ring()
+        self.src_mac = network_context.local_mac
+        self.dest_mac = network_context.arp_cache.lookup(gateway_ip)
+        if self.dest_mac is None:
+            # temp dest mac address FF:FF:FF:FF:FF:FF
+            # ARP can get the real gateway mac address by broadcast
+            self.dest_mac = get_mac_addr_from_str("FF:FF:FF:FF:FF:FF")
+            self.dest_mac = self._get_remote_mac(src_ip, self.src_mac, gateway_ip)
+            network_context.arp_cache.add(gateway_ip, self.dest_mac)
 
     def send(self, data, type_num=PTYPE_IPV4):
         # create an ethernet frame
         ethernet_frm = EthernetFrame(self.src_mac, self.dest_mac, type_num, data)
         self.raw_socket.send(ethernet_frame.assemble(ethernet_frm))
 
-    def receive(self, type_num=PTYPE_IPV4):
+    # send a frame which already contains the ethernet header
+    def send_frame(self, frame):
+        self.raw_socket.send(frame)
+
+    # queue a frame which already contains the ethernet header, it is sent by flush
+    def queue_frame(self, frame):
+        self.raw_socket.queue(frame)
+
+    def flush(self):
+        self.raw_socket.flush()
+
+    def receive(self, type_num=PTYPE_IPV4, deadline=None):
         while True:
-            recv_frame = ethernet_frame.dissemble(self.raw_socket.receive())
+            recv_frame = ethernet_frame.dissemble(self.raw_socket.receive(deadline=deadline))
             # if the frame is the type of data we expect to receive
             if recv_frame.type_num == type_num:
                 return recv_frame.data
+            self.raw_socket.recycle()
+
+    # only let the frames of the given connection reach this socket
+    def allow_connection(self, connection):
+        self.raw_socket.allow_connection(connection)
+
+    def disallow_connection(self, connection):
+        self.raw_socket.disallow_connection(connection)
+
+    # receive a full frame of any type, the caller decodes it
+    def receive_frame(self, deadline=None):
+        return self.raw_socket.receive(deadline=deadline)
+
+    def receive_frame_nowait(self):
+        return self.raw_socket.receive_nowait()
+
+    def fileno(self):
+        return self.raw_socket.fileno()
+
+    def close(self):
+        self.raw_socket.close()
+
+    # recycle the buffers of all received frames, only needed in zero-copy mode
+    def recycle(self):
+        self.raw_socket.recycle()
 
     def _get_remote_mac(self, src_ip, src_mac, gate_ip):
         spa = src_ip
@@ -38,6 +86,8 @@ class EthernetSocket:
         tpa = gate_ip
         tha = self.dest_mac
 
+        # let the arp reply through the socket filter while waiting for it
+        self.raw_socket.allow_arp()
         sent_arp_pac = arp_packet.ARPPacket(sha, spa, tha, tpa)
         sent_arp_data = arp_packet.assemble(sent_arp_pac)
         debug_log("send arp request")
@@ -46,4 +96,6 @@ class EthernetSocket:
         recv_arp_data = self.receive(type_num=HTYPE_ARP)
         debug_log("receive arp response")
         recv_arp_pac = arp_packet.dissemble(recv_arp_data)
+        self.recycle()
+        self.raw_socket.allow_arp(False)
         return recv_arp_pac.sha
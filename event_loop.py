@@ -0,0 +1,248 @@
+import time
+import select
+import errno
+
+# the wheel ticks every millisecond, each level has 256 slots
+TICKS_PER_SECOND = 1000
+SLOT_BITS = 8
+SLOT_COUNT = 1 << SLOT_BITS
+SLOT_MASK = SLOT_COUNT - 1
+LEVEL_COUNT = 4
+
+
+class Timer:
+    def __init__(self, expires, callback, args):
+        '''
+        expires   : tick at which the timer fires
+        callback  : function called when the timer fires
+        args      : arguments of the callback
+        cancelled : a cancelled timer stays in its slot but never fires
+        '''
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, current_tick):
+        '''
+        a hierarchical timer wheel with millisecond ticks, a timer is kept in the
+        lowest level whose range covers it and cascades down as time passes
+
+        current_tick : the last tick which has been processed
+        levels       : LEVEL_COUNT lists of SLOT_COUNT slots
+        timer_count  : number of timers in the wheel, including cancelled ones
+        level_counts : number of timers in each level
+        '''
+        self.current_tick = current_tick
+        self.levels = [[[] for i in range(SLOT_COUNT)] for j in range(LEVEL_COUNT)]
+        self.timer_count = 0
+        self.level_counts = [0] * LEVEL_COUNT
+
+    def add(self, expires, callback, args=()):
+        timer = Timer(max(expires, self.current_tick + 1), callback, args)
+        self._place(timer)
+        self.timer_count += 1
+        return timer
+
+    def _place(self, timer):
+        delta = timer.expires - self.current_tick
+        for level in range(LEVEL_COUNT):
+            # a timer one full revolution ahead lands in the current slot of an upper
+            # level, which is cascaded again exactly when its range starts
+            if delta < 1 << (SLOT_BITS * (level + 1)) or level == LEVEL_COUNT - 1:
+                slot = (timer.expires >> (SLOT_BITS * level)) & SLOT_MASK
+                self.levels[level][slot].append(timer)
+                self.level_counts[level] += 1
+                return
+
+    # process all ticks up to the given one, and return the expired timers
+    def advance(self, tick):
+        expired = []
+        if self.timer_count == 0:
+            self.current_tick = max(self.current_tick, tick)
+            return expired
+        while self.current_tick < tick:
+            if self.level_counts[0] == 0:
+                # nothing can expire before the lowest level wraps, skip to it
+                self.current_tick = min(tick - 1, self.current_tick | SLOT_MASK)
+            self.current_tick += 1
+            # move the timers of the next slot of the upper levels down when a lower level wraps
+            level = 1
+            while level < LEVEL_COUNT and self.current_tick & ((1 << (SLOT_BITS * level)) - 1) == 0:
+                slot = (self.current_tick >> (SLOT_BITS * level)) & SLOT_MASK
+                timers = self.levels[level][slot]
+                self.levels[level][slot] = []
+                self.level_counts[level] -= len(timers)
+                for timer in timers:
+                    self._place(timer)
+                level += 1
+            slot = self.current_tick & SLOT_MASK
+            timers = self.levels[0][slot]
+            if timers:
+                self.levels[0][slot] = []
+                self.level_counts[0] -= len(timers)
+                for timer in timers:
+                    # the top level may hold timers which wrap around more than once
+                    if timer.expires > self.current_tick:
+                        self._place(timer)
+                        continue
+                    self.timer_count -= 1
+                    if not timer.cancelled:
+                        expired.append(timer)
+            if self.timer_count == 0:
+                self.current_tick = tick
+        return expired
+
+    # number of ticks until the next timer may expire, None if there is no timer
+    # the result may be earlier than the real expiry for timers in the upper levels
+    def next_expiry(self):
+        if self.timer_count == 0:
+            return None
+        next_expiry = None
+        for level in range(LEVEL_COUNT):
+            if self.level_counts[level] == 0:
+                continue
+            shift = SLOT_BITS * level
+            current_slot = (self.current_tick >> shift) & SLOT_MASK
+            for distance in range(1, SLOT_COUNT + 1):
+                if self.levels[level][(current_slot + distance) & SLOT_MASK]:
+                    # an upper level slot starts cascading at the beginning of its range
+                    expiry = max(1, (((self.current_tick >> shift) + distance) << shift) - self.current_tick)
+                    if next_expiry is None or expiry < next_expiry:
+                        next_expiry = expiry
+                    break
+        return next_expiry
+
+
+class EventLoop:
+    def __init__(self):
+        '''
+        an epoll based event loop with a timer wheel for deadlines
+
+        epoll       : the epoll object all file descriptors are registered in
+        readers     : callbacks called when a file descriptor becomes readable
+        oneshot_fds : file descriptors registered for a single readiness event
+        timer_wheel : timers in milliseconds
+        '''
+        self.epoll = select.epoll()
+        self.readers = {}
+        self.oneshot_fds = set()
+        self.timer_wheel = TimerWheel(self._current_tick())
+
+    def time(self):
+        return time.time()
+
+    def _current_tick(self):
+        return int(self.time() * TICKS_PER_SECOND)
+
+    # call the function after delay seconds, return a timer which can be cancelled
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        # round up so that a timer never fires before its deadline
+        expires = int(when * TICKS_PER_SECOND) + 1
+        return self.timer_wheel.add(expires, callback, args)
+
+    # call the function whenever the file descriptor is readable
+    def add_reader(self, fd, callback):
+        self._register(fd, callback, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if fd in self.readers:
+            del self.readers[fd]
+            self.oneshot_fds.discard(fd)
+            self.epoll.unregister(fd)
+
+    def _register(self, fd, callback, event_mask):
+        if fd in self.readers:
+            try:
+                self.epoll.modify(fd, event_mask)
+            except IOError, e:
+                # the file descriptor has been closed and reused since, epoll has
+                # dropped the closed one
+                if e.errno != errno.ENOENT:
+                    raise
+                self.epoll.register(fd, event_mask)
+        else:
+            self.epoll.register(fd, event_mask)
+        self.readers[fd] = callback
+        if event_mask & select.EPOLLONESHOT:
+            self.oneshot_fds.add(fd)
+        else:
+            self.oneshot_fds.discard(fd)
+
+    # wait for events and timers once, timeout is in seconds
+    def run_once(self, timeout=None):
+        poll_timeout = -1 if timeout is None else max(timeout, 0)
+        next_expiry = self.timer_wheel.next_expiry()
+        if next_expiry is not None:
+            timer_timeout = float(next_expiry) / TICKS_PER_SECOND
+            poll_timeout = timer_timeout if poll_timeout < 0 else min(poll_timeout, timer_timeout)
+        try:
+            events = self.epoll.poll(poll_timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            callback = self.readers.get(fd)
+            if callback is not None:
+                callback()
+        for timer in self.timer_wheel.advance(self._current_tick()):
+            timer.callback(*timer.args)
+
+    # run the loop until the predicate returns True
+    def run_until(self, predicate):
+        while not predicate():
+            self.run_once()
+
+    # run the loop until the file descriptor is readable or the deadline passes,
+    # return False if the deadline has passed
+    def wait_readable(self, fd, deadline=None):
+        state = {"readable": False, "expired": False}
+
+        def on_readable():
+            state["readable"] = True
+
+        def on_expired():
+            state["expired"] = True
+
+        # a reader already registered for the file descriptor gets it back afterwards
+        previous_reader = self.readers.get(fd)
+        previous_mask = select.EPOLLIN
+        if fd in self.oneshot_fds:
+            previous_mask |= select.EPOLLONESHOT
+        self._register(fd, on_readable, select.EPOLLIN | select.EPOLLONESHOT)
+        timer = None
+        if deadline is not None:
+            timer = self.call_at(deadline, on_expired)
+        try:
+            while not state["readable"] and not state["expired"]:
+                self.run_once()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if self.readers.get(fd) is on_readable:
+                if previous_reader is not None:
+                    self._register(fd, previous_reader, previous_mask)
+                else:
+                    # the file descriptor stays registered but disarmed
+                    self.readers[fd] = None
+        return state["readable"]
+
+
+_event_loop = None
+
+
+# the event loop shared by all sockets of the process
+def get_event_loop():
+    global _event_loop
+    if _event_loop is None:
+        _event_loop = EventLoop()
+    return _event_loop
@@ -1,8 +1,23 @@
-from http.http_content import build_http_content, parse_http_response
+from http.http_content import build_http_content, parse_http_response, parse_http_header, \
+    HEADER_END_MARK
+from http.http_response import HTTPResponseParser, ResponsePlacer
 from tcp.tcp_socket import TCPSocket
-from socket_logger import error_log
+from tcp.tcp_stream import StreamProtocol, create_connection
+from event_loop import get_event_loop
+from packet_engine import get_packet_engine
+from socket_logger import debug_log, error_log
+from collections import deque
 import sys
 
+# parallel connections and smallest range of a segmented download
+DEFAULT_CONNECTIONS = 4
+DEFAULT_MIN_RANGE_SIZE = 1 << 20
+# a range which has received nothing for this long is requested again
+STALL_TIMEOUT = 3.0
+STALL_CHECK_INTERVAL = 0.5
+# how many times the rest of one range is requested again before giving up
+MAX_RANGE_RETRIES = 3
+
 
 def do_get(url):
     host, http_data = build_http_content(url)
@@ -18,6 +33,354 @@ def do_get(url):
     return http_body
 
 
+# get url and pass its body to body_handler in pieces as it arrives, so that memory
+# use does not grow with the size of the body
+def do_get_stream(url, body_handler):
+    host, http_data = build_http_content(url)
+    parser = HTTPResponseParser()
+    responses = []
+
+    def on_header(response):
+        if response.status_code != "200":
+            error_log("status code of the response is not 200, exit the program!")
+            sys.exit(-1)
+
+    parser.expect("GET", on_header, body_handler)
+    tcp_socket = TCPSocket(host)
+    tcp_socket.set_data_handler(lambda data: responses.extend(parser.feed(data)))
+    tcp_socket.send(http_data)
+    if not tcp_socket.close():
+        debug_log("failed to close the socket")
+    # a body without framing ends with the connection
+    response = parser.finish()
+    if response is not None:
+        responses.append(response)
+    if not responses:
+        error_log("the response is incomplete, exit the program!")
+        sys.exit(-1)
+    return responses[0]
+
+
+# get url into file_name, a body of known length is written at the offsets of the
+# received payloads, in order or not, so that nothing is buffered on the way
+def do_get_to_file(url, file_name):
+    host, http_data = build_http_content(url)
+
+    def on_header(response):
+        if response.status_code != "200":
+            error_log("status code of the response is not 200, exit the program!")
+            sys.exit(-1)
+
+    placer = ResponsePlacer(file_name, on_header)
+    tcp_socket = TCPSocket(host)
+    tcp_socket.set_stream_placer(placer)
+    tcp_socket.send(http_data)
+    if not tcp_socket.close():
+        debug_log("failed to close the socket")
+    response = placer.finish()
+    if response is None:
+        placer.discard()
+        error_log("the response is incomplete, exit the program!")
+        sys.exit(-1)
+    return response
+
+
+# start a get request in the event loop, callback is called with the status code
+# and the body once the response is complete, or with (None, None) on failure
+def do_get_async(url, callback, loop=None, engine=None):
+    host, http_data = build_http_content(url)
+    return create_connection(lambda: HTTPResponseProtocol(http_data, callback), host,
+                             loop=loop, engine=engine)
+
+
+class HTTPResponseProtocol(StreamProtocol):
+    def __init__(self, http_data, callback):
+        '''
+        http_data : the request to send
+        callback  : called with the status code and the body of the response
+        chunks    : the response data received so far
+        '''
+        self.http_data = http_data
+        self.callback = callback
+        self.chunks = []
+
+    def connection_made(self, transport):
+        transport.write(self.http_data)
+
+    def data_received(self, data):
+        self.chunks.append(data)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            error_log("failed to get the response: " + str(exc))
+            self.callback(None, None)
+            return
+        response = "".join(self.chunks)
+        header_end = response.find(HEADER_END_MARK)
+        if header_end == -1:
+            error_log("the response header is incomplete")
+            self.callback(None, None)
+            return
+        status_code, headers = parse_http_header(response[:header_end])
+        if status_code is None:
+            self.callback(None, None)
+            return
+        http_body = response[header_end + len(HEADER_END_MARK):]
+        # a body cut short by the connection is a failure, not a shorter body
+        content_length = headers.get("content-length", "")
+        if content_length.isdigit() and len(http_body) < int(content_length):
+            error_log("the response body is incomplete, " + str(len(http_body)) + " of "
+                      + content_length + " bytes received")
+            self.callback(None, None)
+            return
+        self.callback(status_code, http_body)
+
+
+# start a head request in the event loop, callback is called with the status code and
+# the lowercased headers of the response, or with (None, None) on failure
+def do_head_async(url, callback, loop=None, engine=None):
+    host, http_data = build_http_content(url, "HEAD")
+    return create_connection(lambda: HTTPHeaderProtocol(http_data, callback), host,
+                             loop=loop, engine=engine)
+
+
+class HTTPHeaderProtocol(StreamProtocol):
+    def __init__(self, http_data, callback):
+        '''
+        http_data : the request to send
+        callback  : called with the status code and the headers of the response
+        chunks    : the response data received so far
+        '''
+        self.http_data = http_data
+        self.callback = callback
+        self.chunks = []
+
+    def connection_made(self, transport):
+        transport.write(self.http_data)
+
+    def data_received(self, data):
+        self.chunks.append(data)
+
+    def connection_lost(self, exc):
+        response = "".join(self.chunks)
+        if exc is not None or response.find(HEADER_END_MARK) == -1:
+            error_log("failed to get the response header: " + str(exc))
+            self.callback(None, None)
+            return
+        self.callback(*parse_http_header(response[:response.index(HEADER_END_MARK)]))
+
+
+# download url into file_name over several connections, each fetching a byte range,
+# return False if the download failed
+def do_get_segmented(url, file_name, connections=DEFAULT_CONNECTIONS,
+                     min_range_size=DEFAULT_MIN_RANGE_SIZE, loop=None, engine=None):
+    loop = loop if loop is not None else get_event_loop()
+    engine = engine if engine is not None else get_packet_engine()
+    head = {}
+
+    def on_head(status_code, headers):
+        head["status_code"] = status_code
+        head["headers"] = headers
+
+    do_head_async(url, on_head, loop, engine)
+    loop.run_until(lambda: "status_code" in head)
+
+    size = None
+    if head["status_code"] == "200" and "content-length" in head["headers"]:
+        size = int(head["headers"]["content-length"])
+    # a single connection is enough if the size is unknown or the file is small
+    if size is None or connections < 2 or size < 2 * min_range_size:
+        debug_log("download " + url + " over a single connection")
+        do_get_to_file(url, file_name)
+        return True
+
+    with open(file_name, "w+b") as out_file:
+        download = SegmentedDownload(url, out_file, size, connections, min_range_size,
+                                     loop, engine)
+        return download.run()
+
+
+class ByteRange:
+    def __init__(self, start, end):
+        '''
+        start         : offset of the first byte of the range
+        end           : offset after the last byte, lowered when the range is split
+        received      : number of bytes written from start
+        transport     : the connection fetching the range
+        last_progress : when data was last received
+        retries       : how many times the range has been requested again
+        '''
+        self.start = start
+        self.end = end
+        self.received = 0
+        self.transport = None
+        self.last_progress = None
+        self.retries = 0
+
+    def position(self):
+        return self.start + self.received
+
+    def remaining(self):
+        return self.end - self.position()
+
+
+class SegmentedDownload:
+    def __init__(self, url, out_file, size, connections, min_range_size, loop, engine):
+        '''
+        fetches the byte ranges of a file over parallel connections and writes each
+        range at its offset, a finished connection takes over half of the largest
+        range left and a stalled one is requested again
+
+        out_file : the file the ranges are written into
+        size     : size of the whole file
+        ranges   : the ranges being downloaded
+        failed   : set once a range cannot be downloaded
+        '''
+        self.url = url
+        self.out_file = out_file
+        self.size = size
+        self.connections = connections
+        self.min_range_size = min_range_size
+        self.loop = loop
+        self.engine = engine
+        self.ranges = []
+        self.failed = False
+        self.stall_timer = None
+
+    def run(self):
+        self.out_file.truncate(self.size)
+        range_count = min(self.connections, max(1, self.size // self.min_range_size))
+        range_size = self.size // range_count
+        for index in range(range_count):
+            end = self.size if index == range_count - 1 else (index + 1) * range_size
+            self._open(ByteRange(index * range_size, end))
+        self.stall_timer = self.loop.call_later(STALL_CHECK_INTERVAL, self._check_stalls)
+        self.loop.run_until(lambda: self.failed or not self.ranges)
+        self.stall_timer.cancel()
+        for byte_range in list(self.ranges):
+            byte_range.transport.abort()
+        return not self.failed
+
+    def _open(self, byte_range):
+        debug_log("request bytes %d-%d of %s" % (byte_range.start, byte_range.end - 1, self.url))
+        byte_range.last_progress = self.loop.time()
+        self.ranges.append(byte_range)
+        headers = [("Range", "bytes=%d-%d" % (byte_range.start, byte_range.end - 1))]
+        host, http_data = build_http_content(self.url, headers=headers)
+        try:
+            byte_range.transport = create_connection(lambda: RangeProtocol(self, byte_range, http_data),
+                                                     host, loop=self.loop, engine=self.engine)
+        except IOError, e:
+            error_log("failed to connect for a range of " + self.url + ": " + str(e))
+            self.failed = True
+
+    # the server ignored the range and sends the whole file, let this range take it
+    def take_whole_file(self, byte_range):
+        byte_range.end = self.size
+        for other_range in list(self.ranges):
+            if other_range is not byte_range:
+                self.ranges.remove(other_range)
+                other_range.transport.abort()
+
+    def data_received(self, byte_range, data):
+        if byte_range not in self.ranges:
+            return
+        data = data[:byte_range.remaining()]
+        self.out_file.seek(byte_range.position())
+        self.out_file.write(data)
+        byte_range.received += len(data)
+        byte_range.last_progress = self.loop.time()
+        # the range may have been split, the rest belongs to another connection
+        if byte_range.remaining() == 0:
+            byte_range.transport.abort()
+
+    def connection_lost(self, byte_range, exc):
+        if byte_range not in self.ranges:
+            return
+        self.ranges.remove(byte_range)
+        if self.failed:
+            return
+        if byte_range.remaining() > 0:
+            self._retry(byte_range, exc)
+        else:
+            self._split_largest()
+
+    def _retry(self, byte_range, exc):
+        if byte_range.retries >= MAX_RANGE_RETRIES:
+            error_log("failed to download bytes %d-%d of %s: %s"
+                      % (byte_range.position(), byte_range.end - 1, self.url, str(exc)))
+            self.failed = True
+            return
+        rest = ByteRange(byte_range.position(), byte_range.end)
+        rest.retries = byte_range.retries + 1
+        self._open(rest)
+
+    # hand the second half of the largest range to a new connection
+    def _split_largest(self):
+        if not self.ranges:
+            return
+        largest = max(self.ranges, key=lambda byte_range: byte_range.remaining())
+        if largest.remaining() < 2 * self.min_range_size:
+            return
+        split = largest.position() + largest.remaining() // 2
+        new_range = ByteRange(split, largest.end)
+        largest.end = split
+        self._open(new_range)
+
+    def _check_stalls(self):
+        now = self.loop.time()
+        for byte_range in list(self.ranges):
+            if now - byte_range.last_progress > STALL_TIMEOUT:
+                debug_log("range at %d of %s stalled" % (byte_range.position(), self.url))
+                # connection_lost requests the rest of the range again
+                byte_range.transport.abort()
+        self.stall_timer = self.loop.call_later(STALL_CHECK_INTERVAL, self._check_stalls)
+
+
+class RangeProtocol(StreamProtocol):
+    def __init__(self, download, byte_range, http_data):
+        '''
+        download    : the segmented download the range belongs to
+        byte_range  : the range fetched by this connection
+        http_data   : the range request to send
+        header_data : the response data received before the end of the header
+        '''
+        self.download = download
+        self.byte_range = byte_range
+        self.http_data = http_data
+        self.header_data = ""
+        self.header_done = False
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(self.http_data)
+
+    def data_received(self, data):
+        if self.header_done:
+            self.download.data_received(self.byte_range, data)
+            return
+        self.header_data += data
+        if self.header_data.find(HEADER_END_MARK) == -1:
+            return
+        header_end = self.header_data.index(HEADER_END_MARK)
+        body = self.header_data[header_end + len(HEADER_END_MARK):]
+        status_code, _ = parse_http_header(self.header_data[:header_end])
+        self.header_done = True
+        self.header_data = ""
+        if status_code == "200" and self.byte_range.start == 0:
+            self.download.take_whole_file(self.byte_range)
+        elif status_code != "206":
+            error_log("unexpected status code of a range response: " + str(status_code))
+            self.transport.abort()
+            return
+        if body:
+            self.download.data_received(self.byte_range, body)
+
+    def connection_lost(self, exc):
+        self.download.connection_lost(self.byte_range, exc)
+
+
 # to be implemented
 def do_post(url, data):
     return ""
@@ -0,0 +1,237 @@
+from collections import deque
+from http_content import build_http_content
+from http_response import HTTPResponseParser
+from tcp.tcp_stream import StreamProtocol, create_connection
+from event_loop import get_event_loop
+from socket_logger import debug_log, error_log
+
+DEFAULT_MAX_PER_HOST = 4
+# idle connections are closed after this many seconds
+DEFAULT_IDLE_TIMEOUT = 30.0
+# most requests sent ahead on one connection when pipelining
+DEFAULT_PIPELINE_DEPTH = 8
+# a request which was sent on a connection closed by the server is sent again once
+MAX_REQUEST_RETRIES = 1
+
+
+class HTTPRequest:
+    def __init__(self, url, method, callback, header_handler=None, body_handler=None):
+        '''
+        host           : the host part of the url
+        data           : the request to send
+        callback       : called with the HTTPResponse, or with None on failure
+        header_handler : called with the HTTPResponse once its header has arrived
+        body_handler   : if set, the body is streamed to it instead of being kept
+        retries        : how many times the request has been sent again
+        '''
+        self.url = url
+        self.method = method
+        self.callback = callback
+        self.header_handler = header_handler
+        self.body_handler = body_handler
+        self.retries = 0
+        host, http_data = build_http_content(url, method, [("Connection", "keep-alive")],
+                                             version="HTTP/1.1")
+        self.host = host
+        self.data = http_data
+
+
+class HTTPConnection(StreamProtocol):
+    def __init__(self, pool, host):
+        '''
+        a persistent http/1.1 connection of a pool
+
+        requests    : sent requests waiting for their responses, in order
+        parser      : splits the received data into responses
+        reusable    : cleared once a response asks for the connection to be closed
+        idle_timer  : closes the connection when it has been idle for too long
+        '''
+        self.pool = pool
+        self.host = host
+        self.transport = None
+        self.requests = deque()
+        self.parser = HTTPResponseParser()
+        self.connected = False
+        self.reusable = True
+        self.closed = False
+        self.idle_timer = None
+
+    def send_request(self, request):
+        self.cancel_idle_timer()
+        self.requests.append(request)
+        self.parser.expect(request.method, request.header_handler, request.body_handler)
+        if self.connected:
+            self.transport.write(request.data)
+
+    def is_idle(self):
+        return self.connected and not self.requests and self.reusable and not self.closed
+
+    def outstanding_count(self):
+        return len(self.requests)
+
+    def connection_made(self, transport):
+        self.connected = True
+        # requests assigned while connecting
+        for request in self.requests:
+            transport.write(request.data)
+
+    def data_received(self, data):
+        # a response no request is waiting for leaves the connection out of step
+        # with its requests, the data is dropped and the connection closed
+        if not self.requests:
+            self.close()
+            return
+        for response in self.parser.feed(data):
+            if not self.requests:
+                self.close()
+                return
+            request = self.requests.popleft()
+            if not response.keep_alive:
+                self.reusable = False
+            request.callback(response)
+        if self.parser.error:
+            self.reusable = False
+            self.transport.abort()
+            return
+        if not self.requests:
+            self.pool.connection_available(self)
+
+    def eof_received(self):
+        self.reusable = False
+        response = self.parser.finish()
+        if response is not None and self.requests:
+            self.requests.popleft().callback(response)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.cancel_idle_timer()
+        self.pool.connection_closed(self, exc)
+
+    def close(self):
+        self.reusable = False
+        self.cancel_idle_timer()
+        if self.transport is not None and not self.closed:
+            self.transport.close()
+
+    def cancel_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+
+class ConnectionPool:
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 pipelining=False, pipeline_depth=DEFAULT_PIPELINE_DEPTH, loop=None, engine=None):
+        '''
+        keeps http/1.1 connections open per host and sends the requests to the same
+        host over them, instead of a handshake and a teardown for each request
+
+        max_per_host   : most connections open to one host
+        idle_timeout   : seconds an idle connection is kept open
+        pipelining     : send the next requests before the responses of the previous ones
+        pipeline_depth : most requests outstanding on one connection when pipelining
+        connections    : the open connections of each host
+        waiting        : the requests of each host waiting for a connection
+        '''
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.pipelining = pipelining
+        self.pipeline_depth = pipeline_depth
+        self.loop = loop if loop is not None else get_event_loop()
+        self.engine = engine
+        self.connections = {}
+        self.waiting = {}
+
+    def get(self, url, callback, header_handler=None, body_handler=None):
+        self.request(url, callback, "GET", header_handler, body_handler)
+
+    # callback is called with the HTTPResponse of the request, or with None on failure,
+    # the body is passed to body_handler in pieces instead if it is set
+    def request(self, url, callback, method="GET", header_handler=None, body_handler=None):
+        self._dispatch(HTTPRequest(url, method, callback, header_handler, body_handler))
+
+    def pending_count(self):
+        return sum(len(requests) for requests in self.waiting.values()) + \
+            sum(connection.outstanding_count() for connections in self.connections.values()
+                for connection in connections)
+
+    def open_count(self):
+        return sum(len(connections) for connections in self.connections.values())
+
+    # close all connections of the pool
+    def close(self):
+        for connections in self.connections.values():
+            for connection in list(connections):
+                connection.close()
+
+    def _dispatch(self, request):
+        connection = self._find_connection(request.host)
+        if connection is not None:
+            connection.send_request(request)
+        else:
+            self.waiting.setdefault(request.host, deque()).append(request)
+
+    def _find_connection(self, host):
+        connections = self.connections.setdefault(host, [])
+        for connection in connections:
+            if connection.is_idle():
+                return connection
+        if len(connections) < self.max_per_host:
+            return self._open(host)
+        if self.pipelining:
+            candidates = [connection for connection in connections
+                          if connection.reusable and not connection.closed
+                          and connection.outstanding_count() < self.pipeline_depth]
+            if candidates:
+                return min(candidates, key=lambda connection: connection.outstanding_count())
+        return None
+
+    def _open(self, host):
+        debug_log("open a persistent connection to " + host)
+        connection = HTTPConnection(self, host)
+        self.connections[host].append(connection)
+        connection.transport = create_connection(lambda: connection, host,
+                                                 loop=self.loop, engine=self.engine)
+        return connection
+
+    # a connection has answered all its requests
+    def connection_available(self, connection):
+        if not connection.reusable:
+            connection.close()
+            return
+        waiting = self.waiting.get(connection.host)
+        if waiting:
+            connection.send_request(waiting.popleft())
+            # the requests sent ahead when pipelining
+            while self.pipelining and waiting and \
+                    connection.outstanding_count() < self.pipeline_depth:
+                connection.send_request(waiting.popleft())
+            return
+        connection.idle_timer = self.loop.call_later(self.idle_timeout, self._evict, connection)
+
+    def _evict(self, connection):
+        connection.idle_timer = None
+        debug_log("close an idle connection to " + connection.host)
+        connection.close()
+
+    def connection_closed(self, connection, exc):
+        connections = self.connections.get(connection.host, [])
+        if connection in connections:
+            connections.remove(connection)
+        # the requests still waiting for a response, the server may have closed
+        # a kept alive connection just before they arrived
+        # a response which has partly arrived cannot be requested again, its body
+        # may already have been streamed
+        partial = connection.parser.response is not None
+        for index, request in enumerate(connection.requests):
+            if request.retries < MAX_REQUEST_RETRIES and connection.connected \
+                    and not (index == 0 and partial):
+                request.retries += 1
+                self._dispatch(request)
+            else:
+                error_log("failed to get the response of " + request.url + ": " + str(exc))
+                request.callback(None)
+        connection.requests.clear()
+        waiting = self.waiting.get(connection.host)
+        while waiting and len(connections) < self.max_per_host:
+            self._open(connection.host).send_request(waiting.popleft())
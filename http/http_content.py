@@ -8,9 +8,10 @@ SPACE = " "
 HEADER_END_MARK = CRLF * 2
 
 
-def build_http_content(url):
+# headers is a list of (name, value) pairs added after the host header
+def build_http_content(url, method="GET", headers=None, version="HTTP/1.0"):
     host, path = _parse_host_path(url)
-    http_data = _build_first_line(path) + CRLF + _build_http_header_lines(host) + CRLF
+    http_data = _build_first_line(path, method, version) + CRLF + _build_http_header_lines(host, headers) + CRLF
     return host, http_data
 
 
@@ -19,12 +20,13 @@ def _build_first_line(path, method="GET", version="HTTP/1.0"):
     return first_line
 
 
-def _build_http_header_lines(host):
+def _build_http_header_lines(host, headers=None):
     header_content = ""
     header_content += ("Host: " + host)
     header_content += CRLF
-    # header_content += "Connection: keep-alive"
-    # header_content += CRLF
+    for name, value in headers or ():
+        header_content += (name + ": " + value)
+        header_content += CRLF
     return header_content
 
 
@@ -56,3 +58,20 @@ def parse_http_response(http_response):
     except:
         error_log("fail to parse due to the invalid http response format!")
         sys.exit(-1)
+
+
+# parse the status line and the header lines of a response, header names are
+# lowercased, return (None, None) if the format is invalid
+def parse_http_header(header_data):
+    lines = header_data.split(CRLF)
+    first_line = lines[0].split(SPACE)
+    if len(first_line) < 2 or not first_line[0].startswith("HTTP/"):
+        error_log("invalid status line of the http response: " + lines[0])
+        return None, None
+    headers = {}
+    for line in lines[1:]:
+        if line.find(":") == -1:
+            continue
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    return first_line[1], headers
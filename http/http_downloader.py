@@ -0,0 +1,188 @@
+import time
+import socket
+from collections import deque, OrderedDict
+from http_content import _parse_host_path
+from http_connection_pool import ConnectionPool
+from event_loop import get_event_loop
+from dns_resolver import get_resolver
+from packet_engine import get_packet_engine
+from socket_logger import debug_log, error_log
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PER_HOST = 4
+# seconds to wait for the pooled connections to be closed at the end of a run
+CLOSE_TIMEOUT = 1.0
+
+
+class DownloadResult:
+    def __init__(self, url, host):
+        '''
+        url         : the url to download
+        host        : the host part of the url
+        status_code : status code of the response, None if the download failed
+        body        : body of the response, None if the download failed
+        size        : length of the body, kept when the body is released
+        output      : the file the body is streamed into, if any
+        start_time  : when the connection was opened
+        end_time    : when the response was complete or the download failed
+        '''
+        self.url = url
+        self.host = host
+        self.status_code = None
+        self.body = None
+        self.size = 0
+        self.output = None
+        self.start_time = None
+        self.end_time = None
+
+    def succeeded(self):
+        return self.status_code == "200"
+
+    def elapsed(self):
+        return self.end_time - self.start_time
+
+
+class Downloader:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST,
+                 pipelining=False, loop=None, engine=None, on_result=None, open_output=None):
+        '''
+        downloads many urls concurrently in one event loop, all connections share
+        one packet engine so the interface and the gateway are only looked up once,
+        and the urls of one host reuse the kept alive connections of a pool
+
+        concurrency : maximum number of requests in flight at the same time
+        per_host    : maximum number of connections open to the same host
+        pipelining  : send several requests ahead on each connection
+        on_result   : called with each DownloadResult once it is done
+        open_output : if set, called with a DownloadResult whose response is 200 and
+                      returns the file its body is streamed into
+        pending     : queued results of each host, hosts are served round robin
+        active      : number of open connections of each host
+        results     : all results in the order the urls were added
+        elapsed     : wall clock time of the last run
+        '''
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.pipelining = pipelining
+        self.pool = None
+        self.loop = loop if loop is not None else get_event_loop()
+        self.engine = engine
+        self.on_result = on_result
+        self.open_output = open_output
+        self.pending = OrderedDict()
+        self.active = {}
+        self.active_count = 0
+        self.done_count = 0
+        self.results = []
+        self.elapsed = 0
+
+    def add(self, url):
+        host, _ = _parse_host_path(url)
+        result = DownloadResult(url, host)
+        self.results.append(result)
+        self.pending.setdefault(host, deque()).append(result)
+        return result
+
+    # download all added urls and return their results
+    def run(self):
+        if self.engine is None:
+            self.engine = get_packet_engine()
+        self.pool = ConnectionPool(self.per_host, pipelining=self.pipelining,
+                                   loop=self.loop, engine=self.engine)
+        start_time = time.time()
+        # look all hosts up at the same time instead of one by one as they are connected
+        get_resolver().prefetch(self.pending.keys())
+        self._start_downloads()
+        self.loop.run_until(lambda: self.done_count == len(self.results))
+        self.elapsed = time.time() - start_time
+        # tear the kept alive connections down, without waiting long for slow servers
+        self.pool.close()
+        close_deadline = self.loop.time() + CLOSE_TIMEOUT
+        self.loop.run_until(lambda: self.pool.open_count() == 0
+                            or self.loop.time() > close_deadline)
+        return self.results
+
+    def _start_downloads(self):
+        while self.active_count < self.concurrency:
+            result = self._next_pending()
+            if result is None:
+                return
+            self._start(result)
+
+    # take the next url of the first host below its limit, and move the host to
+    # the back so that one host with many urls cannot starve the others
+    def _next_pending(self):
+        # pipelined requests wait on the connections of the pool instead of here
+        host_limit = self.per_host * (self.pool.pipeline_depth if self.pipelining else 1)
+        for host in self.pending.keys():
+            if self.active.get(host, 0) >= host_limit:
+                continue
+            results = self.pending.pop(host)
+            result = results.popleft()
+            if results:
+                self.pending[host] = results
+            return result
+        return None
+
+    def _start(self, result):
+        self.active[result.host] = self.active.get(result.host, 0) + 1
+        self.active_count += 1
+        result.start_time = time.time()
+        debug_log("start downloading " + result.url)
+        try:
+            if self.open_output is None:
+                self.pool.get(result.url, lambda response: self._on_response(result, response))
+            else:
+                self.pool.get(result.url, lambda response: self._on_response(result, response),
+                              lambda response: self._on_header(result, response),
+                              lambda data: self._on_body(result, data))
+        except (socket.error, IOError), e:
+            error_log("failed to connect for " + result.url + ": " + str(e))
+            self._finish(result, None, None)
+
+    def _on_header(self, result, response):
+        if response.status_code == "200":
+            result.output = self.open_output(result)
+
+    def _on_body(self, result, data):
+        if result.output is not None:
+            result.output.write(data)
+
+    def _on_response(self, result, response):
+        if response is None:
+            self._finish(result, None, None)
+        else:
+            self._finish(result, response.status_code, response.body)
+
+    def _finish(self, result, status_code, body):
+        result.end_time = time.time()
+        result.status_code = status_code
+        result.body = body
+        result.size = len(body) if body is not None else 0
+        if result.output is not None:
+            result.size = result.output.tell()
+            result.output.close()
+            result.output = None
+        self.active[result.host] -= 1
+        self.active_count -= 1
+        self.done_count += 1
+        if self.on_result is not None:
+            self.on_result(result)
+        # callbacks run inside the event loop, open the next connections after them
+        self.loop.call_later(0, self._start_downloads)
+
+
+# print the throughput of a run and the timings of each url
+def print_summary(results, elapsed, out):
+    succeeded = [result for result in results if result.succeeded()]
+    total_bytes = sum(result.size for result in succeeded)
+    for result in results:
+        if result.succeeded():
+            out.write("%8.3fs %10d  %s\n" % (result.elapsed(), result.size, result.url))
+        else:
+            out.write("%8.3fs %10s  %s\n" % (result.elapsed(), "FAILED " + str(result.status_code),
+                                             result.url))
+    rate = total_bytes / elapsed if elapsed > 0 else 0
+    out.write("%d of %d urls downloaded, %d bytes in %.3fs, %.1f KB/s, %.1f urls/s\n"
+              % (len(succeeded), len(results), total_bytes, elapsed, rate / 1024,
+                 len(results) / elapsed if elapsed > 0 else 0))
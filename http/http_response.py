@@ -0,0 +1,353 @@
+import os
+from collections import deque
+from http_content import CRLF, HEADER_END_MARK, parse_http_header
+from intervals import IntervalSet
+from mapped_file import MappedFile
+from socket_logger import debug_log, error_log
+
+# parser states
+HEADER = "HEADER"
+BODY_LENGTH = "BODY_LENGTH"
+CHUNK_SIZE = "CHUNK_SIZE"
+CHUNK_DATA = "CHUNK_DATA"
+CHUNK_DATA_END = "CHUNK_DATA_END"
+CHUNK_TRAILER = "CHUNK_TRAILER"
+BODY_UNTIL_CLOSE = "BODY_UNTIL_CLOSE"
+# a header longer than this is treated as an invalid response
+MAX_HEADER_LENGTH = 64 * 1024
+# a streamed body is handed out in pieces of this size
+BODY_CHUNK_SIZE = 64 * 1024
+
+
+class HTTPResponse:
+    def __init__(self, version, status_code, headers):
+        '''
+        version     : http version of the response, like HTTP/1.1
+        status_code : status code of the response
+        headers     : the headers of the response, names are lowercased
+        body        : the body without chunked framing, empty if it was streamed
+        body_length : number of body bytes received
+        keep_alive  : whether the connection can be used for another request
+        '''
+        self.version = version
+        self.status_code = status_code
+        self.headers = headers
+        self.body = ""
+        self.body_length = 0
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            self.keep_alive = connection == "keep-alive"
+        else:
+            self.keep_alive = connection != "close"
+
+
+class HTTPResponseParser:
+    def __init__(self, chunk_size=BODY_CHUNK_SIZE):
+        '''
+        splits the data of a connection into responses using content-length or
+        chunked framing, so that the connection can be kept open
+
+        the header of a response is parsed as soon as it has arrived, the body is
+        either collected into the response or streamed to the body handler of its
+        request in pieces of chunk_size, so that memory does not grow with the body
+
+        expected   : (method, header_handler, body_handler) of the requests still
+                     waiting for a response, in order
+        buffer     : an incomplete header or chunk line, never body data
+        response   : the response being parsed
+        body_data  : body bytes not handed out yet
+        remaining  : bytes left of the body or of the current chunk
+        error      : set once the data cannot be parsed
+        '''
+        self.chunk_size = chunk_size
+        self.expected = deque()
+        self.buffer = ""
+        self.state = HEADER
+        self.response = None
+        self.header_handler = None
+        self.body_handler = None
+        self.body_data = bytearray()
+        self.body_chunks = []
+        self.remaining = 0
+        self.error = False
+
+    # a request has been sent, its response follows the ones expected before,
+    # header_handler is called with the response once its header is parsed and
+    # body_handler with each piece of its body
+    def expect(self, method, header_handler=None, body_handler=None):
+        self.expected.append((method, header_handler, body_handler))
+
+    def pending_count(self):
+        return len(self.expected)
+
+    # parse the received data and return the responses it completed
+    def feed(self, data):
+        responses = []
+        if self.buffer:
+            data = self.buffer + data
+            self.buffer = ""
+        position = 0
+        while position < len(data) and not self.error:
+            next_position = self._parse_step(data, position, responses)
+            if next_position is None:
+                # keep the incomplete header or line for the next data
+                self.buffer = data[position:]
+                break
+            position = next_position
+        return responses
+
+    # the connection has been closed, return the response delimited by the close
+    # or None if the last response is incomplete
+    def finish(self):
+        if self.state == BODY_UNTIL_CLOSE:
+            return self._complete()
+        return None
+
+    # parse from position as far as the current state allows, return the position
+    # after the parsed data or None if more data is needed
+    def _parse_step(self, data, position, responses):
+        if self.state == HEADER:
+            header_end = data.find(HEADER_END_MARK, position)
+            if header_end == -1:
+                if len(data) - position > MAX_HEADER_LENGTH:
+                    self._fail("the header of the response is too long")
+                return None
+            self._start_response(data[position:header_end], responses)
+            return header_end + len(HEADER_END_MARK)
+        if self.state == BODY_LENGTH or self.state == CHUNK_DATA:
+            end = min(len(data), position + self.remaining)
+            self._add_body(data[position:end])
+            self.remaining -= end - position
+            if self.remaining == 0:
+                if self.state == BODY_LENGTH:
+                    responses.append(self._complete())
+                else:
+                    self.state = CHUNK_DATA_END
+            return end
+        if self.state == BODY_UNTIL_CLOSE:
+            self._add_body(data[position:] if position else data)
+            return len(data)
+        line_end = data.find(CRLF, position)
+        if line_end == -1:
+            return None
+        self._parse_chunk_line(data[position:line_end], responses)
+        return line_end + len(CRLF)
+
+    def _start_response(self, header_data, responses):
+        status_code, headers = parse_http_header(header_data)
+        if status_code is None:
+            self._fail("invalid header of the response")
+            return
+        # informational responses come before the real response of the request
+        if status_code.startswith("1"):
+            return
+        if self.expected:
+            method, self.header_handler, self.body_handler = self.expected.popleft()
+        else:
+            method, self.header_handler, self.body_handler = "GET", None, None
+        self.response = HTTPResponse(header_data[:header_data.find(" ")], status_code, headers)
+        if self.header_handler is not None:
+            self.header_handler(self.response)
+        if method == "HEAD" or status_code in ("204", "304"):
+            responses.append(self._complete())
+        elif headers.get("transfer-encoding", "").lower().find("chunked") != -1:
+            self.state = CHUNK_SIZE
+        elif "content-length" in headers:
+            try:
+                self.remaining = int(headers["content-length"])
+            except ValueError:
+                self._fail("invalid content-length of the response")
+                return
+            self.state = BODY_LENGTH
+            if self.remaining == 0:
+                responses.append(self._complete())
+        else:
+            # the server closes the connection after the body
+            self.response.keep_alive = False
+            self.state = BODY_UNTIL_CLOSE
+
+    def _parse_chunk_line(self, line, responses):
+        if self.state == CHUNK_SIZE:
+            try:
+                # chunk extensions follow a semicolon
+                self.remaining = int(line.split(";")[0].strip(), 16)
+            except ValueError:
+                self._fail("invalid chunk size of the response")
+                return
+            self.state = CHUNK_DATA if self.remaining != 0 else CHUNK_TRAILER
+        elif self.state == CHUNK_DATA_END:
+            if line != "":
+                self._fail("missing line end after a chunk of the response")
+                return
+            self.state = CHUNK_SIZE
+        elif line == "":
+            # an empty line ends the trailer and the response
+            responses.append(self._complete())
+
+    def _add_body(self, data):
+        self.response.body_length += len(data)
+        if self.body_handler is None:
+            self.body_chunks.append(data)
+            return
+        self.body_data += data
+        if len(self.body_data) >= self.chunk_size:
+            self._flush_body()
+
+    def _flush_body(self):
+        while len(self.body_data) >= self.chunk_size:
+            self.body_handler(str(self.body_data[:self.chunk_size]))
+            del self.body_data[:self.chunk_size]
+
+    def _complete(self):
+        response = self.response
+        if self.body_handler is not None:
+            self._flush_body()
+            if self.body_data:
+                self.body_handler(str(self.body_data))
+                self.body_data = bytearray()
+        else:
+            response.body = "".join(self.body_chunks)
+        self.response = None
+        self.header_handler = None
+        self.body_handler = None
+        self.body_chunks = []
+        self.state = HEADER
+        return response
+
+    def _fail(self, message):
+        error_log(message)
+        self.error = True
+
+
+class ResponsePlacer:
+    def __init__(self, file_name, header_handler=None):
+        '''
+        writes the body of a response into file_name from the payload of a tcp stream,
+        given in order or not with its offset from the first byte of the response
+
+        when the length of the body is known the file is preallocated and mapped, and
+        each payload is copied straight to its offset in it, only the received ranges
+        are tracked, otherwise the body is parsed in order and streamed to the file
+
+        received    : ranges of the stream received so far
+        position    : how much of the stream has been consumed in order
+        pending     : payload after a gap, waiting to be consumed in order, by offset
+        header_data : the start of the stream until the header has been found
+        body_start  : stream offset of the first byte of the body
+        output      : the mapped file, once the length of the body is known
+        parser      : parses the body in order if its length is not known
+        '''
+        self.file_name = file_name
+        self.header_handler = header_handler
+        self.received = IntervalSet()
+        self.position = 0
+        self.pending = {}
+        self.header_data = ""
+        self.response = None
+        self.body_start = None
+        self.output = None
+        self.parser = None
+        self.stream_file = None
+        self.responses = []
+
+    def place(self, offset, data):
+        end = offset + len(data)
+        if self.output is not None:
+            self.output.write_at(offset - self.body_start, data)
+            self.received.add(offset, end)
+            return
+        if end <= self.position:
+            return
+        if offset < self.position:
+            data = data[self.position - offset:]
+            offset = self.position
+        self.received.add(offset, end)
+        if offset not in self.pending or len(self.pending[offset]) < len(data):
+            self.pending[offset] = data
+        self._consume_pending()
+
+    # length of the stream received without a gap
+    def contiguous_length(self):
+        return self.received.contiguous_from(0)
+
+    # the stream has ended, return the response or None if it is incomplete
+    def finish(self):
+        if self.output is not None:
+            complete = self.output.is_complete()
+            self.output.close()
+            return self.response if complete else None
+        if self.parser is None:
+            return None
+        response = self.parser.finish()
+        if response is not None:
+            self.responses.append(response)
+        self.stream_file.close()
+        return self.responses[0] if self.responses else None
+
+    # remove the file of an incomplete response, the preallocated file has its final
+    # size and could be taken for a complete one
+    def discard(self):
+        if self.output is not None or self.stream_file is not None:
+            os.remove(self.file_name)
+
+    def _consume_pending(self):
+        while self.pending and self.output is None:
+            data = self.pending.pop(self.position, None)
+            if data is None:
+                # a retransmission may have been cut at other boundaries, the
+                # pieces which overlap the position go on from the position
+                overlapping = [offset for offset in self.pending if offset < self.position]
+                if not overlapping:
+                    return
+                for offset in overlapping:
+                    data = self.pending.pop(offset)
+                    if offset + len(data) > self.position and self.position not in self.pending:
+                        self.pending[self.position] = data[self.position - offset:]
+                continue
+            self.position += len(data)
+            self._consume(data)
+
+    def _consume(self, data):
+        if self.parser is not None:
+            self.responses.extend(self.parser.feed(data))
+            return
+        self.header_data += data
+        header_end = self.header_data.find(HEADER_END_MARK)
+        if header_end == -1:
+            if len(self.header_data) > MAX_HEADER_LENGTH:
+                error_log("the header of the response is too long")
+                self.header_data = ""
+            return
+        status_code, headers = parse_http_header(self.header_data[:header_end])
+        if status_code is None:
+            error_log("invalid header of the response")
+            return
+        self.response = HTTPResponse(self.header_data[:self.header_data.find(" ")], status_code,
+                                     headers)
+        if self.header_handler is not None:
+            self.header_handler(self.response)
+        self.body_start = header_end + len(HEADER_END_MARK)
+        if headers.get("transfer-encoding", "").lower().find("chunked") == -1 \
+                and headers.get("content-length", "").isdigit():
+            self._map_output(int(headers["content-length"]))
+        else:
+            self._stream_output()
+
+    # the body length is known, everything from now on goes to its offset in the file
+    def _map_output(self, size):
+        debug_log("place the body of %d bytes into %s" % (size, self.file_name))
+        self.response.body_length = size
+        self.output = MappedFile(self.file_name, size)
+        self.output.write_at(0, self.header_data[self.body_start:])
+        self.header_data = ""
+        for offset, data in self.pending.items():
+            self.output.write_at(offset - self.body_start, data)
+        self.pending.clear()
+
+    def _stream_output(self):
+        self.stream_file = open(self.file_name, "wb")
+        self.parser = HTTPResponseParser()
+        self.parser.expect("GET", body_handler=self.stream_file.write)
+        header_data = self.header_data
+        self.header_data = ""
+        self.responses.extend(self.parser.feed(header_data))
@@ -0,0 +1,69 @@
+from bisect import bisect_left, bisect_right
+
+
+class IntervalSet:
+    def __init__(self):
+        '''
+        a set of half-open [start, end) ranges kept sorted and merged, used to
+        track which parts of a stream or a file have been received
+
+        starts : start of each range, in increasing order
+        ends   : end of each range, ends[i] < starts[i + 1]
+        '''
+        self.starts = []
+        self.ends = []
+
+    # add [start, end) and merge it with the ranges it overlaps or touches
+    def add(self, start, end):
+        if end <= start:
+            return
+        first, last = self.span(start, end)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    # the indexes [first, last) of the ranges which [start, end) overlaps or touches,
+    # first == last if it touches none, then a range for it would be inserted at first
+    def span(self, start, end):
+        # the first range ending at or after start, and the first starting after end
+        return bisect_left(self.ends, start), bisect_right(self.starts, end)
+
+    # remove the first range and return it as (start, end)
+    def pop_first(self):
+        return self.starts.pop(0), self.ends.pop(0)
+
+    # length of the range starting at offset, 0 if offset has not been received
+    def contiguous_from(self, offset=0):
+        index = bisect_right(self.starts, offset) - 1
+        if index < 0 or self.ends[index] <= offset:
+            return 0
+        return self.ends[index] - offset
+
+    def contains(self, start, end):
+        index = bisect_right(self.starts, start) - 1
+        return index >= 0 and self.ends[index] >= end
+
+    # the missing [start, end) ranges between offset and limit
+    def gaps(self, offset, limit):
+        missing = []
+        index = max(0, bisect_right(self.starts, offset) - 1)
+        position = offset
+        while position < limit and index < len(self.starts):
+            if self.ends[index] <= position:
+                index += 1
+                continue
+            if self.starts[index] > position:
+                missing.append((position, min(self.starts[index], limit)))
+            position = max(position, self.ends[index])
+            index += 1
+        if position < limit:
+            missing.append((position, limit))
+        return missing
+
+    def ranges(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
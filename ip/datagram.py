@@ -2,90 +2,73 @@ import socket
 from struct import *
 from utils import get_random_number, calculate_checksum
 from socket_logger import error_log
-from ctypes import create_string_buffer
 
 # packer format
 PACKER_FORMAT = "!BBHHHBBH4s4s"
+IP_HEADER = Struct(PACKER_FORMAT)
+HEADER_LENGTH = IP_HEADER.size
+# the checksum is NOT in network byte order
+CHECKSUM_OFFSET = 10
 
 # transform the full datagram string to an IPDatagram object
 def dissemble(full_datagram):
-    ip_datagram = IPDatagram()
-    ip_header = unpack(PACKER_FORMAT, full_datagram[0:20])
-    version_ihl = ip_header[0]
+    (version_ihl, type_of_service, total_length, datagram_id, flags_fragment_offset, ttl,
+     protocol, header_checksum, src_addr, dest_addr) = IP_HEADER.unpack_from(full_datagram)
+    ihl = version_ihl & 0xF
+    header_length = ihl * 4
+    # if the checksum field is correct, the sum over the header, options included,
+    # should be 0
+    if calculate_checksum(full_datagram[0: header_length]) != 0:
+        error_log("wrong ip datagram checksum!")
+        return None
+
+    # very important! remove the ethernet padding at the frame end
+    ip_datagram = IPDatagram(socket.inet_ntoa(src_addr), socket.inet_ntoa(dest_addr),
+                             full_datagram[header_length: total_length], datagram_id)
     ip_datagram.version = version_ihl >> 4
-    ip_datagram.ihl = version_ihl & 0xF
-    ip_datagram.type_of_service = ip_header[1]
-    ip_datagram.total_length = ip_header[2]
-    ip_datagram.id = ip_header[3]
-    flags_fragment_offset = ip_header[4]
+    ip_datagram.ihl = ihl
+    ip_datagram.type_of_service = type_of_service
+    ip_datagram.total_length = total_length
     flags = flags_fragment_offset >> 13
     ip_datagram.flag_reserved = (flags & 0b100) >> 2
     ip_datagram.flag_df = (flags & 0b010) >> 1
     ip_datagram.flag_mf = flags & 0b001
     ip_datagram.fragment_offset = flags_fragment_offset & 0x1fff
-    ip_datagram.ttl = ip_header[5]
-    ip_datagram.protocol = ip_header[6]
-    ip_datagram.header_checksum = ip_header[7]
-    src_addr = ip_header[8]
-    ip_datagram.src_ip = socket.inet_ntoa(src_addr)
-    dest_addr = ip_header[9]
-    ip_datagram.dest_ip = socket.inet_ntoa(dest_addr)
-
-    # very important! remove the ethernet padding at the frame end
-    data_len = ip_datagram.total_length - ip_datagram.ihl * 4
-    ip_datagram.data = full_datagram[ip_datagram.ihl * 4: ip_datagram.ihl * 4 + data_len]
-
-    # calculate the checksum
-    tmp_ip_header = _assemble_ip_header(ip_datagram, src_addr, dest_addr, version_ihl, flags_fragment_offset)
-    # if the checksum field is correct, the result of calculation should be 0
-    result = calculate_checksum(tmp_ip_header)
-    if result != 0:
-        error_log("wrong ip datagram checksum!")
-        return None
-
+    ip_datagram.ttl = ttl
+    ip_datagram.protocol = protocol
+    ip_datagram.header_checksum = header_checksum
     return ip_datagram
 
 
 # transform the IPDatagram object to a string, which will then be sent by the ip socket
 def assemble(ip_datagram):
-    src_addr = socket.inet_aton(ip_datagram.src_ip)
-    dest_addr = socket.inet_aton(ip_datagram.dest_ip)
     version_ihl = (ip_datagram.version << 4) + ip_datagram.ihl
     flags_fragment_offset = (ip_datagram.flag_reserved << 15) \
                             + (ip_datagram.flag_df << 14) \
                             + (ip_datagram.flag_mf << 13) \
                             + ip_datagram.fragment_offset
-    # get a temporary header without checksum
-    tmp_ip_header = _assemble_ip_header(ip_datagram, src_addr, dest_addr, version_ihl, flags_fragment_offset)
-    # calculate the checksum of IP header and place the result in the checksum field
-    real_checksum = calculate_checksum(tmp_ip_header)
+    # pack the header with a zero checksum, whatever is left in header_checksum, and
+    # place the checksum of it in the checksum field
+    ip_header = bytearray(HEADER_LENGTH)
+    IP_HEADER.pack_into(ip_header, 0,
+                        version_ihl,
+                        ip_datagram.type_of_service,
+                        ip_datagram.total_length,
+                        ip_datagram.id,
+                        flags_fragment_offset,
+                        ip_datagram.ttl,
+                        ip_datagram.protocol,
+                        0,
+                        socket.inet_aton(ip_datagram.src_ip),
+                        socket.inet_aton(ip_datagram.dest_ip))
+    real_checksum = calculate_checksum(ip_header)
     ip_datagram.header_checksum = real_checksum
-    ip_header = _assemble_ip_header(ip_datagram, src_addr, dest_addr, version_ihl, flags_fragment_offset, True)
-    return ip_header + ip_datagram.data
-
-
-def _assemble_ip_header(ip_datagram, src_addr, dest_addr, version_ihl, flags_fragment_offset, final_checksum=False):
-    ip_header_buf = create_string_buffer(calcsize(PACKER_FORMAT))
-    pack_into(PACKER_FORMAT,
-              ip_header_buf,
-              0,
-              version_ihl,
-              ip_datagram.type_of_service,
-              ip_datagram.total_length,
-              ip_datagram.id,
-              flags_fragment_offset,
-              ip_datagram.ttl,
-              ip_datagram.protocol,
-              ip_datagram.header_checksum,
-              src_addr,
-              dest_addr)
-    if final_checksum:
-        pack_into("H", ip_header_buf, calcsize(PACKER_FORMAT[:8]), ip_datagram.header_checksum)
-    return ip_header_buf.raw
+    pack_into("H", ip_header, CHECKSUM_OFFSET, real_checksum)
+    return str(ip_header) + ip_datagram.data
 
 
 class IPDatagram:
-    def __init__(self, src_ip="", dest_ip="", data=""):
+    def __init__(self, src_ip="", dest_ip="", data="", id=None):
         '''
         src_ip          : source ip address
         dest_ip         : destination ip address
@@ -94,7 +77,7 @@ class IPDatagram:
         ihl             : header length
         type of service : default is 0
         total_length    : total length of the datagram
-        id              : datagram id
+        id              : datagram id, a random one if it is not given
         flag_reserved   : default is 0
         flag_df         : do not fragment flag
         flag_mf         : more fragments flag
@@ -109,8 +92,8 @@ class IPDatagram:
         self.version = 4
         self.ihl = 5
         self.type_of_service = 0
-        self.total_length = calcsize(PACKER_FORMAT) + len(data)
-        self.id = get_random_number(0, 65535)
+        self.total_length = HEADER_LENGTH + len(data)
+        self.id = get_random_number(0, 65535) if id is None else id
         self.flag_reserved = 0
         self.flag_df = 1
         self.flag_mf = 0
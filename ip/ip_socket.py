@@ -1,38 +1,136 @@
 from raw_socket import RawSocket
 from datagram import IPDatagram, assemble, dissemble
 from socket_logger import debug_log, error_log
-from utils import timeout, TimeoutError, get_gateway_ip
+from utils import TimeoutError
+from network_context import get_network_context
 from ethernet.ethernet_socket import EthernetSocket
+from packet_encoder import FrameTemplate
+import packet_decoder
 import sys
 
 MAX_TIMEOUT = 180
 
 class IPSocket:
-    def __init__(self, src_ip, dest_ip):
+    def __init__(self, src_ip, dest_ip, zero_copy=False, rx_ring=False):
         self.src_ip = src_ip
         self.dest_ip = dest_ip
-        gateway_ip = get_gateway_ip()
-        self.eth_socket = EthernetSocket(src_ip, gateway_ip)
+        gateway_ip = get_network_context().gateway_ip
+        self.eth_socket = EthernetSocket(src_ip, gateway_ip, zero_copy, rx_ring)
+        self.event_loop = self.eth_socket.event_loop
+        # called with each received tcp segment once reading has started
+        self.segment_handler = None
 
     def send(self, data):
         ip_datagram = IPDatagram(self.src_ip, self.dest_ip, data)
         # pack the IP datagram in Ethernet Frame and use ethernet socket to send
         self.eth_socket.send(assemble(ip_datagram))
 
-    def receive(self):
+    # create the header template of a tcp connection, the macs, ips, ports,
+    # protocol and ttl are packed once and reused for every frame
+    def create_frame_template(self, src_port, dest_port):
+        return FrameTemplate(self.eth_socket.src_mac, self.eth_socket.dest_mac,
+                             self.src_ip, self.dest_ip, src_port, dest_port)
+
+    # filter the frames of a tcp connection between these ip addresses in the kernel
+    def allow_connection(self, src_port, dest_port):
+        self.eth_socket.allow_connection((self.src_ip, src_port, self.dest_ip, dest_port))
+
+    def disallow_connection(self, src_port, dest_port):
+        self.eth_socket.disallow_connection((self.src_ip, src_port, self.dest_ip, dest_port))
+
+    # send a frame assembled from a template
+    def send_frame(self, frame):
+        self.eth_socket.send_frame(frame)
+
+    # queue a frame assembled from a template, all queued frames are sent by flush
+    def queue_frame(self, frame):
+        self.eth_socket.queue_frame(frame)
+
+    def flush(self):
+        self.eth_socket.flush()
+
+    # receive the data of a datagram, raise TimeoutError if nothing is received
+    # before the deadline
+    def receive(self, deadline=None):
+        ip_datagram = self._receive_before(self._receive_datagram, deadline)
+        return ip_datagram.data
+
+    # receive a full frame which has not been decoded yet, so that the caller can
+    # decode all its headers in one pass
+    def receive_frame(self, deadline=None):
+        return self._receive_before(self.eth_socket.receive_frame, deadline)
+
+    # receive a frame and decode its ethernet, ip and tcp headers in one pass,
+    # return None if it does not carry a valid tcp segment
+    def receive_segment(self, deadline=None):
+        return packet_decoder.decode(self.receive_frame(deadline))
+
+    # return the next valid tcp segment which has already been received, or None
+    # if there is none, frames without a valid segment are skipped
+    def receive_segment_nowait(self):
+        while True:
+            frame = self.receive_frame_nowait()
+            if frame is None:
+                return None
+            segment = packet_decoder.decode(frame)
+            if segment is not None:
+                return segment
+            self.recycle()
+
+    # call the handler with every tcp segment between these ip addresses as soon
+    # as it arrives, the segments are handled in the event loop
+    def start_reading(self, handler):
+        self.segment_handler = handler
+        self.event_loop.add_reader(self.fileno(), self._on_readable)
+
+    def stop_reading(self):
+        self.event_loop.remove_reader(self.fileno())
+        self.segment_handler = None
+
+    def _on_readable(self):
+        while self.segment_handler is not None:
+            frame = self.receive_frame_nowait()
+            if frame is None:
+                break
+            segment = packet_decoder.decode(frame)
+            if segment is not None and segment.src_ip == self.dest_ip and segment.dest_ip == self.src_ip:
+                self.segment_handler(segment)
+            self.recycle()
+        # the segments queued by the handler go out together
+        self.flush()
+
+    # return None if no frame can be received without waiting
+    def receive_frame_nowait(self):
+        return self.eth_socket.receive_frame_nowait()
+
+    # the file descriptor to wait on in an event loop
+    def fileno(self):
+        return self.eth_socket.fileno()
+
+    def close(self):
+        self.eth_socket.close()
+
+    def _receive_before(self, receive_function, deadline):
+        # the connection is dead if nothing is received for MAX_TIMEOUT seconds
+        dead_deadline = self.event_loop.time() + MAX_TIMEOUT
+        if deadline is not None and deadline < dead_deadline:
+            return receive_function(deadline)
         try:
-            ip_datagram = self._receive_datagram()
-            return ip_datagram.data
+            return receive_function(dead_deadline)
         except TimeoutError:
             error_log("no datagram received for a long time, dead connection!")
             sys.exit(-1)
 
-    @timeout(MAX_TIMEOUT, "timeout happens when ip receives datagram")
-    def _receive_datagram(self):
+    def _receive_datagram(self, deadline):
         while True:
-            ip_datagram = dissemble(self.eth_socket.receive())
+            ip_datagram = dissemble(self.eth_socket.receive(deadline=deadline))
             if ip_datagram is not None:
                 debug_log(
                    "receive datagram from " + ip_datagram.src_ip + " to " + ip_datagram.dest_ip)
                 if ip_datagram.src_ip == self.dest_ip and ip_datagram.dest_ip == self.src_ip:
                     return ip_datagram
+            self.eth_socket.recycle()
+
+    # the data returned by receive must not be used after recycling it in zero-copy mode
+    def recycle(self):
+        self.eth_socket.recycle()
@@ -1,12 +1,12 @@
 import sys
-from http.http_client import do_get
+import argparse
+from http.http_client import do_get_to_file, do_get_segmented, DEFAULT_MIN_RANGE_SIZE
+from http.http_downloader import Downloader, print_summary, DEFAULT_CONCURRENCY, DEFAULT_PER_HOST
 
 DEFAULT_FILE_NAME = "index.html"
 
-if __name__ == "__main__":
-    url = sys.argv[1]
-    response_data = do_get(url)
 
+def get_file_name(url):
     # remove the http prefix
     if url.find("http://") != -1:
         url = url[(len("http://")):]
@@ -14,9 +14,73 @@ if __name__ == "__main__":
     # if the url do not contain path or it ends with /, use the
     # default file name
     if url.find("/") == -1 or url.endswith("/"):
-        file_name = DEFAULT_FILE_NAME
-    else:
-        file_name = url[url.rfind("/") + 1 :]
+        return DEFAULT_FILE_NAME
+    return url[url.rfind("/") + 1:]
+
+
+def download_one(url, connections=1, min_range_size=DEFAULT_MIN_RANGE_SIZE):
+    # fetch byte ranges of the file over parallel connections
+    if connections > 1:
+        return do_get_segmented(url, get_file_name(url), connections, min_range_size)
+    # the body is written as it arrives instead of being held in memory
+    do_get_to_file(url, get_file_name(url))
+    return True
+
+
+# download the urls listed one per line in url_file concurrently
+def download_many(url_file, concurrency, per_host, pipelining=False):
+    used_names = set()
 
-    with open(file_name, "w+") as f:
-        f.write(response_data)
+    # the body of each url is streamed into its own file
+    def open_output(result):
+        # urls with the same file name are saved as name.1, name.2, ...
+        file_name = get_file_name(result.url)
+        unique_name = file_name
+        suffix = 1
+        while unique_name in used_names:
+            unique_name = file_name + "." + str(suffix)
+            suffix += 1
+        used_names.add(unique_name)
+        return open(unique_name, "wb")
+
+    downloader = Downloader(concurrency, per_host, pipelining, open_output=open_output)
+    for line in url_file:
+        url = line.strip()
+        if url and not url.startswith("#"):
+            downloader.add(url)
+    results = downloader.run()
+    print_summary(results, downloader.elapsed, sys.stdout)
+    return all(result.succeeded() for result in results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="download files over raw sockets")
+    parser.add_argument("url", nargs="?", help="the url to download")
+    parser.add_argument("-i", "--input", metavar="FILE",
+                        help="download the urls listed in FILE concurrently, - for stdin")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="maximum number of concurrent connections")
+    parser.add_argument("-p", "--per-host", type=int, default=DEFAULT_PER_HOST,
+                        help="maximum number of concurrent connections to one host")
+    parser.add_argument("-P", "--pipeline", action="store_true",
+                        help="pipeline the requests to the same host")
+    parser.add_argument("-n", "--connections", type=int, default=1,
+                        help="download a single url over this many connections with range requests")
+    parser.add_argument("-m", "--min-range-size", type=int, default=DEFAULT_MIN_RANGE_SIZE,
+                        help="smallest byte range fetched by one connection")
+    args = parser.parse_args()
+
+    if args.input is None:
+        if args.url is None:
+            parser.error("either a url or an input file is required")
+        if not download_one(args.url, args.connections, args.min_range_size):
+            sys.exit(-1)
+    else:
+        if args.input == "-":
+            succeeded = download_many(sys.stdin, args.concurrency, args.per_host, args.pipeline)
+        else:
+            with open(args.input) as url_file:
+                succeeded = download_many(url_file, args.concurrency, args.per_host,
+                                          args.pipeline)
+        if not succeeded:
+            sys.exit(-1)
@@ -0,0 +1,75 @@
+import os
+import mmap
+import ctypes
+from intervals import IntervalSet
+from socket_logger import debug_log, error_log
+
+
+def _load_posix_fallocate():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        posix_fallocate = libc.posix_fallocate64
+    except (OSError, AttributeError):
+        return None
+    posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    posix_fallocate.restype = ctypes.c_int
+    return posix_fallocate
+
+
+# None if the platform does not provide posix_fallocate, the file is only extended then
+_posix_fallocate = _load_posix_fallocate()
+
+
+class MappedFile:
+    def __init__(self, file_name, size):
+        '''
+        an output file of a known size, preallocated and mapped into memory so that
+        data can be written at any offset without buffering it first
+
+        size     : final size of the file
+        received : the ranges of the file which have been written
+        '''
+        self.file_name = file_name
+        self.size = size
+        self.received = IntervalSet()
+        self.file = open(file_name, "w+b")
+        self._preallocate()
+        # a zero-length file cannot be mapped
+        self.map = mmap.mmap(self.file.fileno(), size) if size > 0 else None
+
+    def _preallocate(self):
+        if self.size == 0:
+            return
+        # reserve the blocks now so that the download does not fail on a full disk
+        # halfway, and the file is not fragmented by the out-of-order writes
+        if _posix_fallocate is not None:
+            result = _posix_fallocate(self.file.fileno(), 0, self.size)
+            if result == 0:
+                return
+            debug_log("posix_fallocate failed: " + os.strerror(result))
+        self.file.truncate(self.size)
+
+    # copy data to its place in the file, data beyond the size is dropped
+    def write_at(self, offset, data):
+        end = min(offset + len(data), self.size)
+        if end <= offset:
+            return
+        if offset < 0:
+            data = data[-offset:]
+            offset = 0
+        self.map[offset:end] = data[:end - offset]
+        self.received.add(offset, end)
+
+    # number of bytes written from the start of the file without a gap
+    def contiguous_length(self):
+        return self.received.contiguous_from(0)
+
+    def is_complete(self):
+        return self.size == 0 or self.received.contains(0, self.size)
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.close()
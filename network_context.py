@@ -0,0 +1,118 @@
+import errno
+import socket
+import time
+from utils import get_default_iface, get_gateway_ip, get_local_ip, get_local_mac
+from ethernet.arp_cache import ArpCache
+from socket_logger import debug_log
+
+# netlink family and multicast groups of the link, ipv4 address and ipv4 route
+# changes, see linux/rtnetlink.h
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+# without netlink the route table is read again at most this often
+ROUTE_CHECK_INTERVAL = 1.0
+
+_network_context = None
+
+
+# the network context shared by all sockets of the process, it is looked up again
+# once the links, addresses or routes have changed
+def get_network_context():
+    global _network_context
+    if _network_context is None:
+        _network_context = NetworkContext()
+    else:
+        _network_context.check_routes()
+    return _network_context
+
+
+# replace the network context of the process, e.g. by a fixed one for a simulated
+# link, and return the one it replaces
+def set_network_context(network_context):
+    global _network_context
+    previous, _network_context = _network_context, network_context
+    return previous
+
+
+class NetworkContext:
+    def __init__(self, device=None, local_ip=None, local_mac=None, gateway_ip=None):
+        '''
+        the default interface, its addresses and the gateway, looked up once for all
+        connections instead of once per connection, or given if device is given
+
+        device        : name of the interface of the default route
+        local_ip      : ip address of the device
+        local_mac     : hardware address of the device
+        gateway_ip    : ip address of the default gateway
+        arp_cache     : macs of the neighbours on the device, see ethernet.arp_cache
+        route_monitor : netlink socket which receives a message when a link, an address
+                        or a route changes, None if netlink cannot be used
+        last_check    : when the route table was read, if there is no route monitor
+        fixed         : the values have been given and are never looked up
+        '''
+        self.fixed = device is not None
+        self.arp_cache = None
+        if self.fixed:
+            self.route_monitor = None
+            self.device = device
+            self.local_ip = local_ip
+            self.local_mac = local_mac
+            self.gateway_ip = gateway_ip
+            self.arp_cache = ArpCache(device, local_ip, local_mac)
+            self.last_check = time.time()
+        else:
+            self.route_monitor = _open_route_monitor()
+            self._resolve()
+
+    # look the network up again if the routes have changed since the last call
+    def check_routes(self):
+        if self.fixed:
+            return
+        if self.route_monitor is not None:
+            changed = self._drain_route_monitor()
+        else:
+            if time.time() - self.last_check < ROUTE_CHECK_INTERVAL:
+                return
+            self.last_check = time.time()
+            changed = (get_default_iface(), get_gateway_ip()) != (self.device, self.gateway_ip)
+        if changed:
+            debug_log("the routes have changed, look up the network again")
+            self._resolve()
+
+    def _resolve(self):
+        self.device = get_default_iface()
+        self.gateway_ip = get_gateway_ip()
+        self.local_ip = get_local_ip(self.device)
+        self.local_mac = get_local_mac(self.device)
+        # the neighbours may be different ones behind the new routes
+        if self.arp_cache is not None:
+            self.arp_cache.clear()
+        self.arp_cache = ArpCache(self.device, self.local_ip, self.local_mac)
+        self.last_check = time.time()
+
+    # return True if a change has been announced, the messages are not parsed, any
+    # of them makes the cached values suspect
+    def _drain_route_monitor(self):
+        changed = False
+        while True:
+            try:
+                self.route_monitor.recv(65536, socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                # ENOBUFS, messages have been lost
+                return True
+            changed = True
+
+
+def _open_route_monitor():
+    try:
+        monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        monitor.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+    except (socket.error, AttributeError), e:
+        debug_log("cannot watch the routes with netlink, reading the route table instead: "
+                  + str(e))
+        return None
+    return monitor
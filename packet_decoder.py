@@ -0,0 +1,202 @@
+import socket
+from struct import Struct, pack, unpack_from
+from checksum import partial_sum, finish_checksum
+from ethernet import ethernet_frame
+from ip import datagram
+from tcp import segment
+
+# Ethernet + IPv4 + TCP headers without options, the fields which are rarely
+# read (MAC addresses, TOS, id, TTL, checksums, urgent pointer) are skipped
+# and only decoded on access, tcp options follow it
+FRAME_HEADER = Struct("!12xHBxH2xHxB2x4s4sHHLLBBH4x")
+FRAME_HEADER_LENGTH = FRAME_HEADER.size
+# only the type, version, protocol, addresses and ports, used to find the
+# connection of a frame before decoding it
+CONNECTION_HEADER = Struct("!12xHB8xB2x4s4sHH")
+ETHERNET_HEADER_LENGTH = ethernet_frame.HEADER_LENGTH
+IP_HEADER_OFFSET = ETHERNET_HEADER_LENGTH
+TCP_HEADER_OFFSET = IP_HEADER_OFFSET + 20
+PTYPE_IPV4 = 0x0800
+# version 4 with a header length of 5 words
+VERSION_IHL_NO_OPTIONS = 0x45
+# data offset of 5 words in the high nibble
+DATA_OFFSET_NO_OPTIONS = 0x50
+# fragment offset and more fragments flag
+FRAGMENT_MASK = 0x3fff
+
+
+# decode a full Ethernet frame into a TCP segment, the fused decoder is used
+# for frames without IP options, other frames fall back to the dissemble
+# functions of each layer
+# return None if the frame does not carry a valid TCP segment
+def decode(frame):
+    packet = decode_fast(frame)
+    if packet is None:
+        packet = decode_layered(frame)
+    return packet
+
+
+# return the (src_addr, dest_addr, src_port, dest_port) of a frame with a
+# 20-byte ip header without verifying it, or None for any other frame
+def peek_connection(frame):
+    if len(frame) < FRAME_HEADER_LENGTH:
+        return None
+    type_num, version_ihl, protocol, src_addr, dest_addr, src_port, dest_port = \
+        CONNECTION_HEADER.unpack_from(frame)
+    if type_num != PTYPE_IPV4 or version_ihl != VERSION_IHL_NO_OPTIONS \
+            or protocol != socket.IPPROTO_TCP:
+        return None
+    return src_addr, dest_addr, src_port, dest_port
+
+
+# single pass decoder for the common 14 + 20 + 20 byte header
+# return None if the frame cannot be handled by the fast path, the caller
+# should fall back to decode_layered in that case
+def decode_fast(frame):
+    if len(frame) < FRAME_HEADER_LENGTH:
+        return None
+    (type_num, version_ihl, total_length, flags_fragment_offset, protocol, src_addr,
+     dest_addr, src_port, dest_port, seq_num, ack_num, offset_reserved, flags,
+     window_size) = FRAME_HEADER.unpack_from(frame)
+    if type_num != PTYPE_IPV4 or version_ihl != VERSION_IHL_NO_OPTIONS \
+            or protocol != socket.IPPROTO_TCP or flags_fragment_offset & FRAGMENT_MASK \
+            or offset_reserved & 0xf0 < DATA_OFFSET_NO_OPTIONS:
+        return None
+    # very important! remove the ethernet padding at the frame end
+    frame_end = IP_HEADER_OFFSET + total_length
+    data_offset = offset_reserved >> 4
+    data_start = TCP_HEADER_OFFSET + data_offset * 4
+    if frame_end > len(frame) or frame_end < data_start:
+        return None
+    # checksum a view on the frame so that slicing it does not copy the payload
+    view = frame if isinstance(frame, memoryview) else memoryview(frame)
+    # the sum over a header with a correct checksum field should be 0
+    if finish_checksum(partial_sum(view[IP_HEADER_OFFSET: TCP_HEADER_OFFSET])) != 0:
+        return None
+    tcp_length = frame_end - TCP_HEADER_OFFSET
+    pseudo_header_sum = partial_sum(pack("!4s4sBBH", src_addr, dest_addr, 0, protocol, tcp_length))
+    if finish_checksum(partial_sum(view[TCP_HEADER_OFFSET: frame_end], pseudo_header_sum)) != 0:
+        return None
+    return PacketView(frame, src_addr, dest_addr, src_port, dest_port, seq_num, ack_num,
+                      flags, window_size, frame[data_start: frame_end], data_offset)
+
+
+# decode the frame layer by layer with the dissemble functions
+def decode_layered(frame):
+    recv_frame = ethernet_frame.dissemble(frame)
+    if recv_frame.type_num != PTYPE_IPV4:
+        return None
+    ip_datagram = datagram.dissemble(recv_frame.data)
+    if ip_datagram is None or ip_datagram.protocol != socket.IPPROTO_TCP:
+        return None
+    tcp_segment = segment.dissemble(ip_datagram.data, ip_datagram.src_ip, ip_datagram.dest_ip)
+    if tcp_segment is None:
+        return None
+    tcp_segment.src_ip = ip_datagram.src_ip
+    tcp_segment.dest_ip = ip_datagram.dest_ip
+    return tcp_segment
+
+
+class PacketView(object):
+    __slots__ = ("frame", "src_addr", "dest_addr", "src_port", "dest_port", "seq_num",
+                 "ack_num", "flags", "window_size", "data", "data_offset")
+
+    def __init__(self, frame, src_addr, dest_addr, src_port, dest_port, seq_num, ack_num,
+                 flags, window_size, data, data_offset=5):
+        '''
+        a read-only view of a received TCP segment, it has the same fields as a
+        dissembled TCPSegment
+
+        frame       : the full Ethernet frame
+        src_addr    : packed source ip address
+        dest_addr   : packed destination ip address
+        flags       : the flags byte of the TCP header
+        data_offset : size of the TCP header in 32 bit words, the options are
+                      decoded on access
+        '''
+        self.frame = frame
+        self.src_addr = src_addr
+        self.dest_addr = dest_addr
+        self.src_port = src_port
+        self.dest_port = dest_port
+        self.seq_num = seq_num
+        self.ack_num = ack_num
+        self.flags = flags
+        self.window_size = window_size
+        self.data = data
+        self.data_offset = data_offset
+
+    @property
+    def fin(self):
+        return self.flags & 0b00000001
+
+    @property
+    def syn(self):
+        return (self.flags & 0b00000010) >> 1
+
+    @property
+    def rst(self):
+        return (self.flags & 0b00000100) >> 2
+
+    @property
+    def psh(self):
+        return (self.flags & 0b00001000) >> 3
+
+    @property
+    def ack(self):
+        return (self.flags & 0b00010000) >> 4
+
+    @property
+    def urg(self):
+        return (self.flags & 0b00100000) >> 5
+
+    @property
+    def src_ip(self):
+        return socket.inet_ntoa(self.src_addr)
+
+    @property
+    def dest_ip(self):
+        return socket.inet_ntoa(self.dest_addr)
+
+    @property
+    def src_mac(self):
+        return unpack_from("!6s", self.frame, 6)[0]
+
+    @property
+    def dest_mac(self):
+        return unpack_from("!6s", self.frame, 0)[0]
+
+    @property
+    def type_of_service(self):
+        return unpack_from("!B", self.frame, IP_HEADER_OFFSET + 1)[0]
+
+    @property
+    def id(self):
+        return unpack_from("!H", self.frame, IP_HEADER_OFFSET + 4)[0]
+
+    @property
+    def ttl(self):
+        return unpack_from("!B", self.frame, IP_HEADER_OFFSET + 8)[0]
+
+    @property
+    def header_checksum(self):
+        return unpack_from("H", self.frame, IP_HEADER_OFFSET + 10)[0]
+
+    @property
+    def reserved(self):
+        return unpack_from("!B", self.frame, TCP_HEADER_OFFSET + 12)[0] & 0x0f
+
+    @property
+    def checksum(self):
+        return unpack_from("H", self.frame, TCP_HEADER_OFFSET + 16)[0]
+
+    @property
+    def urgent_pointer(self):
+        return unpack_from("!H", self.frame, TCP_HEADER_OFFSET + 18)[0]
+
+    @property
+    def options(self):
+        if self.data_offset == 5:
+            return []
+        return segment.decode_options(
+            self.frame[FRAME_HEADER_LENGTH: TCP_HEADER_OFFSET + self.data_offset * 4])
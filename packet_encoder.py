@@ -0,0 +1,90 @@
+import socket
+from struct import Struct, pack, pack_into
+from checksum import partial_sum, finish_checksum
+from utils import get_random_number
+from tcp import segment
+
+# Ethernet + IPv4 + TCP headers without options, see packet_decoder
+FRAME_HEADER = Struct("!6s6sHBBHHHBBH4s4sHHLLBBHHH")
+FRAME_HEADER_LENGTH = FRAME_HEADER.size
+IP_HEADER_OFFSET = 14
+TCP_HEADER_OFFSET = IP_HEADER_OFFSET + 20
+PTYPE_IPV4 = 0x0800
+VERSION_IHL_NO_OPTIONS = 0x45
+DATA_OFFSET_NO_OPTIONS = 0x50
+# do not fragment flag
+FLAG_DF = 0x4000
+DEFAULT_TTL = 255
+
+# the fields which change from one segment to another
+IP_LENGTH_ID = Struct("!HH")
+IP_LENGTH_ID_OFFSET = IP_HEADER_OFFSET + 2
+IP_CHECKSUM_OFFSET = IP_HEADER_OFFSET + 10
+TCP_VARIABLE_FIELDS = Struct("!LLBBH")
+TCP_VARIABLE_FIELDS_OFFSET = TCP_HEADER_OFFSET + 4
+TCP_CHECKSUM_OFFSET = TCP_HEADER_OFFSET + 16
+
+
+class FrameTemplate:
+    def __init__(self, src_mac, dest_mac, src_ip, dest_ip, src_port, dest_port, ttl=DEFAULT_TTL):
+        '''
+        a complete Ethernet + IP + TCP header for one connection, the fields which
+        never change are packed and summed once, assemble only patches the rest
+
+        header          : the reusable header buffer
+        ip_id           : id of the next ip datagram
+        ip_partial_sum  : checksum sum of the constant ip header fields
+        tcp_partial_sum : checksum sum of the pseudo header and the constant tcp header fields
+        '''
+        self.header = bytearray(FRAME_HEADER_LENGTH)
+        src_addr = socket.inet_aton(src_ip)
+        dest_addr = socket.inet_aton(dest_ip)
+        FRAME_HEADER.pack_into(self.header, 0, dest_mac, src_mac, PTYPE_IPV4,
+                               VERSION_IHL_NO_OPTIONS, 0, 0, 0, FLAG_DF, ttl, socket.IPPROTO_TCP, 0,
+                               src_addr, dest_addr, src_port, dest_port, 0, 0,
+                               DATA_OFFSET_NO_OPTIONS, 0, 0, 0, 0)
+        self.ip_id = get_random_number(0, 65535)
+        # the length, id and checksum fields are still 0 in the template
+        self.ip_partial_sum = partial_sum(memoryview(self.header)[IP_HEADER_OFFSET: TCP_HEADER_OFFSET])
+        # the pseudo header without the tcp length, plus the ports
+        self.tcp_partial_sum = partial_sum(pack("!4s4sBBHH", src_addr, dest_addr, 0,
+                                                socket.IPPROTO_TCP, src_port, dest_port))
+        self._tcp_variable_view = memoryview(self.header)[
+            TCP_VARIABLE_FIELDS_OFFSET: TCP_VARIABLE_FIELDS_OFFSET + TCP_VARIABLE_FIELDS.size]
+
+    # patch the fields of the tcp segment into the template and return the full frame
+    def assemble(self, tcp_segment):
+        data = tcp_segment.data
+        flags = tcp_segment.fin + (tcp_segment.syn << 1) + (tcp_segment.rst << 2) + (
+            tcp_segment.psh << 3) + (tcp_segment.ack << 4) + (tcp_segment.urg << 5)
+        return self.assemble_fields(tcp_segment.seq_num, tcp_segment.ack_num, flags,
+                                    tcp_segment.window_size, data,
+                                    segment.encode_options(tcp_segment.options))
+
+    # options are the packed options field, see segment.encode_options
+    def assemble_fields(self, seq_num, ack_num, flags, window_size, data, options=""):
+        header = self.header
+        tcp_length = 20 + len(options) + len(data)
+        ip_id = self.ip_id
+        self.ip_id = (ip_id + 1) & 0xffff
+
+        # ip header, only the total length, id and checksum change
+        IP_LENGTH_ID.pack_into(header, IP_LENGTH_ID_OFFSET, tcp_length + 20, ip_id)
+        ip_sum = partial_sum(pack("!HH", tcp_length + 20, ip_id), self.ip_partial_sum)
+        # the checksum is NOT in network byte order, like in datagram.assemble
+        pack_into("H", header, IP_CHECKSUM_OFFSET, finish_checksum(ip_sum))
+
+        # tcp header, ports, urgent pointer and the pseudo header are constant
+        # the options are a multiple of 4 bytes long, so the data offset grows by whole words
+        TCP_VARIABLE_FIELDS.pack_into(header, TCP_VARIABLE_FIELDS_OFFSET, seq_num, ack_num,
+                                      DATA_OFFSET_NO_OPTIONS + (len(options) << 2), flags,
+                                      window_size)
+        tcp_sum = partial_sum(pack("!H", tcp_length), self.tcp_partial_sum)
+        tcp_sum = partial_sum(self._tcp_variable_view, tcp_sum)
+        if options:
+            tcp_sum = partial_sum(options, tcp_sum)
+        tcp_sum = partial_sum(data, tcp_sum)
+        pack_into("H", header, TCP_CHECKSUM_OFFSET, finish_checksum(tcp_sum))
+        if options:
+            return str(header) + options + data
+        return str(header) + data
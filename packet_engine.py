@@ -0,0 +1,201 @@
+import sys
+import socket
+from collections import deque
+from ethernet.ethernet_socket import EthernetSocket
+from ip.datagram import IPDatagram, assemble
+from ip.ip_socket import MAX_TIMEOUT
+from packet_encoder import FrameTemplate
+from utils import TimeoutError
+from network_context import get_network_context
+from socket_logger import debug_log, error_log
+import packet_decoder
+
+# one engine per network interface
+_engines = {}
+
+
+# the engine of the default interface, shared by all connections of the process,
+# rx_ring is only chosen by the call which creates it, None takes the engine as it is
+# and a later call asking for another rx_ring raises ValueError
+def get_packet_engine(rx_ring=None):
+    device = get_network_context().device
+    engine = _engines.get(device)
+    if engine is None:
+        engine = PacketEngine(rx_ring=bool(rx_ring))
+        _engines[device] = engine
+    elif rx_ring is not None and bool(rx_ring) != engine.rx_ring:
+        raise ValueError("the packet engine of " + device + " has already been created "
+                         + ("with" if engine.rx_ring else "without") + " an rx ring")
+    return engine
+
+
+class PacketEngine:
+    def __init__(self, src_ip=None, rx_ring=False):
+        '''
+        owns the raw socket of an interface, decodes each frame once and dispatches
+        the tcp segments to the channel of their connection
+
+        src_ip        : local ip address
+        rx_ring       : whether the frames are received through a packet rx ring
+        eth_socket    : the ethernet socket shared by all connections
+        channels      : channels keyed by (remote address, remote port, local port)
+        dropped_count : frames which belong to no registered connection
+        '''
+        network_context = get_network_context()
+        self.src_ip = src_ip if src_ip is not None else network_context.local_ip
+        self.src_addr = socket.inet_aton(self.src_ip)
+        self.rx_ring = rx_ring
+        self.eth_socket = EthernetSocket(self.src_ip, network_context.gateway_ip, rx_ring=rx_ring)
+        self.event_loop = self.eth_socket.event_loop
+        self.channels = {}
+        self.dropped_count = 0
+        self.reading = False
+
+    # a channel carries the segments of one connection to the given ip address
+    def open_channel(self, dest_ip):
+        return EngineChannel(self, dest_ip)
+
+    def register(self, channel, src_port, dest_port):
+        self.channels[(channel.dest_addr, dest_port, src_port)] = channel
+        self.eth_socket.allow_connection((self.src_ip, src_port, channel.dest_ip, dest_port))
+        if not self.reading:
+            self.event_loop.add_reader(self.eth_socket.fileno(), self._on_readable)
+            self.reading = True
+
+    def unregister(self, channel, src_port, dest_port):
+        if self.channels.pop((channel.dest_addr, dest_port, src_port), None) is None:
+            return
+        self.eth_socket.disallow_connection((self.src_ip, src_port, channel.dest_ip, dest_port))
+        if not self.channels and self.reading:
+            self.event_loop.remove_reader(self.eth_socket.fileno())
+            self.reading = False
+
+    def _on_readable(self):
+        channels = self.channels
+        while True:
+            frame = self.eth_socket.receive_frame_nowait()
+            if frame is None:
+                break
+            connection = packet_decoder.peek_connection(frame)
+            if connection is not None:
+                src_addr, dest_addr, src_port, dest_port = connection
+                channel = channels.get((src_addr, src_port, dest_port))
+                # drop the frames of unknown connections before decoding them
+                if channel is None or dest_addr != self.src_addr:
+                    self.dropped_count += 1
+                    continue
+                segment = packet_decoder.decode(frame)
+            else:
+                segment = packet_decoder.decode(frame)
+                channel = None
+                if segment is not None and segment.dest_ip == self.src_ip:
+                    channel = channels.get((socket.inet_aton(segment.src_ip), segment.src_port,
+                                            segment.dest_port))
+            if segment is None or channel is None:
+                self.dropped_count += 1
+                continue
+            channel.dispatch(segment)
+        # the segments queued while dispatching go out together
+        self.eth_socket.flush()
+
+
+class EngineChannel:
+    def __init__(self, engine, dest_ip):
+        '''
+        stands in for an IPSocket of one connection on a shared packet engine
+
+        segment_queue   : received segments, when no handler is set
+        segment_handler : called with each received segment once reading has started
+        ports           : (src_port, dest_port) of the registered connection
+        '''
+        self.engine = engine
+        self.src_ip = engine.src_ip
+        self.dest_ip = dest_ip
+        self.dest_addr = socket.inet_aton(dest_ip)
+        self.event_loop = engine.event_loop
+        self.segment_queue = deque()
+        self.segment_handler = None
+        self.ports = None
+
+    def allow_connection(self, src_port, dest_port):
+        self.ports = (src_port, dest_port)
+        self.engine.register(self, src_port, dest_port)
+
+    def disallow_connection(self, src_port, dest_port):
+        self.engine.unregister(self, src_port, dest_port)
+
+    def create_frame_template(self, src_port, dest_port):
+        eth_socket = self.engine.eth_socket
+        return FrameTemplate(eth_socket.src_mac, eth_socket.dest_mac,
+                             self.src_ip, self.dest_ip, src_port, dest_port)
+
+    def send(self, data):
+        self.engine.eth_socket.send(assemble(IPDatagram(self.src_ip, self.dest_ip, data)))
+
+    def send_frame(self, frame):
+        self.engine.eth_socket.send_frame(frame)
+
+    def queue_frame(self, frame):
+        self.engine.eth_socket.queue_frame(frame)
+
+    def flush(self):
+        self.engine.eth_socket.flush()
+
+    def dispatch(self, segment):
+        if self.segment_handler is not None:
+            self.segment_handler(segment)
+        else:
+            self.segment_queue.append(segment)
+
+    # wait in the event loop for the next segment of this connection
+    def receive_segment(self, deadline=None):
+        # the connection is dead if nothing is received for MAX_TIMEOUT seconds
+        dead_deadline = self.event_loop.time() + MAX_TIMEOUT
+        if deadline is not None and deadline < dead_deadline:
+            if not self._wait_for_segment(deadline):
+                raise TimeoutError("timeout happens when receiving a segment")
+        elif not self._wait_for_segment(dead_deadline):
+            error_log("no datagram received for a long time, dead connection!")
+            sys.exit(-1)
+        return self.segment_queue.popleft()
+
+    # return a segment of this connection which has already been received, or None
+    def receive_segment_nowait(self):
+        if self.segment_queue:
+            return self.segment_queue.popleft()
+        return None
+
+    def _wait_for_segment(self, deadline):
+        state = {"expired": False}
+
+        def on_expired():
+            state["expired"] = True
+
+        timer = self.event_loop.call_at(deadline, on_expired)
+        try:
+            while not self.segment_queue and not state["expired"]:
+                # queued frames must not wait while this connection waits
+                self.flush()
+                self.event_loop.run_once()
+        finally:
+            timer.cancel()
+        return len(self.segment_queue) != 0
+
+    def start_reading(self, handler):
+        self.segment_handler = handler
+        # hand over what has been received before
+        while self.segment_queue and self.segment_handler is not None:
+            handler(self.segment_queue.popleft())
+
+    def stop_reading(self):
+        self.segment_handler = None
+
+    # the engine does not receive in zero-copy mode, nothing to recycle
+    def recycle(self):
+        pass
+
+    def close(self):
+        if self.ports is not None:
+            self.engine.unregister(self, self.ports[0], self.ports[1])
+            self.ports = None
+        self.segment_queue.clear()
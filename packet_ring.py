@@ -0,0 +1,104 @@
+import mmap
+from struct import Struct, pack_into, unpack_from
+from socket_logger import debug_log
+
+# constants from linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_BLOCK_COUNT = 8
+DEFAULT_FRAME_SIZE = 2048
+# milliseconds after which the kernel hands over a block which is not full
+DEFAULT_BLOCK_TIMEOUT = 10
+
+# struct tpacket_req3: block size, block count, frame size, frame count,
+# retire block timeout, private size, feature request word
+TPACKET_REQ3 = Struct("=IIIIIII")
+# struct tpacket_block_desc: version, private offset, then the tpacket_hdr_v1
+# fields block status, number of packets and offset to the first packet
+BLOCK_DESC = Struct("=IIIII")
+BLOCK_STATUS_OFFSET = 8
+# struct tpacket3_hdr: next offset, sec, nsec, snap length, length, status,
+# mac offset, network offset
+PACKET_HEADER = Struct("=IIIIIIHH")
+
+
+class PacketRxRing:
+    def __init__(self, raw_socket, block_size=DEFAULT_BLOCK_SIZE, block_count=DEFAULT_BLOCK_COUNT,
+                 frame_size=DEFAULT_FRAME_SIZE, block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        '''
+        a TPACKET_V3 receive ring shared with the kernel, frames are read out of
+        the mapped memory one block at a time
+
+        raw_socket    : the bound AF_PACKET socket
+        block_size    : size of a block, should be a multiple of the page size
+        block_count   : number of blocks in the ring
+        frame_size    : the minimal frame slot size the kernel checks against
+        block_timeout : milliseconds after which a partly filled block is handed over
+        current_block : index of the next block to read
+        '''
+        self.raw_socket = raw_socket
+        self.block_size = block_size
+        self.block_count = block_count
+        raw_socket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        frame_count = block_size / frame_size * block_count
+        raw_socket.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                              TPACKET_REQ3.pack(block_size, block_count, frame_size, frame_count,
+                                                block_timeout, 0, 0))
+        self.ring = mmap.mmap(raw_socket.fileno(), block_size * block_count,
+                              mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.current_block = 0
+        # frames of the block which are not returned by receive yet
+        self.pending_frames = []
+
+    # return the next frame, or None if no frame is ready, the socket becomes
+    # readable when the kernel hands over a block
+    def receive(self):
+        while not self.pending_frames:
+            frames = self._read_block()
+            if frames is None:
+                return None
+            # keep the frames in reverse order so that popping them is cheap
+            frames.reverse()
+            self.pending_frames = frames
+        return self.pending_frames.pop()
+
+    # return all frames of the next block, or None if no block is ready
+    def receive_batch(self):
+        if self.pending_frames:
+            frames = self.pending_frames[::-1]
+            self.pending_frames = []
+            return frames
+        return self._read_block()
+
+    # copy all frames out of the current block and give it back to the kernel
+    # return None if the kernel has not handed it over yet
+    def _read_block(self):
+        block_offset = self.current_block * self.block_size
+        if not self._block_status(block_offset) & TP_STATUS_USER:
+            return None
+        ring = self.ring
+        packet_count, packet_offset = BLOCK_DESC.unpack_from(ring, block_offset)[3:5]
+        packet_offset += block_offset
+        frames = []
+        for i in range(packet_count):
+            next_offset, sec, nsec, snap_length, length, status, mac_offset, net_offset = \
+                PACKET_HEADER.unpack_from(ring, packet_offset)
+            frame_start = packet_offset + mac_offset
+            frames.append(ring[frame_start: frame_start + snap_length])
+            packet_offset += next_offset
+        pack_into("=I", ring, block_offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+        self.current_block = (self.current_block + 1) % self.block_count
+        debug_log("read " + str(packet_count) + " frames from the rx ring")
+        return frames
+
+    def _block_status(self, block_offset):
+        return unpack_from("=I", self.ring, block_offset + BLOCK_STATUS_OFFSET)[0]
+
+    def close(self):
+        self.ring.close()
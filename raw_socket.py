@@ -1,22 +1,246 @@
 import sys
+import errno
+import ctypes
 from utils import *
 from socket_logger import *
+from event_loop import get_event_loop
+import bpf
+from packet_ring import PacketRxRing, DEFAULT_BLOCK_SIZE, DEFAULT_BLOCK_COUNT, DEFAULT_BLOCK_TIMEOUT
+
+# flush the queued frames automatically when this many are waiting
+MAX_BATCH_SIZE = 64
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+# None if the platform does not provide sendmmsg, frames are sent one by one then
+_sendmmsg = _load_sendmmsg()
+
+# link backends which stand in for the raw socket of a device, see register_link
+_links = {}
+
+
+# open the link of a device, a raw AF_PACKET socket unless a backend has been
+# registered for the device
+def open_link(device, buffer_pool=None, event_loop=None):
+    factory = _links.get(device)
+    if factory is not None:
+        return factory(buffer_pool, event_loop)
+    return RawSocket(device, buffer_pool, event_loop)
+
+
+# let factory(buffer_pool, event_loop) open the links of device instead of a raw
+# socket, e.g. a simulated link, it has the interface of RawSocket, None removes it
+def register_link(device, factory):
+    if factory is None:
+        _links.pop(device, None)
+    else:
+        _links[device] = factory
 
 
 class RawSocket:
-    def __init__(self, device):
+    def __init__(self, device, buffer_pool=None, event_loop=None):
         try:
             self.raw_socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
             # the defalut device will be eth0
             self.device = device
             self.raw_socket.bind((device, socket.SOCK_RAW))
         except socket.error, msg:
-            print 'Socket could not be created. Error Code : ' + str(
-                msg[0]) + ' Message ' + msg[1]
+            error_log('Socket could not be created. Error Code : ' + str(
+                msg[0]) + ' Message ' + msg[1])
             sys.exit()
+        # waiting for frames is done in the event loop instead of a blocking recvfrom
+        self.event_loop = event_loop if event_loop is not None else get_event_loop()
+        # in zero-copy mode frames are received into the buffers of the pool,
+        # and stay valid until they are recycled
+        self.buffer_pool = buffer_pool
+        self.leased_buffers = []
+        # frames waiting to be sent in one batch
+        self.send_queue = []
+        # frames are read out of a memory-mapped ring once it is enabled
+        self.rx_ring = None
+        # the kernel only passes the frames of these connections, and arp frames
+        # if allowed, once a filter is attached
+        self.filtered_connections = set()
+        self.arp_allowed = False
+
+    # let the segments of a (local_ip, local_port, remote_ip, remote_port) connection through
+    def allow_connection(self, connection):
+        self.filtered_connections.add(connection)
+        self._update_filter()
+
+    def disallow_connection(self, connection):
+        self.filtered_connections.discard(connection)
+        self._update_filter()
+
+    def allow_arp(self, allowed=True):
+        self.arp_allowed = allowed
+        self._update_filter()
+
+    # regenerate the socket filter and swap it in
+    def _update_filter(self):
+        program = bpf.build_filter(self.filtered_connections, self.arp_allowed)
+        try:
+            bpf.attach_filter(self.raw_socket, program)
+        except socket.error, msg:
+            # the frames are still filtered in python
+            error_log("failed to attach the socket filter: " + str(msg))
+
+    # receive frames through a TPACKET_V3 ring instead of one recvfrom per frame,
+    # block_timeout is in milliseconds
+    def enable_rx_ring(self, block_size=DEFAULT_BLOCK_SIZE, block_count=DEFAULT_BLOCK_COUNT,
+                       block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        self.rx_ring = PacketRxRing(self.raw_socket, block_size, block_count,
+                                    block_timeout=block_timeout)
 
     def send(self, data):
+        # keep the order of the frames which are still queued
+        if self.send_queue:
+            self.send_queue.append(data)
+            self.flush()
+            return
         self.raw_socket.send(data)
 
-    def receive(self, buffer_size=65536):
-        return self.raw_socket.recvfrom(buffer_size)[0]
+    # queue a frame, it is sent by the next flush
+    def queue(self, data):
+        self.send_queue.append(data)
+        if len(self.send_queue) >= MAX_BATCH_SIZE:
+            self.flush()
+
+    # send all queued frames, with a single sendmmsg call where available
+    def flush(self):
+        frames = self.send_queue
+        if not frames:
+            return
+        self.send_queue = []
+        sent_count = 0
+        if _sendmmsg is not None and len(frames) > 1:
+            sent_count = self._send_batch(frames)
+        # send the rest one by one if sendmmsg is missing or failed
+        for frame in frames[sent_count:]:
+            self.raw_socket.send(frame)
+
+    # return the number of frames sent
+    def _send_batch(self, frames):
+        frame_count = len(frames)
+        iovecs = (IOVec * frame_count)()
+        msgs = (MMsgHdr * frame_count)()
+        # keep a reference to every buffer until the call returns
+        buffers = [ctypes.c_char_p(frame) for frame in frames]
+        for i in range(frame_count):
+            iovecs[i].iov_base = ctypes.cast(buffers[i], ctypes.c_void_p)
+            iovecs[i].iov_len = len(frames[i])
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        sent_count = 0
+        while sent_count < frame_count:
+            result = _sendmmsg(self.raw_socket.fileno(),
+                               ctypes.cast(ctypes.byref(msgs, sent_count * ctypes.sizeof(MMsgHdr)),
+                                           ctypes.POINTER(MMsgHdr)),
+                               frame_count - sent_count, 0)
+            if result <= 0:
+                debug_log("sendmmsg failed with errno " + str(ctypes.get_errno()))
+                break
+            sent_count += result
+        return sent_count
+
+    # receive a frame, raise TimeoutError if none is received before the deadline
+    def receive(self, buffer_size=65536, deadline=None):
+        while True:
+            frame = self._receive_nowait(buffer_size)
+            if frame is not None:
+                return frame
+            self._wait_readable(deadline)
+
+    # iterate over batches of received frames, a batch holds the frames of one
+    # block of the rx ring, or a single frame when the ring is not enabled
+    def receive_batch(self, buffer_size=65536, deadline=None):
+        while True:
+            if self.rx_ring is not None:
+                frames = self.rx_ring.receive_batch()
+                if frames is None:
+                    self._wait_readable(deadline)
+                    continue
+                yield frames
+            else:
+                yield [self.receive(buffer_size, deadline)]
+
+    # return a frame if one can be received without waiting, None otherwise
+    def receive_nowait(self, buffer_size=65536):
+        return self._receive_nowait(buffer_size)
+
+    def fileno(self):
+        return self.raw_socket.fileno()
+
+    def close(self):
+        if self.rx_ring is not None:
+            self.rx_ring.close()
+        self.raw_socket.close()
+
+    def _wait_readable(self, deadline):
+        # queued frames must not wait while this socket waits, send them first
+        self.flush()
+        if not self.event_loop.wait_readable(self.raw_socket.fileno(), deadline):
+            raise TimeoutError("timeout happens when receiving a frame")
+
+    # return None if no frame can be received right away
+    def _receive_nowait(self, buffer_size):
+        if self.rx_ring is not None:
+            return self.rx_ring.receive()
+        try:
+            return self._receive(buffer_size, socket.MSG_DONTWAIT)
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return None
+
+    def _receive(self, buffer_size, flags=0):
+        if self.buffer_pool is None:
+            return self.raw_socket.recvfrom(buffer_size, flags)[0]
+        buf = self.buffer_pool.acquire()
+        try:
+            received_size = self.raw_socket.recv_into(buf, 0, flags)
+        except socket.error:
+            self.buffer_pool.release(buf)
+            raise
+        self.leased_buffers.append(buf)
+        # a view on the received bytes, slicing it further does not copy
+        return memoryview(buf)[:received_size]
+
+    # give all received buffers back to the pool, the frames returned by receive
+    # must not be used after calling it
+    def recycle(self):
+        if self.buffer_pool is None:
+            return
+        for buf in self.leased_buffers:
+            self.buffer_pool.release(buf)
+        del self.leased_buffers[:]
@@ -0,0 +1,297 @@
+import os
+import errno
+import socket
+import random
+from collections import deque
+from event_loop import get_event_loop
+from utils import TimeoutError
+from socket_logger import debug_log
+import packet_decoder
+
+# a reordered frame arrives this many seconds after the frames sent after it
+DEFAULT_REORDER_DELAY = 0.005
+
+
+class LinkProfile:
+    def __init__(self, delay=0.0, jitter=0.0, bandwidth=None, loss=0.0, reorder=0.0,
+                 duplicate=0.0, queue_limit=None, reorder_delay=DEFAULT_REORDER_DELAY):
+        '''
+        the impairments of one direction of a simulated link, like those of netem
+
+        delay         : one-way propagation delay in seconds
+        jitter        : a random delay of up to this many seconds is added to each frame,
+                        the frames keep their order
+        bandwidth     : bytes per second the link can carry, None for no limit
+        loss          : probability that a frame is dropped
+        reorder       : probability that a frame is held back by reorder_delay, so that
+                        the frames sent after it overtake it
+        duplicate     : probability that a frame is delivered twice
+        queue_limit   : bytes which may wait for the bandwidth, frames beyond it are
+                        dropped like at a full router queue, None for no limit
+        '''
+        self.delay = delay
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.queue_limit = queue_limit
+        self.reorder_delay = reorder_delay
+
+
+class LinkDirection:
+    def __init__(self, profile, rng, loop, deliver):
+        '''
+        carries the frames of one direction of a link, each frame is delivered by
+        a timer of the event loop once its transmission and delay are over
+
+        busy_until    : when the frames which are already queued have been transmitted
+        last_arrival  : arrival time of the last frame which was not reordered
+        deliver       : called with each frame which arrives
+        '''
+        self.profile = profile
+        self.rng = rng
+        self.loop = loop
+        self.deliver = deliver
+        self.busy_until = 0.0
+        self.last_arrival = 0.0
+        self.sent_count = 0
+        self.sent_bytes = 0
+        self.dropped_count = 0
+        self.duplicated_count = 0
+        self.reordered_count = 0
+
+    def transmit(self, frame):
+        profile = self.profile
+        now = self.loop.time()
+        self.sent_count += 1
+        self.sent_bytes += len(frame)
+        departure = now
+        if profile.bandwidth is not None:
+            start = max(now, self.busy_until)
+            if profile.queue_limit is not None and \
+                    (start - now) * profile.bandwidth + len(frame) > profile.queue_limit:
+                self.dropped_count += 1
+                return
+            departure = start + float(len(frame)) / profile.bandwidth
+            self.busy_until = departure
+        if profile.loss and self.rng.random() < profile.loss:
+            self.dropped_count += 1
+            return
+        arrival = departure + profile.delay
+        if profile.jitter:
+            arrival += self.rng.random() * profile.jitter
+        if profile.reorder and self.rng.random() < profile.reorder:
+            self.reordered_count += 1
+            arrival = max(arrival, self.last_arrival) + profile.reorder_delay
+        else:
+            arrival = max(arrival, self.last_arrival)
+            self.last_arrival = arrival
+        # even without any impairment the frame arrives on a timer, never while its
+        # sender is still running
+        self.loop.call_at(arrival, self.deliver, frame)
+        if profile.duplicate and self.rng.random() < profile.duplicate:
+            self.duplicated_count += 1
+            self.loop.call_at(arrival, self.deliver, frame)
+
+
+class SimulatedLink:
+    def __init__(self, device, to_peer=None, to_host=None, seed=0, loop=None):
+        '''
+        an in-memory link between the sockets of this host and a simulated peer, it
+        stands in for the raw socket of device, see raw_socket.register_link, the
+        impairments are drawn from a random generator seeded with seed, so that a
+        run can be repeated
+
+        to_peer  : LinkProfile of the frames sent by this host
+        to_host  : LinkProfile of the frames sent by the peer
+        peer     : receives the frames of this host by peer.receive_frame(frame),
+                   and sends its own with send_to_host
+        sockets  : the open SimulatedSockets, each one receives every frame which
+                   passes its filter, like raw sockets
+        '''
+        self.device = device
+        self.loop = loop if loop is not None else get_event_loop()
+        self.rng = random.Random(seed)
+        self.peer = None
+        self.sockets = []
+        self.uplink = LinkDirection(to_peer or LinkProfile(), self.rng, self.loop,
+                                    self._deliver_to_peer)
+        self.downlink = LinkDirection(to_host or LinkProfile(), self.rng, self.loop,
+                                      self._deliver_to_host)
+
+    def attach_peer(self, peer):
+        self.peer = peer
+
+    # open a socket of this host on the link, the signature of a link factory
+    def open_socket(self, buffer_pool=None, event_loop=None):
+        simulated_socket = SimulatedSocket(self, buffer_pool)
+        self.sockets.append(simulated_socket)
+        return simulated_socket
+
+    def send_from_host(self, frame):
+        self.uplink.transmit(frame)
+
+    def send_to_host(self, frame):
+        self.downlink.transmit(frame)
+
+    def _deliver_to_peer(self, frame):
+        if self.peer is not None:
+            self.peer.receive_frame(frame)
+
+    def _deliver_to_host(self, frame):
+        for simulated_socket in self.sockets:
+            simulated_socket.deliver(frame)
+
+
+class SimulatedSocket:
+    def __init__(self, link, buffer_pool=None):
+        '''
+        a socket on a simulated link with the interface of RawSocket, the received
+        frames wait in a queue and a pipe is readable while the queue is not empty,
+        so that the event loop can wait on it
+
+        received        : frames which have arrived and have not been received yet
+        filter_attached : the frames are filtered like by the socket filter of a raw
+                          socket, once a connection or arp has been allowed
+        '''
+        self.link = link
+        self.device = link.device
+        self.event_loop = link.loop
+        self.buffer_pool = buffer_pool
+        self.leased_buffers = []
+        self.send_queue = []
+        self.rx_ring = None
+        self.received = deque()
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            _set_nonblocking(fd)
+        self.filtered_connections = set()
+        self.arp_allowed = False
+        self.filter_attached = False
+        self.closed = False
+        self.dropped_count = 0
+
+    def allow_connection(self, connection):
+        self.filtered_connections.add(_packed_connection(connection))
+        self.filter_attached = True
+
+    def disallow_connection(self, connection):
+        self.filtered_connections.discard(_packed_connection(connection))
+
+    def allow_arp(self, allowed=True):
+        self.arp_allowed = allowed
+        self.filter_attached = True
+
+    # the frames are handed over one by one, there is no ring to map
+    def enable_rx_ring(self, *args, **kwargs):
+        debug_log("a simulated link has no rx ring, frames are received one by one")
+
+    def send(self, data):
+        if self.send_queue:
+            self.send_queue.append(data)
+            self.flush()
+            return
+        self.link.send_from_host(data)
+
+    # queue a frame, it is sent by the next flush
+    def queue(self, data):
+        self.send_queue.append(data)
+
+    def flush(self):
+        frames = self.send_queue
+        self.send_queue = []
+        for frame in frames:
+            self.link.send_from_host(frame)
+
+    # receive a frame, raise TimeoutError if none is received before the deadline
+    def receive(self, buffer_size=65536, deadline=None):
+        while True:
+            frame = self.receive_nowait(buffer_size)
+            if frame is not None:
+                return frame
+            # queued frames must not wait while this socket waits, send them first
+            self.flush()
+            if not self.event_loop.wait_readable(self.read_fd, deadline):
+                raise TimeoutError("timeout happens when receiving a frame")
+
+    # a batch always holds a single frame, there is no rx ring
+    def receive_batch(self, buffer_size=65536, deadline=None):
+        while True:
+            yield [self.receive(buffer_size, deadline)]
+
+    # return a frame if one can be received without waiting, None otherwise
+    def receive_nowait(self, buffer_size=65536):
+        if not self.received:
+            return None
+        frame = self.received.popleft()
+        if not self.received:
+            self._drain_pipe()
+        frame = frame[:buffer_size]
+        if self.buffer_pool is None:
+            return frame
+        buf = self.buffer_pool.acquire()
+        buf[:len(frame)] = frame
+        self.leased_buffers.append(buf)
+        return memoryview(buf)[:len(frame)]
+
+    def recycle(self):
+        if self.buffer_pool is None:
+            return
+        for buf in self.leased_buffers:
+            self.buffer_pool.release(buf)
+        del self.leased_buffers[:]
+
+    def fileno(self):
+        return self.read_fd
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.link.sockets.remove(self)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    # called by the link with each frame which arrives
+    def deliver(self, frame):
+        if not self._passes(frame):
+            return
+        if not self.received:
+            os.write(self.write_fd, "x")
+        self.received.append(frame)
+
+    # the rules of bpf.build_filter, applied in python
+    def _passes(self, frame):
+        if not self.filter_attached:
+            return True
+        if frame[12:14] == "\x08\x06":
+            return self.arp_allowed
+        connection = packet_decoder.peek_connection(frame)
+        if connection is None:
+            return False
+        src_addr, dest_addr, src_port, dest_port = connection
+        if (dest_addr, dest_port, src_addr, src_port) in self.filtered_connections:
+            return True
+        self.dropped_count += 1
+        return False
+
+    def _drain_pipe(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+# (local_ip, local_port, remote_ip, remote_port) with packed addresses
+def _packed_connection(connection):
+    local_ip, local_port, remote_ip, remote_port = connection
+    return socket.inet_aton(local_ip), local_port, socket.inet_aton(remote_ip), remote_port
+
+
+def _set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
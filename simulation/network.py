@@ -0,0 +1,52 @@
+from raw_socket import register_link
+from network_context import NetworkContext, set_network_context
+from dns_resolver import Resolver, StubUpstream, set_resolver
+from link import SimulatedLink
+from peer import ScriptedPeer
+
+HOST_IP = "10.0.0.1"
+HOST_MAC = "\x02\x00\x00\x00\x00\x01"
+GATEWAY_IP = "10.0.0.254"
+GATEWAY_MAC = "\x02\x00\x00\x00\x00\xfe"
+SERVER_IP = "10.0.1.1"
+SERVER_HOST = "sim.example"
+
+_network_count = 0
+
+
+class SimulatedNetwork:
+    def __init__(self, files, to_peer=None, to_host=None, seed=0, **peer_options):
+        '''
+        a host and an http server joined by a simulated link, once installed every
+        connection of the process to SERVER_HOST goes over the link instead of a raw
+        socket, so that the whole stack can be run without a network or root
+
+        link     : the SimulatedLink, to_peer and to_host are its LinkProfiles
+        peer     : the ScriptedPeer serving files, peer_options are passed to it
+        device   : name of the simulated device, unique to the network
+        previous : the network context and resolver replaced by install
+        '''
+        global _network_count
+        _network_count += 1
+        self.device = "sim%d" % _network_count
+        self.link = SimulatedLink(self.device, to_peer, to_host, seed)
+        self.peer = ScriptedPeer(self.link, SERVER_IP, GATEWAY_MAC, GATEWAY_IP, files,
+                                 **peer_options)
+        self.previous = None
+
+    def url(self, path):
+        return "http://" + SERVER_HOST + path
+
+    def install(self):
+        register_link(self.device, self.link.open_socket)
+        network_context = NetworkContext(self.device, HOST_IP, HOST_MAC, GATEWAY_IP)
+        resolver = Resolver(StubUpstream({SERVER_HOST: [SERVER_IP]}))
+        self.previous = (set_network_context(network_context), set_resolver(resolver))
+
+    def uninstall(self):
+        register_link(self.device, None)
+        self.peer.close()
+        network_context = set_network_context(self.previous[0])
+        network_context.arp_cache.clear()
+        set_resolver(self.previous[1])
+        self.previous = None
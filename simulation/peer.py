@@ -0,0 +1,523 @@
+import re
+import socket
+from ethernet import arp_packet, ethernet_frame
+from packet_encoder import FrameTemplate
+from tcp.segment import encode_options, get_option, OPTION_MSS, OPTION_WINDOW_SCALE, \
+    OPTION_SACK_PERMITTED, OPTION_SACK, OPTION_TIMESTAMPS
+from tcp.tcp_options import TCPOptions, timestamp
+from tcp.reassembly import ReassemblyQueue
+from tcp.congestion import create_congestion_control, DEFAULT_CONGESTION_CONTROL
+from tcp.rto import RTOEstimator
+from socket_logger import debug_log
+from utils import get_random_number
+import packet_decoder
+
+HTYPE_ARP = 0x0806
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+PSH = 0x08
+ACK = 0x10
+DUP_ACK_THRESHOLD = 3
+# the window the peer advertises, it never runs out of room
+PEER_RECEIVE_WINDOW = 1 << 22
+PEER_WINDOW_SCALE = 7
+# a closed connection stays this long to ack a fin of the host again, far shorter
+# than 2 MSL, the simulated link never holds a segment long
+TIME_WAIT = 1.0
+# the acked part of the send buffer is dropped once it is this long
+SEND_BUFFER_TRIM = 1 << 20
+HEADER_END_MARK = "\r\n\r\n"
+RANGE_PATTERN = re.compile(r"^range:\s*bytes=(\d+)-(\d*)\s*$", re.I | re.M)
+CONTENT_LENGTH_PATTERN = re.compile(r"^content-length:\s*(\d+)\s*$", re.I | re.M)
+CONNECTION_CLOSE_PATTERN = re.compile(r"^connection:\s*close\s*$", re.I | re.M)
+
+
+class PeerStats:
+    def __init__(self):
+        '''
+        counters of a scripted peer over all its connections
+        '''
+        self.connections = 0
+        self.requests = 0
+        self.segments_sent = 0
+        self.bytes_sent = 0
+        self.retransmissions = 0
+        self.fast_retransmits = 0
+        self.timeouts = 0
+        self.segments_received = 0
+
+
+class ScriptedPeer:
+    def __init__(self, link, ip, mac, gateway_ip, files, port=80, mss=1460,
+                 congestion_control=DEFAULT_CONGESTION_CONTROL, sack=True, timestamps=True):
+        '''
+        the far end of a simulated link, it is the gateway of the host, answering its
+        arp requests, and an http server behind it, the frames of the host reach it by
+        receive_frame and its own are sent over the link
+
+        ip, mac      : addresses of the server, mac is the one of the gateway as well
+        gateway_ip   : the ip whose arp requests are answered with mac
+        files        : body of each path the http server serves
+        connections  : PeerConnection by (packed host address, host port)
+        '''
+        self.link = link
+        self.loop = link.loop
+        self.ip = ip
+        self.addr = socket.inet_aton(ip)
+        self.mac = mac
+        self.gateway_ip = gateway_ip
+        self.files = files
+        self.port = port
+        self.mss = mss
+        self.congestion_control = congestion_control
+        self.sack = sack
+        self.timestamps = timestamps
+        self.connections = {}
+        self.stats = PeerStats()
+        link.attach_peer(self)
+
+    def receive_frame(self, frame):
+        if frame[12:14] == "\x08\x06":
+            self._answer_arp(frame)
+            return
+        packet = packet_decoder.decode(frame)
+        if packet is None or packet.dest_addr != self.addr or packet.dest_port != self.port:
+            return
+        self.stats.segments_received += 1
+        key = (packet.src_addr, packet.src_port)
+        connection = self.connections.get(key)
+        if packet.syn and not packet.ack:
+            if connection is not None and connection.irs == packet.seq_num:
+                # a retransmitted syn, the syn-ack has been lost or is late
+                connection.on_syn()
+                return
+            if connection is not None:
+                connection.close()
+            connection = PeerConnection(self, frame[6:12], packet)
+            self.connections[key] = connection
+            self.stats.connections += 1
+            return
+        if connection is None:
+            if not packet.rst:
+                self._reset(frame[6:12], packet)
+            return
+        connection.on_segment(packet)
+
+    def send(self, frame):
+        self.link.send_to_host(frame)
+
+    def remove(self, connection):
+        if self.connections.get(connection.key) is connection:
+            del self.connections[connection.key]
+
+    # drop all connections and their timers
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+    def _answer_arp(self, frame):
+        request = arp_packet.dissemble(ethernet_frame.dissemble(frame).data)
+        if request.optr != arp_packet.OPTR_REQUEST or request.tpa != self.gateway_ip:
+            return
+        reply = arp_packet.ARPPacket(self.mac, self.gateway_ip, request.sha, request.spa,
+                                     arp_packet.OPTR_REPLY)
+        self.send(ethernet_frame.assemble(ethernet_frame.EthernetFrame(
+            self.mac, request.sha, HTYPE_ARP, arp_packet.assemble(reply))))
+
+    # answer a segment of an unknown connection, see RFC 793 3.4
+    def _reset(self, host_mac, packet):
+        template = FrameTemplate(self.mac, host_mac, self.ip, socket.inet_ntoa(packet.src_addr),
+                                 self.port, packet.src_port)
+        if packet.ack:
+            frame = template.assemble_fields(packet.ack_num, 0, RST, 0, "")
+        else:
+            end = packet.seq_num + len(packet.data) + packet.syn + packet.fin
+            frame = template.assemble_fields(0, end & 0xffffffff, RST | ACK, 0, "")
+        self.send(frame)
+
+
+class PeerConnection:
+    def __init__(self, peer, host_mac, syn):
+        '''
+        one tcp connection of a scripted peer, a sender with slow start, fast
+        retransmit and recovery (NewReno, with the holes reported by sack resent first)
+        and a retransmission timer, and a receiver which acks every segment
+
+        send_buffer   : the data from send_base on which has not been acked yet
+        snd_una       : oldest unacked sequence number
+        snd_nxt       : next sequence number to send
+        snd_max       : highest sequence number sent, snd_nxt goes back after a timeout
+        fin_seq       : sequence number of our fin once the server closes
+        peer_edge     : right edge of the window of the host
+        recover       : highest sequence number sent when the recovery started, None
+                        outside of a recovery
+        sacked        : the [start, end) ranges the host has reported by sack
+        rtt_sample    : (sequence number, send time) of the segment timed without
+                        timestamps
+        irs           : initial sequence number of the host
+        rcv_nxt       : next sequence number expected from the host
+        request_data  : received bytes not yet parsed into requests
+        time_wait     : both fins have been acked, the connection is kept for TIME_WAIT
+        '''
+        self.peer = peer
+        self.loop = peer.loop
+        self.key = (syn.src_addr, syn.src_port)
+        self.template = FrameTemplate(peer.mac, host_mac, peer.ip,
+                                      socket.inet_ntoa(syn.src_addr), peer.port, syn.src_port)
+        self.options = TCPOptions(peer.mss, PEER_WINDOW_SCALE, peer.sack, peer.timestamps)
+        self.options.negotiate(syn)
+        self.options.on_segment(syn, syn.seq_num)
+        self.mss = self.options.send_mss
+        self.congestion = create_congestion_control(peer.congestion_control, self.mss)
+        self.rto_estimator = RTOEstimator()
+        self.iss = get_random_number(0, 0x7fffffff)
+        self.send_base = self.iss + 1
+        self.send_buffer = bytearray()
+        self.snd_una = self.iss
+        self.snd_nxt = self.iss + 1
+        self.snd_max = self.snd_nxt
+        self.fin_seq = None
+        self.peer_edge = self.snd_nxt + syn.window_size
+        self.dup_acks = 0
+        self.recover = None
+        self.retransmit_next = None
+        self.sacked = []
+        self.rtt_sample = None
+        self.timer = None
+        self.probing = False
+        self.irs = syn.seq_num
+        self.rcv_nxt = syn.seq_num + 1
+        self.reassembly = ReassemblyQueue()
+        self.request_data = ""
+        self.upload_left = 0
+        self.closing = False
+        self.host_fin = False
+        self.established = False
+        self.time_wait = False
+        self._send_syn_ack()
+
+    def _send_syn_ack(self):
+        options = [(OPTION_MSS, self.peer.mss)]
+        if self.options.sack_permitted:
+            options.append((OPTION_SACK_PERMITTED, None))
+        if self.options.timestamps:
+            options.append((OPTION_TIMESTAMPS, (timestamp(self.loop.time()),
+                                                self.options.ts_recent)))
+        if self.options.rcv_wscale:
+            options.append((OPTION_WINDOW_SCALE, self.options.rcv_wscale))
+        self._transmit(self.iss, SYN | ACK, "", options, syn=True)
+        self._arm_timer()
+
+    def on_syn(self):
+        if not self.established:
+            self._send_syn_ack()
+
+    def on_segment(self, packet):
+        if packet.rst:
+            self.close()
+            return
+        self.options.on_segment(packet, self.rcv_nxt)
+        if packet.ack:
+            self._on_ack(packet)
+        self._on_data(packet)
+        if self._done():
+            if not self.time_wait:
+                debug_log("the simulated connection from port %d is closed" % self.key[1])
+                self.time_wait = True
+                self.timer = self._cancel(self.timer)
+                self.timer = self.loop.call_later(TIME_WAIT, self.close)
+            return
+        self._output()
+
+    def _on_ack(self, packet):
+        ack_num = packet.ack_num
+        if not self.established:
+            if ack_num != self.iss + 1:
+                return
+            self.established = True
+            self.snd_una = ack_num
+            self.timer = self._cancel(self.timer)
+        if self.options.sack_permitted:
+            self._update_sacked(get_option(packet.options, OPTION_SACK))
+        window_edge = ack_num + self.options.peer_window(packet)
+        acked = ack_num - self.snd_una
+        if acked > 0 and ack_num <= self.snd_max:
+            self._on_new_ack(packet, ack_num)
+        elif acked == 0 and self.snd_una != self.snd_nxt and not packet.data and not packet.fin \
+                and not self.probing:
+            self._on_dup_ack()
+        self.peer_edge = max(self.peer_edge, window_edge)
+
+    def _on_new_ack(self, packet, ack_num):
+        now = self.loop.time()
+        acked = ack_num - self.snd_una
+        self.snd_una = ack_num
+        # the acks of segments sent before a timeout may still arrive
+        self.snd_nxt = max(self.snd_nxt, ack_num)
+        self.dup_acks = 0
+        self.probing = False
+        echo_rtt = self.options.echo_rtt(now)
+        if echo_rtt is not None:
+            self.rto_estimator.on_sample(echo_rtt)
+        elif self.rtt_sample is not None and ack_num > self.rtt_sample[0]:
+            self.rto_estimator.on_sample(now - self.rtt_sample[1])
+            self.rtt_sample = None
+        self.sacked = [(start, end) for start, end in self.sacked if end > ack_num]
+        if self.recover is not None:
+            if ack_num >= self.recover:
+                self.recover = None
+                self.congestion.on_recovery_exit()
+            else:
+                # a partial ack, the next hole is lost as well
+                self.congestion.on_partial_ack(acked)
+                self._retransmit(ack_num)
+        else:
+            # the host coalesces its acks, the window grows by every segment acked
+            # like linux counts them, instead of by one segment per ack
+            while acked > 0:
+                self.congestion.on_ack(min(acked, self.mss), now)
+                acked -= self.mss
+        self._trim_send_buffer()
+        self.timer = self._cancel(self.timer)
+        if self.snd_una != self.snd_nxt:
+            self._arm_timer()
+
+    def _on_dup_ack(self):
+        self.dup_acks += 1
+        if self.recover is not None:
+            self.congestion.on_recovery_dup_ack()
+            self._retransmit_sacked_hole()
+        elif self.dup_acks == DUP_ACK_THRESHOLD:
+            self.peer.stats.fast_retransmits += 1
+            self.recover = self.snd_nxt
+            self.retransmit_next = self.snd_una
+            self.congestion.on_fast_retransmit(self.snd_nxt - self.snd_una, self.loop.time())
+            self._retransmit(self.snd_una)
+
+    def _update_sacked(self, blocks):
+        if not blocks:
+            return
+        ranges = self.sacked + [(start, end) for start, end in blocks if end > self.snd_una]
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.sacked = merged
+
+    # resend the next hole below the highest sacked byte, see RFC 6675
+    def _retransmit_sacked_hole(self):
+        if not self.sacked:
+            return
+        position = max(self.retransmit_next, self.snd_una)
+        for start, end in self.sacked:
+            if position < start:
+                self._retransmit(position)
+                return
+            position = max(position, end)
+        self.retransmit_next = position
+
+    def _retransmit(self, seq_num):
+        if seq_num >= self.snd_nxt:
+            return
+        self.peer.stats.retransmissions += 1
+        self.rtt_sample = None
+        sent = self._send_at(seq_num)
+        if self.retransmit_next is not None:
+            self.retransmit_next = max(self.retransmit_next, seq_num + sent)
+
+    def _on_data(self, packet):
+        data = packet.data
+        seq_num = packet.seq_num
+        if not data and not packet.fin:
+            return
+        if data:
+            if seq_num <= self.rcv_nxt < seq_num + len(data):
+                self._on_request_data(str(data[self.rcv_nxt - seq_num:]))
+                self.rcv_nxt = seq_num + len(data)
+                while True:
+                    ordered_data = self.reassembly.pop_from(self.rcv_nxt)
+                    if ordered_data is None:
+                        break
+                    self._on_request_data(ordered_data)
+                    self.rcv_nxt += len(ordered_data)
+            elif seq_num > self.rcv_nxt:
+                self.reassembly.add(seq_num, str(data))
+        if packet.fin and seq_num + len(data) == self.rcv_nxt and not self.host_fin:
+            self.host_fin = True
+            self.rcv_nxt += 1
+            self.closing = True
+        self._send_ack()
+
+    def _on_request_data(self, data):
+        if self.upload_left:
+            consumed = min(self.upload_left, len(data))
+            self.upload_left -= consumed
+            data = data[consumed:]
+        self.request_data += data
+        while not self.closing and not self.upload_left and HEADER_END_MARK in self.request_data:
+            header_end = self.request_data.index(HEADER_END_MARK) + len(HEADER_END_MARK)
+            header = self.request_data[:header_end]
+            self.request_data = self.request_data[header_end:]
+            content_length = CONTENT_LENGTH_PATTERN.search(header)
+            if content_length is not None:
+                # the body of an upload is read and dropped
+                body_length = int(content_length.group(1))
+                consumed = min(body_length, len(self.request_data))
+                self.request_data = self.request_data[consumed:]
+                self.upload_left = body_length - consumed
+            self._respond(header)
+
+    def _respond(self, header):
+        self.peer.stats.requests += 1
+        request_line = header.split("\r\n", 1)[0].split(" ")
+        method, path = request_line[0], request_line[1] if len(request_line) > 1 else "/"
+        keep_alive = request_line[-1] == "HTTP/1.1" and \
+            CONNECTION_CLOSE_PATTERN.search(header) is None
+        version = "HTTP/1.1" if keep_alive else "HTTP/1.0"
+        body = self.peer.files.get(path)
+        if body is None:
+            status, body = "404 Not Found", ""
+        else:
+            status = "200 OK"
+            byte_range = RANGE_PATTERN.search(header)
+            if byte_range is not None:
+                start = int(byte_range.group(1))
+                end = int(byte_range.group(2)) + 1 if byte_range.group(2) else len(body)
+                body = body[start:min(end, len(body))]
+                status = "206 Partial Content"
+        response = "%s %s\r\nContent-Length: %d\r\n\r\n" % (version, status, len(body))
+        self.send_buffer += response
+        if method != "HEAD":
+            self.send_buffer += body
+        if not keep_alive:
+            self.closing = True
+
+    def _send_ack(self):
+        options = []
+        if self.options.sack_permitted and len(self.reassembly):
+            options.append((OPTION_SACK, [(start & 0xffffffff, end & 0xffffffff) for start, end in
+                                          self.reassembly.sack_ranges(self.options.max_sack_blocks())]))
+        self._transmit(self.snd_nxt, ACK, "", options)
+
+    # send new data within the congestion window and the window of the host, and our
+    # fin once all of it has been sent
+    def _output(self):
+        if not self.established:
+            return
+        buffer_end = self.send_base + len(self.send_buffer)
+        if self.closing and self.fin_seq is None and not self.upload_left:
+            self.fin_seq = buffer_end
+        window = self.congestion.window()
+        if self.recover is None and self.dup_acks < DUP_ACK_THRESHOLD:
+            # limited transmit, each of the first duplicate acks lets a new segment
+            # out, so that a small window still gets to the third one, see RFC 3042
+            window += self.dup_acks * self.mss
+        limit = min(self.snd_una + window, self.peer_edge)
+        while self.snd_nxt < buffer_end:
+            length = min(self.mss, buffer_end - self.snd_nxt, limit - self.snd_nxt)
+            in_flight = self.snd_nxt != self.snd_una
+            # less than a full segment is only sent when nothing is in flight
+            if length <= 0 or (in_flight and length < min(self.mss, buffer_end - self.snd_nxt)):
+                if not in_flight and self.timer is None:
+                    # the host has closed its window, it is probed when the timer expires
+                    self._arm_timer()
+                return
+            self._send_new(length)
+        if self.fin_seq is not None and self.snd_nxt == self.fin_seq:
+            self._send_new(0)
+
+    def _send_new(self, length):
+        if self.rtt_sample is None and not self.options.timestamps \
+                and self.snd_nxt >= self.snd_max:
+            self.rtt_sample = (self.snd_nxt, self.loop.time())
+        self.snd_nxt += self._send_at(self.snd_nxt, length)
+        self.snd_max = max(self.snd_max, self.snd_nxt)
+        if self.timer is None:
+            self._arm_timer()
+
+    # send the segment starting at seq_num, return the sequence space it takes,
+    # its data and its fin
+    def _send_at(self, seq_num, length=None):
+        offset = seq_num - self.send_base
+        if length is None:
+            length = self.mss
+        data = str(self.send_buffer[offset: offset + length])
+        flags = ACK
+        if data:
+            flags |= PSH
+        if self.fin_seq is not None and seq_num + len(data) == self.fin_seq:
+            flags |= FIN
+        self._transmit(seq_num, flags, data)
+        return len(data) + (flags & FIN)
+
+    def _transmit(self, seq_num, flags, data, options=None, syn=False):
+        options = options or []
+        if self.options.timestamps and not syn:
+            options.insert(0, (OPTION_TIMESTAMPS, (timestamp(self.loop.time()),
+                                                   self.options.ts_recent)))
+        window = self.options.advertised_window(PEER_RECEIVE_WINDOW, syn)
+        frame = self.template.assemble_fields(seq_num & 0xffffffff, self.rcv_nxt & 0xffffffff,
+                                              flags, window, data, encode_options(options))
+        self.peer.stats.segments_sent += 1
+        self.peer.stats.bytes_sent += len(data)
+        self.peer.send(frame)
+
+    def _arm_timer(self):
+        self.timer = self._cancel(self.timer)
+        self.timer = self.loop.call_later(self.rto_estimator.rto(), self._on_timeout)
+
+    # the oldest segment is resent and the sending starts over from it, or the
+    # closed window of the host is probed
+    def _on_timeout(self):
+        self.timer = None
+        if not self.established:
+            self.rto_estimator.on_timeout()
+            self._send_syn_ack()
+            return
+        buffer_end = self.send_base + len(self.send_buffer)
+        if self.probing or (self.snd_una == self.snd_nxt and self.snd_nxt < buffer_end):
+            # a probe of one byte beyond the closed window, the ack of the host tells
+            # when it opens again
+            self.probing = True
+            self.rto_estimator.on_timeout()
+            self.snd_nxt = self.snd_una + self._send_at(self.snd_una, 1)
+            self.snd_max = max(self.snd_max, self.snd_nxt)
+            self._arm_timer()
+            return
+        if self.snd_una == self.snd_nxt:
+            return
+        self.peer.stats.timeouts += 1
+        self.rto_estimator.on_timeout()
+        self.congestion.on_timeout(self.snd_nxt - self.snd_una, self.loop.time())
+        self.recover = None
+        self.dup_acks = 0
+        self.rtt_sample = None
+        self.sacked = []
+        # go back n, the segments after the oldest are sent again as the window opens
+        self.snd_nxt = self.snd_una
+        self.peer.stats.retransmissions += 1
+        self._output()
+        self._arm_timer()
+
+    def _trim_send_buffer(self):
+        acked = min(self.snd_una, self.send_base + len(self.send_buffer)) - self.send_base
+        if acked >= SEND_BUFFER_TRIM:
+            del self.send_buffer[:acked]
+            self.send_base += acked
+
+    # both fins have been sent and acked
+    def _done(self):
+        return self.host_fin and self.fin_seq is not None and self.snd_una > self.fin_seq
+
+    def close(self):
+        self.timer = self._cancel(self.timer)
+        self.peer.remove(self)
+
+    def _cancel(self, timer):
+        if timer is not None:
+            timer.cancel()
+        return None
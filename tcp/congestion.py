@@ -0,0 +1,149 @@
+from socket_logger import debug_log
+
+# initial window in segments, see RFC 5681
+INITIAL_WINDOW = 2
+# the congestion window never grows beyond this many segments
+MAX_CWND = 1000
+# CUBIC constants, see RFC 8312
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+
+# create the congestion control named name, see CONGESTION_CONTROLS
+def create_congestion_control(name, mss):
+    if name not in CONGESTION_CONTROLS:
+        raise ValueError("unknown congestion control: " + str(name))
+    return CONGESTION_CONTROLS[name](mss)
+
+
+class CongestionControl:
+    def __init__(self, mss):
+        '''
+        the window growth and reduction of a sender, the sender detects losses and
+        calls the hooks below, windows are in bytes
+
+        cwnd     : congestion window
+        ssthresh : slow start threshold
+        '''
+        self.mss = mss
+        self.cwnd = float(INITIAL_WINDOW * mss)
+        self.ssthresh = float(MAX_CWND * mss)
+        self.max_cwnd = float(MAX_CWND * mss)
+
+    # bytes which may be in flight
+    def window(self):
+        return int(self.cwnd)
+
+    def in_slow_start(self):
+        return self.cwnd < self.ssthresh
+
+    # new data has been acked outside of a fast recovery
+    def on_ack(self, acked_bytes, now):
+        if self.in_slow_start():
+            self.cwnd += min(acked_bytes, self.mss)
+        else:
+            self._congestion_avoidance(acked_bytes, now)
+        self.cwnd = min(self.cwnd, self.max_cwnd)
+
+    def _congestion_avoidance(self, acked_bytes, now):
+        pass
+
+    # the third duplicate ack has arrived, the lost segment is retransmitted and
+    # a fast recovery starts, see RFC 6582
+    def on_fast_retransmit(self, flight_size, now):
+        self._reduce(flight_size, now)
+        # the three segments which have left the network
+        self.cwnd = self.ssthresh + 3 * self.mss
+
+    # another duplicate ack during the fast recovery, a segment has left the network
+    def on_recovery_dup_ack(self):
+        self.cwnd += self.mss
+
+    # an ack during the fast recovery which does not cover all the data sent before it
+    def on_partial_ack(self, acked_bytes):
+        self.cwnd = max(self.cwnd - acked_bytes + self.mss, self.mss)
+
+    def on_recovery_exit(self):
+        self.cwnd = self.ssthresh
+
+    # the retransmission timer has expired, start from one segment again
+    def on_timeout(self, flight_size, now):
+        self._reduce(flight_size, now)
+        self.cwnd = float(self.mss)
+
+    # set ssthresh after a loss
+    def _reduce(self, flight_size, now):
+        pass
+
+
+class NewReno(CongestionControl):
+    def _congestion_avoidance(self, acked_bytes, now):
+        # about one segment per round trip
+        self.cwnd += self.mss * self.mss / self.cwnd
+
+    def _reduce(self, flight_size, now):
+        self.ssthresh = max(flight_size / 2.0, 2.0 * self.mss)
+        debug_log("newreno: ssthresh is %d" % self.ssthresh)
+
+
+class Cubic(CongestionControl):
+    def __init__(self, mss):
+        '''
+        the window grows as a cubic function of the time since the last reduction,
+        so that it is regained fast on paths with a large bandwidth delay product
+
+        w_max       : window in segments before the last reduction
+        epoch_start : when the current congestion avoidance epoch started
+        k           : seconds the cubic function takes to reach w_max again
+        w_est       : window in segments a reno sender would have, see RFC 8312 4.2
+        '''
+        CongestionControl.__init__(self, mss)
+        self.w_max = 0.0
+        self.epoch_start = None
+        self.k = 0.0
+        self.origin = 0.0
+        self.w_est = 0.0
+
+    def _congestion_avoidance(self, acked_bytes, now):
+        segments = self.cwnd / self.mss
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if segments < self.w_max:
+                self.k = ((self.w_max - segments) / CUBIC_C) ** (1.0 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0.0
+                self.origin = segments
+            self.w_est = segments
+        elapsed = now - self.epoch_start
+        target = self.origin + CUBIC_C * (elapsed - self.k) ** 3
+        # the reno friendly window grows by about one segment every 1.7 round trips
+        self.w_est += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * acked_bytes / self.cwnd
+        if target > segments:
+            self.cwnd += (target - segments) / segments * acked_bytes
+        else:
+            # keep probing slowly around w_max
+            self.cwnd += 0.01 * acked_bytes / segments
+        self.cwnd = max(self.cwnd, self.w_est * self.mss)
+
+    def _reduce(self, flight_size, now):
+        segments = self.cwnd / self.mss
+        # fast convergence, give way to newer flows
+        if segments < self.w_max:
+            self.w_max = segments * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = segments
+        self.epoch_start = None
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, 2.0 * self.mss)
+        debug_log("cubic: w_max is %.1f segments" % self.w_max)
+
+    def on_timeout(self, flight_size, now):
+        CongestionControl.on_timeout(self, flight_size, now)
+        self.w_max = 0.0
+
+
+CONGESTION_CONTROLS = {
+    "newreno": NewReno,
+    "cubic": Cubic,
+}
+DEFAULT_CONGESTION_CONTROL = "newreno"
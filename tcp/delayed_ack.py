@@ -0,0 +1,42 @@
+# most time the ack of in-order data is delayed, RFC 1122 allows up to 500 ms
+DELAYED_ACK_TIMEOUT = 0.04
+# an ack is sent for at least every this many full-sized segments, see RFC 5681
+ACK_EVERY = 2
+
+
+class DelayedAck:
+    def __init__(self, delay=DELAYED_ACK_TIMEOUT, ack_every=ACK_EVERY, coalesce=True):
+        '''
+        decides when the received data is acked, the ack of in-order data waits until
+        ack_every full-sized segments have arrived or until delay has passed, the
+        caller acks out-of-order data, filled gaps and fins at once, see RFC 5681 4.2
+
+        coalesce : the ack which is due while a burst of received segments is handled
+                   is sent once for the whole burst, instead of every ack_every segments
+        pending  : full-sized segments received since the last ack
+        deadline : when the delayed ack has to be sent, None if no ack is waiting
+        '''
+        self.delay = delay
+        self.ack_every = ack_every
+        self.coalesce = coalesce
+        self.pending = 0
+        self.deadline = None
+
+    # in-order data has been received and not acked yet
+    def on_data(self, now, full_sized):
+        if self.deadline is None:
+            self.deadline = now + self.delay
+        if full_sized:
+            self.pending += 1
+
+    # enough full-sized segments have arrived, or the delay is turned off
+    def ack_due(self):
+        return self.pending >= self.ack_every or self.delay <= 0
+
+    def ack_waiting(self):
+        return self.deadline is not None
+
+    # an ack for everything received has been sent, on its own or with data
+    def on_ack_sent(self):
+        self.pending = 0
+        self.deadline = None
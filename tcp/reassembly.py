@@ -0,0 +1,95 @@
+from intervals import IntervalSet
+
+
+class ReassemblyQueue:
+    def __init__(self):
+        '''
+        the out-of-order data of a connection as sorted [start, end) ranges, a segment
+        which overlaps or touches a range is merged into it, so that the data after a
+        hole is handed out in one piece once the hole is filled
+
+        received : the held ranges, see intervals.IntervalSet
+        chunks   : the data of each range of received
+        latest   : index of the range which the last added segment went into
+        '''
+        self.received = IntervalSet()
+        self.chunks = []
+        self.latest = None
+        self.byte_count = 0
+
+    # keep data received at offset, the bytes which are already held are not replaced,
+    # only the parts of data which fill the holes between them are added
+    def add(self, offset, data):
+        end = offset + len(data)
+        if end <= offset:
+            return
+        first, last = self.received.span(offset, end)
+        if first == last:
+            self.received.add(offset, end)
+            self.chunks.insert(first, bytearray(data))
+            self.byte_count += len(data)
+            self.latest = first
+            return
+        starts = self.received.starts
+        ends = self.received.ends
+        held_count = sum(ends[index] - starts[index] for index in range(first, last))
+        merged_start = min(offset, starts[first])
+        if offset < starts[first]:
+            merged = bytearray(data[:starts[first] - offset])
+            following = range(first, last)
+        else:
+            # the data goes after the first held range, which is extended in place
+            merged = self.chunks[first]
+            following = range(first + 1, last)
+        merged_end = merged_start + len(merged)
+        for index in following:
+            # the hole before a held range is filled from data, then the held bytes follow
+            merged += data[merged_end - offset: starts[index] - offset]
+            merged += self.chunks[index]
+            merged_end = ends[index]
+        if end > merged_end:
+            merged += data[merged_end - offset:]
+            merged_end = end
+        self.byte_count += (merged_end - merged_start) - held_count
+        self.received.add(offset, end)
+        self.chunks[first:last] = [merged]
+        self.latest = first
+
+    # remove and return the data from offset up to the next hole, None if offset
+    # has not been received, the data before offset is dropped
+    def pop_from(self, offset):
+        starts = self.received.starts
+        while starts and self.received.ends[0] <= offset:
+            self._remove_first()
+        if not starts or starts[0] > offset:
+            return None
+        data = str(self.chunks[0][offset - starts[0]:])
+        self._remove_first()
+        return data
+
+    # the received [start, end) ranges, the range of the last added segment first and
+    # then the others in order, see RFC 2018
+    def sack_ranges(self, limit):
+        ranges = self.received.ranges()
+        if self.latest is not None and self.latest < len(ranges):
+            ranges.insert(0, ranges.pop(self.latest))
+        return ranges[:limit]
+
+    def ranges(self):
+        return self.received.ranges()
+
+    def clear(self):
+        self.received = IntervalSet()
+        self.chunks = []
+        self.latest = None
+        self.byte_count = 0
+
+    def __len__(self):
+        return len(self.received)
+
+    def _remove_first(self):
+        start, end = self.received.pop_first()
+        self.byte_count -= end - start
+        del self.chunks[0]
+        if self.latest is not None:
+            self.latest = self.latest - 1 if self.latest > 0 else None
@@ -0,0 +1,105 @@
+# the receive buffer starts at this size and grows with the delivery rate
+INITIAL_RECEIVE_BUFFER = 64 * 1024
+# most bytes held for the application and out of order, the window never goes beyond it
+DEFAULT_RECEIVE_BUFFER_LIMIT = 4 * 1024 * 1024
+
+
+class ReceiveBuffer:
+    def __init__(self, limit=DEFAULT_RECEIVE_BUFFER_LIMIT, initial_size=INITIAL_RECEIVE_BUFFER,
+                 auto_tune=True):
+        '''
+        the space for the received data of a connection, the advertised window is its
+        free space, and its size follows the rate the application takes the data at,
+        like the dynamic right-sizing of Linux
+
+        size       : current size of the buffer, grows from initial_size up to limit
+        unread     : in-order bytes the application has not taken yet
+        right_edge : sequence number up to which the last advertised window allows
+                     data, None before a window has been advertised
+        rtt        : round trip time measured by the receiver, None before a sample
+        copied     : bytes taken by the application since epoch_start
+        space      : most bytes taken by the application in one round trip
+        '''
+        self.limit = limit
+        self.size = min(initial_size, limit)
+        self.auto_tune = auto_tune
+        self.unread = 0
+        self.right_edge = None
+        self.rtt = None
+        self.rtt_seq = None
+        self.rtt_time = None
+        self.epoch_start = None
+        self.copied = 0
+        self.space = 0
+
+    def free_space(self, out_of_order_bytes=0):
+        return max(self.size - self.unread - out_of_order_bytes, 0)
+
+    # the window to advertise with ack_num, the right edge never moves back and small
+    # openings are held back so that the sender does not send small segments, see
+    # RFC 1122 4.2.3.3, the window of a syn (ack_num None) is the free space
+    def window(self, ack_num, out_of_order_bytes, mss):
+        free = self.free_space(out_of_order_bytes)
+        if ack_num is None:
+            return free
+        window = max(self.right_edge - ack_num, 0) if self.right_edge is not None else 0
+        if free >= window + min(self.size / 2, mss):
+            window = free
+        self.right_edge = ack_num + window
+        return window
+
+    # the window can open enough to be announced without waiting for data, that is
+    # when it at least doubles, like Linux does
+    def window_update_due(self, ack_num, out_of_order_bytes, mss):
+        window = max(self.right_edge - ack_num, 0) if self.right_edge is not None else 0
+        free = self.free_space(out_of_order_bytes)
+        return free >= 2 * window and free - window >= mss
+
+    # in-order data has been received and is held until the application takes it
+    def on_received(self, length):
+        self.unread += length
+
+    def on_consumed(self, length, now):
+        self.unread = max(self.unread - length, 0)
+        self.copied += length
+        self._tune(now)
+
+    # in-order data has arrived and moved ack_num, echo_rtt is the round trip time
+    # given by the echoed timestamp if there is one, otherwise the time a window takes
+    # to arrive is taken, which is at least the round trip time
+    def measure_rtt(self, ack_num, now, echo_rtt=None):
+        if echo_rtt is not None:
+            self._on_rtt_sample(echo_rtt)
+        elif self.rtt_seq is None:
+            if self.right_edge is not None:
+                self.rtt_seq = max(self.right_edge, ack_num + 1)
+                self.rtt_time = now
+        elif ack_num >= self.rtt_seq:
+            self._on_rtt_sample(now - self.rtt_time)
+            self.rtt_seq = None
+
+    def _on_rtt_sample(self, rtt):
+        # follow a lower rtt at once and a higher one slowly, the buffer should not
+        # grow from a sample taken while the sender was idle
+        if self.rtt is None or rtt < self.rtt:
+            self.rtt = rtt
+        else:
+            self.rtt += (rtt - self.rtt) / 8
+
+    # once per round trip, make the buffer twice as large as what the application
+    # took in the round trip, so that the sender is never limited by the window
+    # while its congestion window grows
+    def _tune(self, now):
+        if not self.auto_tune or self.rtt is None:
+            return
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.copied = 0
+            return
+        if now - self.epoch_start < self.rtt:
+            return
+        if self.copied > self.space:
+            self.space = self.copied
+            self.size = max(self.size, min(2 * self.space, self.limit))
+        self.epoch_start = now
+        self.copied = 0
@@ -0,0 +1,70 @@
+# retransmission timeout in seconds before the first rtt sample, see RFC 6298
+INITIAL_RTO = 1.0
+# RFC 6298 asks for a floor of 1 second, like most stacks we allow a lower one
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+# timer granularity of the event loop
+CLOCK_GRANULARITY = 0.001
+# weights of a new sample in srtt and rttvar
+ALPHA = 1.0 / 8
+BETA = 1.0 / 4
+K = 4
+
+
+class RTOEstimator:
+    def __init__(self, min_rto=MIN_RTO, max_rto=MAX_RTO, initial_rto=INITIAL_RTO):
+        '''
+        derives the retransmission timeout from the measured round trip times,
+        see RFC 6298
+
+        srtt    : smoothed round trip time, None before the first sample
+        rttvar  : round trip time variation
+        backoff : the timeout is doubled this many times after consecutive timeouts
+        '''
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = initial_rto
+        self.backoff = 0
+
+    # a round trip time measured on a segment which has not been retransmitted
+    def on_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.base_rto = self.srtt + max(CLOCK_GRANULARITY, K * self.rttvar)
+        # a new sample ends the backoff
+        self.backoff = 0
+
+    def on_timeout(self):
+        if self.rto() < self.max_rto:
+            self.backoff += 1
+
+    def rto(self):
+        return min(max(self.base_rto, self.min_rto) * (1 << self.backoff), self.max_rto)
+
+
+class InFlightSegment:
+    def __init__(self, segment, sent_time, rto, retransmitted=False):
+        '''
+        a sent segment waiting for its ack
+
+        sent_time     : when it was sent last
+        deadline      : when it is taken as lost
+        retransmitted : it has been sent more than once, its ack cannot be used as
+                        an rtt sample then (Karn's rule)
+        '''
+        self.segment = segment
+        self.end_seq = segment.seq_num + len(segment.data)
+        self.sent_time = sent_time
+        self.deadline = sent_time + rto
+        self.retransmitted = retransmitted
+
+    def resent(self, now, rto):
+        self.sent_time = now
+        self.deadline = now + rto
+        self.retransmitted = True
@@ -1,11 +1,27 @@
 import socket
 from struct import *
-from utils import get_random_number, calculate_checksum
+from utils import get_random_number
+from checksum import partial_sum, finish_checksum, update_checksum
 from socket_logger import error_log
 
 HEADER_PACK_FORMAT = "!HHLLBBHHH"
 PSEUDO_HEADER_PACK_FORMAT = "!4s4sBBH"
 PARTIAL_HEADER_PACK_FORMAT = "!HHLLBBH"
+# offsets of the fields which can be patched in an assembled segment
+SEQ_NUM_OFFSET = 4
+ACK_NUM_OFFSET = 8
+WINDOW_SIZE_OFFSET = 14
+CHECKSUM_OFFSET = 16
+# option kinds, see RFC 793, RFC 2018 and RFC 7323
+OPTION_END = 0
+OPTION_NOP = 1
+OPTION_MSS = 2
+OPTION_WINDOW_SCALE = 3
+OPTION_SACK_PERMITTED = 4
+OPTION_SACK = 5
+OPTION_TIMESTAMPS = 8
+# the options field is at most 40 bytes long
+MAX_OPTIONS_LENGTH = 40
 
 
 def dissemble(full_segment, src_ip, dest_ip):
@@ -31,14 +47,18 @@ def dissemble(full_segment, src_ip, dest_ip):
     header_length = tcp_segment.data_offset * 4
     # header_length > 20 means it has options field
     if header_length > 20:
-        tcp_segment.options = unpack("!L", full_segment[20: header_length])[0]
+        tcp_segment.options = decode_options(full_segment[20: header_length])
 
     # the part after header length is for tcp segment data
     tcp_segment.data = full_segment[header_length: ]
-    tmp_tcp_header = _assemble_tmp_tcp_header(tcp_segment, offset_reserved, flags)
-    expected_checksum = _calculate_segment_checksum(tmp_tcp_header, src_ip,
-                                                   dest_ip, tcp_segment.data)
-    if expected_checksum != tcp_segment.checksum:
+    # sum the bytes as they arrived, the options of the peer may be laid out in
+    # another way than encode_options would lay them out, the sum over a segment
+    # with a correct checksum field is 0
+    pseudo_header = pack(PSEUDO_HEADER_PACK_FORMAT, socket.inet_aton(src_ip),
+                         socket.inet_aton(dest_ip), 0, socket.IPPROTO_TCP, len(full_segment))
+    segment_sum = partial_sum(full_segment, partial_sum(pseudo_header))
+    if finish_checksum(segment_sum) != 0:
+        expected_checksum = finish_checksum(segment_sum - tcp_segment.checksum)
         error_log("wrong tcp segment checksum, " + "expected: " + str(expected_checksum) + ", actual: " + str(tcp_segment.checksum))
         return None
 
@@ -47,6 +67,7 @@ def dissemble(full_segment, src_ip, dest_ip):
 
 # transform a TCPSegment object to a string, which will then be sent by the socket
 def assemble(tcp_segment):
+    tcp_segment.data_offset = 5 + len(encode_options(tcp_segment.options)) / 4
     offset_reserved = (tcp_segment.data_offset << 4) + tcp_segment.reserved
     flags = tcp_segment.fin + (tcp_segment.syn << 1) + (tcp_segment.rst << 2) + (
         tcp_segment.psh << 3) + (
@@ -68,7 +89,8 @@ def assemble(tcp_segment):
                       flags,
                       tcp_segment.window_size) + \
                  pack("H", tcp_checksum) + \
-                 pack("!H", tcp_segment.urgent_pointer)
+                 pack("!H", tcp_segment.urgent_pointer) + \
+                 encode_options(tcp_segment.options)
     return tcp_header + tcp_segment.data
 
 
@@ -87,17 +109,123 @@ def _assemble_tmp_tcp_header(tcp_segment, offset_reserved, flags):
                           tcp_segment.window_size,
                           checksum,
                           tcp_segment.urgent_pointer)
-    if tcp_segment.options != 0:
-        options_pack = pack("!L", tcp_segment.options)
-        tmp_tcp_header += options_pack
+    if tcp_segment.options:
+        tmp_tcp_header += encode_options(tcp_segment.options)
     return tmp_tcp_header
 
 
+# pack a list of (kind, value) options, padded to a multiple of 4 bytes
+# the value of OPTION_MSS is the mss, of OPTION_WINDOW_SCALE the shift count, of
+# OPTION_TIMESTAMPS a (tsval, tsecr) pair and of OPTION_SACK a list of (left edge,
+# right edge) blocks, the value of OPTION_SACK_PERMITTED is ignored, other kinds carry
+# their raw bytes
+def encode_options(options):
+    if not options:
+        return ""
+    packed = []
+    length = 0
+    for kind, value in options:
+        if kind in (OPTION_TIMESTAMPS, OPTION_SACK):
+            # nops in front, so that the 32 bit fields are aligned like other stacks do
+            padding = (2 - length) % 4
+            packed.append(chr(OPTION_NOP) * padding)
+            length += padding
+        if kind == OPTION_MSS:
+            option = pack("!BBH", kind, 4, value)
+        elif kind == OPTION_WINDOW_SCALE:
+            option = pack("!BBB", kind, 3, value)
+        elif kind == OPTION_SACK_PERMITTED:
+            option = pack("!BB", kind, 2)
+        elif kind == OPTION_TIMESTAMPS:
+            option = pack("!BBLL", kind, 10, value[0] & 0xffffffff, value[1] & 0xffffffff)
+        elif kind == OPTION_SACK:
+            option = pack("!BB", kind, 2 + 8 * len(value)) + "".join(
+                pack("!LL", left_edge & 0xffffffff, right_edge & 0xffffffff)
+                for left_edge, right_edge in value)
+        else:
+            option = pack("!BB", kind, 2 + len(value)) + value
+        packed.append(option)
+        length += len(option)
+    option_bytes = "".join(packed)
+    option_bytes += chr(OPTION_END) * (-len(option_bytes) % 4)
+    if len(option_bytes) > MAX_OPTIONS_LENGTH:
+        error_log("tcp options are too long: " + str(len(option_bytes)) + " bytes")
+    return option_bytes
+
+
+# unpack the options field into a list of (kind, value), see encode_options,
+# a malformed option ends the list
+def decode_options(option_bytes):
+    options = []
+    position = 0
+    while position < len(option_bytes):
+        kind = unpack_from("!B", option_bytes, position)[0]
+        if kind == OPTION_END:
+            break
+        if kind == OPTION_NOP:
+            position += 1
+            continue
+        if position + 2 > len(option_bytes):
+            break
+        length = unpack_from("!B", option_bytes, position + 1)[0]
+        if length < 2 or position + length > len(option_bytes):
+            break
+        if kind == OPTION_MSS and length == 4:
+            options.append((kind, unpack_from("!H", option_bytes, position + 2)[0]))
+        elif kind == OPTION_WINDOW_SCALE and length == 3:
+            options.append((kind, unpack_from("!B", option_bytes, position + 2)[0]))
+        elif kind == OPTION_TIMESTAMPS and length == 10:
+            options.append((kind, unpack_from("!LL", option_bytes, position + 2)))
+        elif kind == OPTION_SACK_PERMITTED:
+            options.append((kind, None))
+        elif kind == OPTION_SACK:
+            blocks = []
+            for block_offset in range(position + 2, position + length - 7, 8):
+                blocks.append(unpack_from("!LL", option_bytes, block_offset))
+            options.append((kind, blocks))
+        else:
+            value = option_bytes[position + 2: position + length]
+            options.append((kind, value.tobytes() if isinstance(value, memoryview) else value))
+        position += length
+    return options
+
+
+# the value of the first option of the given kind, or default if there is none
+def get_option(options, kind, default=None):
+    for option_kind, value in options:
+        if option_kind == kind:
+            return value
+    return default
+
+
+def has_option(options, kind):
+    return any(option_kind == kind for option_kind, _ in options)
+
+
+# patch the sequence number, acknowledge number and window size of an assembled segment
+# in place, the checksum is updated incrementally so the data is not summed again
+def update_header_fields(raw_segment, seq_num=None, ack_num=None, window_size=None):
+    checksum = unpack_from("H", raw_segment, CHECKSUM_OFFSET)[0]
+    for offset, field_format, value in ((SEQ_NUM_OFFSET, "!L", seq_num),
+                                        (ACK_NUM_OFFSET, "!L", ack_num),
+                                        (WINDOW_SIZE_OFFSET, "!H", window_size)):
+        if value is None:
+            continue
+        old_field = str(raw_segment[offset: offset + calcsize(field_format)])
+        new_field = pack(field_format, value)
+        raw_segment[offset: offset + len(new_field)] = new_field
+        checksum = update_checksum(checksum, old_field, new_field)
+    pack_into("H", raw_segment, CHECKSUM_OFFSET, checksum)
+    return raw_segment
+
+
 # calculate checksum for the given segment
 def _calculate_segment_checksum(tmp_tcp_header, src_ip, dest_ip, data):
     pseudo_header = _assemble_pseudo_header(tmp_tcp_header, src_ip, dest_ip, len(data))
-    checksum_base = pseudo_header + tmp_tcp_header + data
-    tcp_checksum = calculate_checksum(checksum_base)
+    # the pseudo header and the tcp header have an even length, so the data can be
+    # summed separately instead of being concatenated with them
+    header_sum = partial_sum(pseudo_header + tmp_tcp_header)
+    tcp_checksum = finish_checksum(partial_sum(data, header_sum))
     return tcp_checksum
 
 
@@ -140,7 +268,7 @@ class TCPSegment:
         window_size    :  slide window size
         checksum       :  TCP checksum
         urgent_pointer :  default is 0
-        options        :  optional, contains some special information
+        options        :  list of (kind, value) options, see encode_options
         '''
         self.src_ip = src_ip
         self.src_port = src_port
@@ -160,7 +288,7 @@ class TCPSegment:
         self.window_size = 29200
         self.checksum = 0
         self.urgent_pointer = 0
-        self.options = 0
+        self.options = []
         self.data = data
 
 
@@ -171,16 +299,20 @@ class TCPSegmentFactory:
         self.dest_ip = dest_ip
         self.dest_port = dest_port
 
-    def create_syn(self):
+    def create_syn(self, options=None):
         syn_segment = TCPSegment(self.src_ip, self.src_port, self.dest_ip, self.dest_port)
         syn_segment.syn = 1
+        if options is not None:
+            syn_segment.options = options
         return syn_segment
 
-    def create_ack(self, seq_num, ack_num):
+    def create_ack(self, seq_num, ack_num, options=None):
         ack_segment = TCPSegment(self.src_ip, self.src_port, self.dest_ip, self.dest_port)
         ack_segment.ack = 1
         ack_segment.seq_num = seq_num
         ack_segment.ack_num = ack_num
+        if options is not None:
+            ack_segment.options = options
         return ack_segment
 
     def create_psh_ack(self, seq_num, ack_num, data):
@@ -206,4 +338,3 @@ class TCPSegmentFactory:
         fin_segment.seq_num = seq_num
         fin_segment.ack_num = ack_num
         return fin_segment
-禾
\ No newline at end of file
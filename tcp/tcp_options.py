@@ -0,0 +1,126 @@
+from segment import OPTION_MSS, OPTION_WINDOW_SCALE, OPTION_SACK_PERMITTED, OPTION_TIMESTAMPS, \
+    get_option, has_option
+
+# the mss we advertise, an Ethernet MTU minus the ip and tcp headers
+MSS = 1460
+# mss assumed when the peer does not send one, see RFC 9293
+DEFAULT_MSS = 536
+# shift of the windows we advertise, windows up to 65535 << 7 bytes (8 MB) can be
+# advertised, see RFC 7323
+WINDOW_SCALE = 7
+MAX_WINDOW_SCALE = 14
+MAX_WINDOW = 65535
+# bytes the timestamps option takes in every segment, with its padding
+TIMESTAMPS_LENGTH = 12
+# sack blocks which fit in the options field with and without timestamps
+MAX_SACK_BLOCKS_WITH_TIMESTAMPS = 3
+MAX_SACK_BLOCKS = 4
+
+
+class TCPOptions:
+    def __init__(self, mss=MSS, window_scale=WINDOW_SCALE, sack=True, timestamps=True):
+        '''
+        the options of a connection, offered in the syn and agreed on with the syn-ack
+
+        mss            : the mss we advertise
+        send_mss       : most data we put in one segment, the mss of the peer minus
+                         the room taken by the options of every segment
+        snd_wscale     : shift of the windows advertised by the peer
+        rcv_wscale     : shift of the windows we advertise, 0 if the peer does not scale
+        sack_permitted : the peer accepts sack blocks
+        timestamps     : both sides put timestamps in every segment
+        ts_recent      : latest timestamp of the peer, echoed in our segments
+        ts_echo        : our timestamp echoed in the last segment of the peer, 0 if none
+        '''
+        self.mss = mss
+        self.window_scale = window_scale
+        self.offer_sack = sack
+        self.offer_timestamps = timestamps
+        self.send_mss = DEFAULT_MSS
+        self.snd_wscale = 0
+        self.rcv_wscale = 0
+        self.sack_permitted = False
+        self.timestamps = False
+        self.ts_recent = 0
+        self.ts_echo = 0
+
+    def syn_options(self, now):
+        options = [(OPTION_MSS, self.mss)]
+        if self.offer_sack:
+            options.append((OPTION_SACK_PERMITTED, None))
+        if self.offer_timestamps:
+            options.append((OPTION_TIMESTAMPS, (timestamp(now), 0)))
+        if self.window_scale is not None:
+            options.append((OPTION_WINDOW_SCALE, self.window_scale))
+        return options
+
+    # take the options of the syn-ack, an option is only used if both sides sent it
+    def negotiate(self, syn_ack_segment):
+        options = syn_ack_segment.options
+        self.send_mss = min(self.mss, get_option(options, OPTION_MSS, DEFAULT_MSS))
+        self.sack_permitted = self.offer_sack and has_option(options, OPTION_SACK_PERMITTED)
+        peer_window_scale = get_option(options, OPTION_WINDOW_SCALE)
+        if self.window_scale is not None and peer_window_scale is not None:
+            self.snd_wscale = min(peer_window_scale, MAX_WINDOW_SCALE)
+            self.rcv_wscale = self.window_scale
+        peer_timestamps = get_option(options, OPTION_TIMESTAMPS)
+        if self.offer_timestamps and peer_timestamps is not None:
+            self.timestamps = True
+            self.ts_recent = peer_timestamps[0]
+            self.send_mss -= TIMESTAMPS_LENGTH
+
+    # the window of the peer in bytes, the window of a syn is never scaled
+    def peer_window(self, segment):
+        if segment.syn:
+            return segment.window_size
+        return segment.window_size << self.snd_wscale
+
+    # the window field for receive_window bytes of free space
+    def advertised_window(self, receive_window, syn=False):
+        if syn:
+            return min(receive_window, MAX_WINDOW)
+        return min(receive_window >> self.rcv_wscale, MAX_WINDOW)
+
+    def max_sack_blocks(self):
+        return MAX_SACK_BLOCKS_WITH_TIMESTAMPS if self.timestamps else MAX_SACK_BLOCKS
+
+    # keep the timestamp of a segment which is not beyond the data we expect, so that
+    # the oldest unacked segment of the peer is the one timed, see RFC 7323 4.3
+    def on_segment(self, segment, ack_num):
+        if not self.timestamps:
+            return
+        peer_timestamps = get_option(segment.options, OPTION_TIMESTAMPS)
+        if peer_timestamps is None:
+            self.ts_echo = 0
+            return
+        ts_value, self.ts_echo = peer_timestamps
+        if segment.seq_num <= ack_num and (ts_value - self.ts_recent) & 0xffffffff < 0x80000000:
+            self.ts_recent = ts_value
+
+    # the round trip time given by the echoed timestamp of the last segment, None if
+    # it has none, the echo is valid for retransmitted segments as well
+    def echo_rtt(self, now):
+        if not self.timestamps or self.ts_echo == 0:
+            return None
+        return ((timestamp(now) - self.ts_echo) & 0xffffffff) / 1000.0
+
+    # put our timestamp in a segment, replacing the one of an earlier transmission
+    def add_timestamp(self, segment, now):
+        if not self.timestamps:
+            return
+        options = [option for option in segment.options if option[0] != OPTION_TIMESTAMPS]
+        options.insert(0, (OPTION_TIMESTAMPS, (timestamp(now), self.ts_recent)))
+        segment.options = options
+
+
+# the smallest shift which lets a window of buffer_size bytes be advertised
+def window_scale_for(buffer_size):
+    shift = 0
+    while MAX_WINDOW << shift < buffer_size and shift < MAX_WINDOW_SCALE:
+        shift += 1
+    return shift
+
+
+# the timestamp clock ticks every millisecond, 0 is skipped as it means no echo
+def timestamp(now):
+    return int(now * 1000) & 0xffffffff or 1
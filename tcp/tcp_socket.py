@@ -1,39 +1,100 @@
 import sys
 from utils import *
-from segment import TCPSegmentFactory, assemble, dissemble
+from segment import TCPSegmentFactory, OPTION_SACK
+from tcp_options import TCPOptions, MSS, window_scale_for
+from receive_buffer import ReceiveBuffer, DEFAULT_RECEIVE_BUFFER_LIMIT
+from delayed_ack import DelayedAck, DELAYED_ACK_TIMEOUT, ACK_EVERY
+from reassembly import ReassemblyQueue
+from congestion import create_congestion_control, DEFAULT_CONGESTION_CONTROL
+from rto import RTOEstimator, InFlightSegment, MIN_RTO, MAX_RTO
 from ip.ip_socket import IPSocket
+from network_context import get_network_context
+from dns_resolver import get_resolver
 from socket_logger import debug_log, error_log
 from io import BytesIO
 from collections import deque, OrderedDict
 
-MSS = 1460
-MAX_CWND = 1000
 MAX_TIMEOUT = 60
+# the syn and the fin are sent at most this many times
+MAX_SYN_RETRIES = 6
+# the connection is given up after this many timeouts in a row
+MAX_RETRANSMISSIONS = 8
+# duplicate acks which trigger a fast retransmit
+DUP_ACK_THRESHOLD = 3
 
 
 class TCPSocket:
-    def __init__(self, host):
+    def __init__(self, host, zero_copy=False, rx_ring=False, engine=None,
+                 congestion_control=DEFAULT_CONGESTION_CONTROL, min_rto=MIN_RTO, max_rto=MAX_RTO,
+                 ack_delay=DELAYED_ACK_TIMEOUT, ack_every=ACK_EVERY, coalesce_acks=True,
+                 receive_buffer_limit=DEFAULT_RECEIVE_BUFFER_LIMIT):
         # init source ip, destination ip, source port and destination port
-        self.src_ip = get_local_ip()
-        self.dest_ip = get_remote_ip_by_host(host)
+        self.src_ip = get_network_context().local_ip
+        self.dest_ip = get_resolver().resolve(host)
         self.src_port = get_free_port()
         self.dest_port = 80
-        # create an ip socket
-        self.ip_socket = IPSocket(self.src_ip, self.dest_ip)
+        # create an ip socket, or a channel of a packet engine shared with other connections
+        self.engine = engine
+        if engine is not None:
+            self.ip_socket = engine.open_channel(self.dest_ip)
+        else:
+            self.ip_socket = IPSocket(self.src_ip, self.dest_ip, zero_copy, rx_ring)
+        # timers and waiting for segments are driven by the shared event loop
+        self.event_loop = self.ip_socket.event_loop
+        # drop the frames of other connections in the kernel, the checks in
+        # _receive_segment stay as a safety net
+        self.ip_socket.allow_connection(self.src_port, self.dest_port)
         # a segment factory, used to create segments
         self.segment_factory = TCPSegmentFactory(self.src_ip, self.src_port,
                                                  self.dest_ip, self.dest_port)
+        # the ethernet, ip and tcp headers of this connection, only the changing fields
+        # are patched into it when sending a segment
+        self.frame_template = self.ip_socket.create_frame_template(self.src_port, self.dest_port)
         # save received ordered data into the data holder, from which the application layer can read
         self.data_holder = BytesIO()
-        # initial sequence number and acknowledge number should be 0
+        # if set, ordered data is passed to it instead of the data holder
+        self.data_handler = None
+        # if set, all received data is placed by its offset in the stream, see set_stream_placer
+        self.stream_placer = None
+        self.data_start_seq = 0
+        # out-of-order data by its offset from data_start_seq, reported to the server
+        # in sack blocks if it has agreed to them in its syn
+        self.out_of_order = ReassemblyQueue()
+        # acks of in-order data are delayed and coalesced, see tcp.delayed_ack
+        self.delayed_ack = DelayedAck(ack_delay, ack_every, coalesce_acks)
+        # initial sequence number and acknowledge number should be 0,
+        # seq_num is the oldest unacked sequence number and snd_nxt the next one to send
         self.seq_num = 0
+        self.snd_nxt = 0
         self.ack_num = 0
 
-        # initial advertised window size
+        # initial advertised window size, and whether the last segment changed it,
+        # an ack that updates the window is not a duplicate ack
         self.awnd = 0
-        # initial congestion window size
-        self.cwnd = 1
+        self.window_changed = False
+        # mss, window scaling, sack and timestamps, offered in the syn and agreed on
+        # with the server, see tcp.tcp_options
+        self.tcp_options = TCPOptions(window_scale=window_scale_for(receive_buffer_limit))
+        # the advertised window is the free space of the receive buffer, which grows
+        # with the delivery rate up to receive_buffer_limit, see tcp.receive_buffer
+        self.receive_buffer = ReceiveBuffer(receive_buffer_limit)
+        # the congestion window, see tcp.congestion for the algorithms, it is created
+        # again with the mss of the server once the connection is established
+        self.congestion_control = congestion_control
+        self.congestion = create_congestion_control(congestion_control, MSS)
+        # duplicate acks in a row, and the highest sequence number sent when the
+        # current fast recovery started
+        self.dup_acks = 0
+        self.recover = None
 
+        # the retransmission timeout follows the measured round trip times, see RFC 6298,
+        # the data sent again after a timeout ends at retransmit_end, its acks cannot be timed
+        self.rto_estimator = RTOEstimator(min_rto, max_rto)
+        self.retransmit_end = 0
+        self.retransmissions = 0
+
+        # InFlightSegments of the sent data keyed by the ack number which acks them,
+        # in sending order
         self.unacked_segments = OrderedDict()
         self.sender_queue = deque()
 
@@ -47,15 +108,9 @@ class TCPSocket:
         self._partition_data(data)
 
         # send all segments in queue until all have been acked
-        while len(self.sender_queue) != 0:
+        while len(self.sender_queue) != 0 or len(self.unacked_segments) != 0:
             self._send_data_in_queue()
             self._receive_acks_for_sent()
-            # if there are segments that receive no ack, set the congestion window to 1
-            if len(self.unacked_segments) != 0:
-                self.cwnd = 1
-                # reappend unacked_segments into the sender queue
-                for unacked_seq_num, data_segment in self.unacked_segments.items():
-                    self.sender_queue.appendleft(data_segment)
 
         self._receive_data_and_send_ack()
         # after receiving all data, set the pointer to the start
@@ -64,24 +119,35 @@ class TCPSocket:
     # three-way handshake
     def _connect(self):
         debug_log("start three-way handshake")
-        syn_segment = self.segment_factory.create_syn()
+        syn_segment = self.segment_factory.create_syn(
+            self.tcp_options.syn_options(self.event_loop.time()))
         self.seq_num = syn_segment.seq_num
         debug_log("send syn to server")
 
-        # send syn to the server, resend if timeout
-        self._send_segment(syn_segment)
-        try:
-            ack_syn_segment = self._receive_ack(1, 0)
-        except TimeoutError:
+        # send syn to the server, resend with a doubled timeout on each timeout
+        ack_syn_segment = None
+        for attempt in range(MAX_SYN_RETRIES):
+            sent_time = self.event_loop.time()
             self._send_segment(syn_segment)
             try:
-                ack_syn_segment = self._receive_ack(1, 0)
+                ack_syn_segment = self._receive_ack(
+                    1, 0, deadline=sent_time + self.rto_estimator.rto())
             except TimeoutError:
-                # exit the program if still timeout
-                sys.exit(-1)
-                error_log("failed to create a TCP connection")
+                self.rto_estimator.on_timeout()
+                continue
+            # a retransmitted syn gives no sample, its ack may be for either syn
+            if attempt == 0:
+                self.rto_estimator.on_sample(self.event_loop.time() - sent_time)
+            break
+        if ack_syn_segment is None:
+            # exit the program if still timeout
+            error_log("failed to create a TCP connection")
+            sys.exit(-1)
 
         debug_log("receive ack syn from server")
+        self.tcp_options.negotiate(ack_syn_segment)
+        self.congestion = create_congestion_control(self.congestion_control,
+                                                    self.tcp_options.send_mss)
         # add 1 to the sequence number
         self.seq_num += 1
         # set the ack number
@@ -89,22 +155,24 @@ class TCPSocket:
         ack_segment = self.segment_factory.create_ack(self.seq_num,
                                                       self.ack_num)
         self._send_segment(ack_segment)
+        self.snd_nxt = self.seq_num
         debug_log("send ack to server")
         debug_log("complete three-way handshake")
 
-    # partition data if it cannot be sent in a single segment
+    # partition data if it cannot be sent in a single segment of the negotiated mss
     def _partition_data(self, data):
+        mss = self.tcp_options.send_mss
         seg_seq_num = self.seq_num
         total_len = len(data)
         remain_len = total_len
         start_index = 0
-        while remain_len > MSS:
-            partitioned_data = data[start_index: start_index + MSS]
+        while remain_len > mss:
+            partitioned_data = data[start_index: start_index + mss]
             debug_log("partition data: " + partitioned_data + ", seq_num: " + str(seg_seq_num))
             partitioned_data_seg = self.segment_factory.create_psh_ack(seg_seq_num, self.ack_num, partitioned_data)
-            seg_seq_num += MSS
-            start_index += MSS
-            remain_len -= MSS
+            seg_seq_num += mss
+            start_index += mss
+            remain_len -= mss
             # add the segment into the sender queue
             self.sender_queue.append(partitioned_data_seg)
         # add the last segment
@@ -112,153 +180,396 @@ class TCPSocket:
         last_data_seg = self.segment_factory.create_psh_ack(seg_seq_num, self.ack_num, last_data)
         self.sender_queue.append(last_data_seg)
 
-    # send the segments in the queue (the max number of segments that can be sent should be restricted by the window size)
+    # send the segments in the queue (the bytes in flight are restricted by the window)
     def _send_data_in_queue(self):
         # window size should be min(cwnd, awnd)
-        wnd_size = min(self.cwnd * MSS, self.awnd)
-        while wnd_size > 0 and len(self.sender_queue) > 0:
-            data_segment = self.sender_queue.popleft()
-            if len(data_segment.data) < wnd_size:
-                debug_log("send request data to the server, sequence number: " + str(self.seq_num))
-                self._send_segment(data_segment)
-                expected_ack_num = self.seq_num + len(data_segment.data)
-                self.unacked_segments[expected_ack_num] = data_segment
-                wnd_size -= len(data_segment.data)
-            else:
-                self.sender_queue.appendleft(data_segment)
+        wnd_size = min(self.congestion.window(), self.awnd)
+        now = self.event_loop.time()
+        rto = self.rto_estimator.rto()
+        while len(self.sender_queue) > 0:
+            data_segment = self.sender_queue[0]
+            # one segment may always be in flight, so that a small window cannot stall
+            if len(self.unacked_segments) != 0 and \
+                    self.snd_nxt - self.seq_num + len(data_segment.data) > wnd_size:
                 break
+            self.sender_queue.popleft()
+            debug_log("send request data to the server, sequence number: " + str(data_segment.seq_num))
+            self._send_segment(data_segment, batch=True)
+            self.snd_nxt = data_segment.seq_num + len(data_segment.data)
+            self.unacked_segments[self.snd_nxt] = InFlightSegment(
+                data_segment, now, rto, retransmitted=self.snd_nxt <= self.retransmit_end)
+        # send the whole window in one batch
+        self.ip_socket.flush()
 
-    # receive the acks for all sent segments
+    # wait for the next ack of the sent segments until the oldest one expires,
+    # send everything in flight again on a timeout
     def _receive_acks_for_sent(self):
-        for i in range(len(self.unacked_segments)):
-            try:
-                ack_seg = self._receive_ack(0, 0)
-                # receive a new ack for one of the segments
-                if ack_seg.ack_num in self.unacked_segments:
-                    acked_segment = self.unacked_segments[ack_seg.ack_num]
-                    if ack_seg.ack_num - self.seq_num == len(acked_segment.data):
-                        self.seq_num += len(acked_segment.data)
-                    # can safely remove it now
-                    del self.unacked_segments[ack_seg.ack_num]
-            except TimeoutError:
-                return
+        if len(self.unacked_segments) == 0:
+            return
+        oldest = next(self.unacked_segments.itervalues())
+        try:
+            ack_segment = self._receive_ack(0, 0, deadline=oldest.deadline)
+        except TimeoutError:
+            self.retransmissions += 1
+            if self.retransmissions > MAX_RETRANSMISSIONS:
+                error_log("too many retransmissions, dead connection!")
+                sys.exit(-1)
+            self.rto_estimator.on_timeout()
+            debug_log("timeout when waiting for acks, send the unacked segments again, "
+                      "rto is %.3fs" % self.rto_estimator.rto())
+            self.congestion.on_timeout(self.snd_nxt - self.seq_num, self.event_loop.time())
+            self.recover = None
+            self.dup_acks = 0
+            # everything in flight is taken as lost and sent again as the window opens
+            for in_flight in reversed(self.unacked_segments.values()):
+                in_flight.segment.ack_num = self.ack_num
+                self.sender_queue.appendleft(in_flight.segment)
+            self.unacked_segments.clear()
+            self.retransmit_end = max(self.retransmit_end, self.snd_nxt)
+            self.snd_nxt = self.seq_num
+            return
+        self._handle_ack(ack_segment)
+
+    def _handle_ack(self, ack_segment):
+        ack_num = ack_segment.ack_num
+        if ack_num == self.seq_num:
+            # see RFC 5681, a duplicate ack carries no data and no fin, leaves the
+            # window unchanged, and arrives while data is outstanding
+            if len(ack_segment.data) == 0 and not ack_segment.fin \
+                    and not self.window_changed and self.seq_num != self.snd_nxt:
+                self._handle_dup_ack()
+            return
+        if ack_num < self.seq_num or ack_num > self.snd_nxt:
+            return
+        acked_bytes = ack_num - self.seq_num
+        self.seq_num = ack_num
+        self.dup_acks = 0
+        self.retransmissions = 0
+        # can safely remove the acked segments now
+        now = self.event_loop.time()
+        newest_acked = None
+        retransmitted = False
+        for expected_ack_num in list(self.unacked_segments):
+            if expected_ack_num > ack_num:
+                break
+            newest_acked = self.unacked_segments.pop(expected_ack_num)
+            retransmitted = retransmitted or newest_acked.retransmitted
+        # the echoed timestamp times retransmissions as well, without timestamps an ack
+        # covering a retransmission cannot be timed (Karn's rule)
+        echo_rtt = self.tcp_options.echo_rtt(now)
+        if echo_rtt is not None:
+            self.rto_estimator.on_sample(echo_rtt)
+        elif newest_acked is not None and not retransmitted:
+            self.rto_estimator.on_sample(now - newest_acked.sent_time)
+        # the oldest segment gets a full timeout from now on, see RFC 6298 5.3
+        if len(self.unacked_segments) != 0:
+            oldest = next(self.unacked_segments.itervalues())
+            oldest.deadline = max(oldest.deadline, now + self.rto_estimator.rto())
+        if self.recover is None:
+            self.congestion.on_ack(acked_bytes, self.event_loop.time())
+        elif ack_num >= self.recover:
+            debug_log("leave fast recovery")
+            self.recover = None
+            self.congestion.on_recovery_exit()
+        else:
+            # the next hole is known to be lost as well, see RFC 6582
+            self.congestion.on_partial_ack(acked_bytes)
+            self._retransmit_oldest()
+
+    def _handle_dup_ack(self):
+        self.dup_acks += 1
+        if self.recover is not None:
+            self.congestion.on_recovery_dup_ack()
+        elif self.dup_acks == DUP_ACK_THRESHOLD:
+            debug_log("fast retransmit at " + str(self.seq_num))
+            self.recover = self.snd_nxt
+            self.congestion.on_fast_retransmit(self.snd_nxt - self.seq_num, self.event_loop.time())
+            # only the lost segment is sent again
+            self._retransmit_oldest()
+
+    def _retransmit_oldest(self):
+        if len(self.unacked_segments) != 0:
+            oldest = next(self.unacked_segments.itervalues())
+            oldest.segment.ack_num = self.ack_num
+            self._send_segment(oldest.segment)
+            oldest.resent(self.event_loop.time(), self.rto_estimator.rto())
 
     # when trying to receive ack, throw a timeout error if no ack received for 60 seconds
-    @timeout(MAX_TIMEOUT, "timeout happends when tcp receives ack")
-    def _receive_ack(self, syn_flag, fin_flag):
+    # or before the deadline if it is given
+    def _receive_ack(self, syn_flag, fin_flag, timeout=MAX_TIMEOUT, deadline=None):
+        if deadline is None:
+            deadline = self.event_loop.time() + timeout
         while True:
-            received_segment = self._receive_segment()
+            received_segment = self._receive_segment(deadline)
             if received_segment.syn == syn_flag and received_segment.fin == fin_flag:
                 break
-        # after receiving an ack, add 1 to the congestion window size if it's less than 1000
-        if self.cwnd < MAX_CWND:
-            self.cwnd += 1
         return received_segment
 
     # receive data from the server and send ack back
     def _receive_data_and_send_ack(self):
         init_data_index = self.ack_num
-        unordered_data = dict()
+        self.data_start_seq = init_data_index
+        # index of a fin received after a hole
+        out_of_order_fin = None
         while True:
-            segment = self._receive_segment()
+            segment = self._receive_data_segment()
             data = segment.data
+            fin = segment.fin
             segment_index = segment.seq_num - init_data_index
             expected_index = self.ack_num - init_data_index
             # if the server sends fin and all data before has been received, break the auto ack mode
-            if segment.fin == 1 and segment_index == expected_index:
+            if fin == 1 and segment_index == expected_index:
                 if len(data) != 0:
                     self._handle_ordered_data(data)
-                # ack to fin
-                self.ack_num += 1
-                fin_ack_segment = self.segment_factory.create_fin_ack(
-                    self.seq_num,
-                    self.ack_num)
-                self._send_segment(fin_ack_segment)
-                debug_log("ack to fin")
-                if self._receive_segment().ack == 1:
-                    debug_log("successfully close the connection")
-                    self.connection_closed = True
+                if self._acknowledge_fin():
                     break
 
+            # a retransmission cut at other boundaries may go on after the expected index
+            if segment_index < expected_index < segment_index + len(data):
+                data = data[expected_index - segment_index:]
+                segment_index = expected_index
+            # the buffer has no room for data beyond the advertised window, drop it
+            window_end = self.receive_buffer.right_edge - init_data_index
+            if segment_index + len(data) > window_end >= expected_index:
+                debug_log("drop data beyond the receive window")
+                data = data[:max(window_end - segment_index, 0)]
+                fin = 0
+                if len(data) == 0:
+                    self._send_ack()
+                    continue
             # duplicate segment, drop it and ack (the ack number should be correct)
             if segment_index < expected_index:
                 debug_log("get duplicate segment")
-                ack_segment = self.segment_factory.create_ack(self.seq_num,
-                                                              segment_index + init_data_index)
-                self._send_segment(ack_segment)
+                self._send_ack()
                 continue
+            # in order or not, the placer puts the data straight at its place
+            elif self.stream_placer is not None:
+                self._place_data(segment_index, data)
+                if fin:
+                    out_of_order_fin = segment_index + len(data)
             # new ordered segment (handle it and all cached unordered data)
             elif segment_index == expected_index:
                 debug_log("get ordered segment")
                 self._handle_ordered_data(data)
-                self._handle_unordered_data(unordered_data)
-            # unordered data, cache it
+                self._handle_unordered_data()
+            # unordered data, cache it, the data is copied out of the received buffer
             else:
                 debug_log("get unordered segment")
-                unordered_data[segment_index] = segment.data
-            ack_segment = self.segment_factory.create_ack(self.seq_num,
-                                                          self.ack_num)
-            self._send_segment(ack_segment)
-
-    # handle all cached unordered data
-    def _handle_unordered_data(self, unordered_data):
-        for key in sorted(unordered_data):
-            # if all data before it has been acked, handle it as an ordered data
-            if key == self.ack_num:
-                data = unordered_data[key]
-                self._handle_ordered_data(data)
-            # all data after it should also be unordered, so break directly
-            elif key > self.data_holder.tell():
-                break
-            # duplicate data, delete
+                self.out_of_order.add(segment_index, data)
+                if fin:
+                    out_of_order_fin = segment_index + len(data)
+            # the hole before the fin has been filled
+            if out_of_order_fin is not None and self.ack_num - init_data_index == out_of_order_fin:
+                if self._acknowledge_fin():
+                    break
+                continue
+            if len(data) == 0 and not fin:
+                continue
+            # out-of-order data, filled gaps and fins are acked at once, so that the
+            # server learns about a hole quickly, the ack of in-order data is delayed
+            if fin or self.ack_num - init_data_index != expected_index + len(data):
+                self._send_ack()
             else:
-                del unordered_data[key]
+                self.delayed_ack.on_data(self.event_loop.time(),
+                                         len(data) >= self.tcp_options.send_mss)
+                if self.delayed_ack.ack_due() and not self.delayed_ack.coalesce:
+                    self._send_ack()
+        self.ip_socket.flush()
+
+    # receive the next segment of the server, the delayed ack is sent when it is due
+    # once the segments received so far are handled, or when its timer expires
+    def _receive_data_segment(self):
+        segment = self._receive_segment(wait=False)
+        while segment is None:
+            if self.delayed_ack.ack_due() and self.delayed_ack.ack_waiting():
+                self._send_ack()
+            try:
+                segment = self._receive_segment(self.delayed_ack.deadline)
+            except TimeoutError:
+                self._send_ack()
+        return segment
+
+    # acks of a burst of segments are sent together, the raw socket flushes them
+    # before it blocks on receiving
+    def _send_ack(self):
+        self._send_segment(self._create_ack(), batch=True)
+
+    # ack the fin of the server, return True once the server has acked our fin
+    def _acknowledge_fin(self):
+        self.ack_num += 1
+        fin_ack_segment = self.segment_factory.create_fin_ack(
+            self.seq_num,
+            self.ack_num)
+        debug_log("ack to fin")
+        # resend our fin with a doubled timeout on each timeout, the fin or its ack
+        # may be lost like any other segment
+        for attempt in range(MAX_SYN_RETRIES):
+            self._send_segment(fin_ack_segment)
+            try:
+                segment = self._receive_segment(
+                    self.event_loop.time() + self.rto_estimator.rto())
+            except TimeoutError:
+                self.rto_estimator.on_timeout()
+                continue
+            if segment.ack == 1:
+                debug_log("successfully close the connection")
+                self.connection_closed = True
+                return True
+            return False
+        # all data has been received, the server forgets the connection after its
+        # own retries
+        debug_log("no ack to our fin, close the connection anyway")
+        self.connection_closed = True
+        return True
+
+    # handle the cached unordered data which follows the ordered data now, the ranges
+    # are merged so it comes out in one piece up to the next hole
+    def _handle_unordered_data(self):
+        data = self.out_of_order.pop_from(self.ack_num - self.data_start_seq)
+        if data is not None:
+            self._handle_ordered_data(data)
+
+    # an ack with sack blocks for the data received after a hole
+    def _create_ack(self):
+        if not self.tcp_options.sack_permitted:
+            return self.segment_factory.create_ack(self.seq_num, self.ack_num)
+        max_blocks = self.tcp_options.max_sack_blocks()
+        if self.stream_placer is not None:
+            ranges = [(start, end) for start, end in self.stream_placer.received.ranges()
+                      if start > 0][:max_blocks]
+        else:
+            ranges = self.out_of_order.sack_ranges(max_blocks)
+        if not ranges:
+            return self.segment_factory.create_ack(self.seq_num, self.ack_num)
+        blocks = [(self.data_start_seq + start, self.data_start_seq + end) for start, end in ranges]
+        return self.segment_factory.create_ack(self.seq_num, self.ack_num,
+                                               [(OPTION_SACK, blocks)])
 
     # handle ordered data
     def _handle_ordered_data(self, ordered_data):
-        self.data_holder.write(ordered_data)
+        if self.stream_placer is not None:
+            self._place_data(self.ack_num - self.data_start_seq, ordered_data)
+            return
+        if self.data_handler is not None:
+            self.data_handler(_to_bytes(ordered_data))
+        else:
+            self.data_holder.write(ordered_data)
         self.ack_num += len(ordered_data)
+        self._on_data_delivered(len(ordered_data))
+
+    # the ack number covers all data the placer has received without a gap
+    def _place_data(self, stream_offset, data):
+        self.stream_placer.place(stream_offset, _to_bytes(data))
+        ack_num = self.data_start_seq + self.stream_placer.contiguous_length()
+        if ack_num > self.ack_num:
+            delivered = ack_num - self.ack_num
+            self.ack_num = ack_num
+            self._on_data_delivered(delivered)
+
+    # the application takes the data as soon as it is in order, the data holder
+    # belongs to it as well as it can only be read once the response is complete,
+    # the receive buffer grows with the rate the data comes in at
+    def _on_data_delivered(self, length):
+        now = self.event_loop.time()
+        self.receive_buffer.measure_rtt(self.ack_num, now, self.tcp_options.echo_rtt(now))
+        self.receive_buffer.on_received(length)
+        self.receive_buffer.on_consumed(length, now)
+
+    # stream the received data to handler instead of keeping all of it in memory
+    def set_data_handler(self, handler):
+        self.data_handler = handler
+
+    # pass every received payload to placer.place(stream_offset, data) as soon as it
+    # arrives, in order or not, instead of caching the out-of-order data here, the
+    # placer reports how much of the stream it has without a gap by contiguous_length()
+    def set_stream_placer(self, placer):
+        self.stream_placer = placer
 
     def receive(self, bufsize=4096):
         return self.data_holder.read(bufsize)
 
     # close the connection
     def close(self):
+        closed = self._close_connection()
+        # close the raw socket, or give the connection up on the shared engine,
+        # instead of leaving the raw socket to the garbage collector
+        self.ip_socket.close()
+        return closed
+
+    def _close_connection(self):
         if not self.connection_closed:
             fin_segment = self.segment_factory.create_fin(self.seq_num,
                                                           self.ack_num)
-            # send fin to the server, resend if timeout
-            self._send_segment(fin_segment)
-            try:
-                ack_fin_segment = self._receive_ack(0, 1)
-            except TimeoutError:
+            # send fin to the server, resend with a doubled timeout on each timeout
+            ack_fin_segment = None
+            for attempt in range(MAX_SYN_RETRIES):
                 self._send_segment(fin_segment)
                 try:
-                    ack_fin_segment = self._receive_ack(0, 1)
+                    ack_fin_segment = self._receive_ack(
+                        0, 1, deadline=self.event_loop.time() + self.rto_estimator.rto())
+                    break
                 except TimeoutError:
-                    # return False if still timeout
-                    return False
-
-                debug_log("receive ack fin from server")
-                self.seq_num += 1
-                self.ack_num += 1
-                ack_segment = self.segment_factory.create_ack(self.seq_num,
-                                                              self.ack_num)
-                self._send_segment(ack_segment)
-                debug_log("send ack to server")
-                debug_log("complete connection teardown")
+                    self.rto_estimator.on_timeout()
+            if ack_fin_segment is None:
+                # return False if still timeout
+                return False
+
+            debug_log("receive ack fin from server")
+            self.seq_num += 1
+            self.ack_num += 1
+            ack_segment = self.segment_factory.create_ack(self.seq_num,
+                                                          self.ack_num)
+            self._send_segment(ack_segment)
+            debug_log("send ack to server")
+            debug_log("complete connection teardown")
 
         return True
 
-    def _send_segment(self, segment):
-        self.ip_socket.send(assemble(segment))
+    # batched segments are queued until the ip socket is flushed
+    def _send_segment(self, segment, batch=False):
+        segment.window_size = self.tcp_options.advertised_window(
+            self._receive_window(segment.syn), segment.syn)
+        # any segment with the current ack number acks what the delayed ack waits for
+        if segment.ack and segment.ack_num == self.ack_num:
+            self.delayed_ack.on_ack_sent()
+        self.tcp_options.add_timestamp(segment, self.event_loop.time())
+        frame = self.frame_template.assemble(segment)
+        if batch:
+            self.ip_socket.queue_frame(frame)
+        else:
+            self.ip_socket.send_frame(frame)
+
+    # the free space of the receive buffer, out-of-order data takes room in it
+    def _receive_window(self, syn):
+        return self.receive_buffer.window(None if syn else self.ack_num,
+                                          self.out_of_order.byte_count, self.tcp_options.mss)
 
-    def _receive_segment(self):
+    # raise TimeoutError if no segment is received before the deadline, return None
+    # instead of waiting if wait is False and no segment has been received yet
+    def _receive_segment(self, deadline=None, wait=True):
+        # the previous segment has been consumed, give its buffer back
+        self.ip_socket.recycle()
         while True:
-            tcp_segment = dissemble(self.ip_socket.receive(), self.dest_ip,
-                                    self.src_ip)
+            if wait:
+                tcp_segment = self.ip_socket.receive_segment(deadline)
+            else:
+                tcp_segment = self.ip_socket.receive_segment_nowait()
+                if tcp_segment is None:
+                    return None
             if tcp_segment is not None and tcp_segment.src_port == self.dest_port \
-                    and tcp_segment.dest_port == self.src_port:
+                    and tcp_segment.dest_port == self.src_port \
+                    and tcp_segment.src_ip == self.dest_ip and tcp_segment.dest_ip == self.src_ip:
                 # set advertised window size whenever receiving a new segment
-                self.awnd = tcp_segment.window_size
+                peer_window = self.tcp_options.peer_window(tcp_segment)
+                self.window_changed = peer_window != self.awnd
+                self.awnd = peer_window
+                self.tcp_options.on_segment(tcp_segment, self.ack_num)
                 return tcp_segment
+            self.ip_socket.recycle()
+
+
+# copy the data out of a received buffer if it is a view on it
+def _to_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
@@ -0,0 +1,540 @@
+import socket
+from collections import deque
+from utils import get_free_port, TimeoutError
+from segment import TCPSegmentFactory, OPTION_SACK
+from reassembly import ReassemblyQueue
+from tcp_options import TCPOptions, MSS, window_scale_for
+from delayed_ack import DelayedAck, DELAYED_ACK_TIMEOUT, ACK_EVERY
+from receive_buffer import ReceiveBuffer, DEFAULT_RECEIVE_BUFFER_LIMIT
+from tcp_socket import _to_bytes
+from congestion import create_congestion_control, DEFAULT_CONGESTION_CONTROL
+from rto import RTOEstimator, InFlightSegment, MIN_RTO, MAX_RTO
+from ip.ip_socket import IPSocket
+from network_context import get_network_context
+from dns_resolver import get_resolver
+from event_loop import get_event_loop
+from socket_logger import debug_log, error_log
+
+# connection states
+SYN_SENT = "SYN_SENT"
+ESTABLISHED = "ESTABLISHED"
+# we have sent a fin, waiting for the fin of the server
+FIN_WAIT = "FIN_WAIT"
+# the server has sent a fin, waiting for the ack of our fin
+LAST_ACK = "LAST_ACK"
+CLOSED = "CLOSED"
+
+MAX_RETRANSMISSIONS = 8
+# duplicate acks which trigger a fast retransmit
+DUP_ACK_THRESHOLD = 3
+
+
+# open a tcp connection driven by the event loop and return its transport,
+# protocol_factory is called without arguments to create the protocol
+def create_connection(protocol_factory, host, port=80, loop=None, engine=None,
+                      congestion_control=DEFAULT_CONGESTION_CONTROL, min_rto=MIN_RTO,
+                      max_rto=MAX_RTO, ack_delay=DELAYED_ACK_TIMEOUT, ack_every=ACK_EVERY,
+                      coalesce_acks=True, receive_buffer_limit=DEFAULT_RECEIVE_BUFFER_LIMIT):
+    transport = TCPTransport(host, port, protocol_factory(), loop, engine, congestion_control,
+                             min_rto, max_rto, ack_delay, ack_every, coalesce_acks,
+                             receive_buffer_limit)
+    transport.connect()
+    return transport
+
+
+class StreamProtocol:
+    # called once the three-way handshake has completed
+    def connection_made(self, transport):
+        pass
+
+    # called with the data received in order, the protocol can hold the data back
+    # with transport.pause_reading() while it cannot take more
+    def data_received(self, data):
+        pass
+
+    # called when the server has sent a fin
+    def eof_received(self):
+        pass
+
+    # called when the connection is closed, exc is None if it was closed normally
+    def connection_lost(self, exc):
+        pass
+
+
+class TCPTransport:
+    def __init__(self, host, port, protocol, loop=None, engine=None,
+                 congestion_control=DEFAULT_CONGESTION_CONTROL, min_rto=MIN_RTO, max_rto=MAX_RTO,
+                 ack_delay=DELAYED_ACK_TIMEOUT, ack_every=ACK_EVERY, coalesce_acks=True,
+                 receive_buffer_limit=DEFAULT_RECEIVE_BUFFER_LIMIT):
+        '''
+        a non-blocking tcp connection, segments are handled when the raw socket
+        becomes readable and retransmissions are scheduled on the event loop
+
+        protocol          : receives the events of the connection
+        ip_socket         : an IPSocket, or a channel of the given packet engine
+        snd_una           : oldest sequence number which has not been acked
+        snd_nxt           : sequence number of the next new segment
+        ack_num           : next sequence number expected from the server
+        awnd              : window advertised by the server
+        send_buffer       : data waiting for window space, cut into segments of the
+                            negotiated mss when it is sent
+        unacked_segments  : InFlightSegments of the sent data, oldest first
+        out_of_order      : out-of-order data by sequence number, merged into ranges
+        out_of_order_fin  : sequence number of a fin received after a hole
+        tcp_options       : mss, window scaling, sack and timestamps agreed on in the
+                            handshake, see tcp.tcp_options
+        receive_buffer    : its free space is the advertised window, it grows with the
+                            rate the protocol takes the data at, see tcp.receive_buffer
+        reading_paused    : the protocol takes no data, see pause_reading
+        unread_data       : in-order data held while reading is paused
+        eof_delivered     : the fin of the server has been passed to the protocol
+        delayed_ack       : decides when in-order data is acked, see tcp.delayed_ack
+        ack_timer         : sends the delayed ack, ack_deadline is when it expires
+        fin_seq           : sequence number of our fin once it is sent
+        congestion        : grows and reduces the congestion window, see tcp.congestion
+        dup_acks          : duplicate acks received in a row
+        recover           : highest sequence number sent when a fast recovery started,
+                            None outside of a fast recovery
+        rto_estimator     : derives the retransmission timeout from the rtt samples
+        retransmit_end    : the data sent again after a timeout ends here, its acks
+                            are no rtt samples
+        syn_time          : when the syn was sent
+        '''
+        self.loop = loop if loop is not None else get_event_loop()
+        self.protocol = protocol
+        self.src_ip = get_network_context().local_ip
+        self.dest_ip = get_resolver().resolve(host)
+        self.src_port = get_free_port()
+        self.dest_port = port
+        if engine is not None:
+            self.ip_socket = engine.open_channel(self.dest_ip)
+        else:
+            self.ip_socket = IPSocket(self.src_ip, self.dest_ip)
+        self.ip_socket.allow_connection(self.src_port, self.dest_port)
+        self.segment_factory = TCPSegmentFactory(self.src_ip, self.src_port,
+                                                 self.dest_ip, self.dest_port)
+        self.frame_template = self.ip_socket.create_frame_template(self.src_port, self.dest_port)
+
+        self.state = CLOSED
+        self.snd_una = 0
+        self.snd_nxt = 0
+        self.ack_num = 0
+        self.awnd = MSS
+        self.send_buffer = deque()
+        self.unacked_segments = deque()
+        self.out_of_order = ReassemblyQueue()
+        self.out_of_order_fin = None
+        self.tcp_options = TCPOptions(window_scale=window_scale_for(receive_buffer_limit))
+        self.receive_buffer = ReceiveBuffer(receive_buffer_limit)
+        self.reading_paused = False
+        self.unread_data = deque()
+        self.eof_delivered = False
+        self.delayed_ack = DelayedAck(ack_delay, ack_every, coalesce_acks)
+        self.ack_timer = None
+        self.ack_deadline = None
+        self.fin_seq = None
+        self.fin_received = False
+        self.closing = False
+        self.congestion_control = congestion_control
+        self.congestion = create_congestion_control(congestion_control, MSS)
+        self.dup_acks = 0
+        self.recover = None
+
+        self.rto_estimator = RTOEstimator(min_rto, max_rto)
+        self.retransmit_end = 0
+        self.syn_time = None
+        self.retransmissions = 0
+        self.retransmit_timer = None
+
+    def connect(self):
+        syn_segment = self.segment_factory.create_syn(
+            self.tcp_options.syn_options(self.loop.time()))
+        self.snd_una = syn_segment.seq_num
+        self.snd_nxt = syn_segment.seq_num + 1
+        self.state = SYN_SENT
+        self.ip_socket.start_reading(self._on_segment)
+        debug_log("send syn to server")
+        self._send_segment(syn_segment)
+        self.syn_time = self.loop.time()
+        self._start_retransmit_timer()
+
+    # queue data to be sent, it is sent as soon as the window allows
+    def write(self, data):
+        if self.closing or self.state == CLOSED:
+            error_log("cannot write to a closing connection")
+            return
+        # the mss of the server is only known once the connection is established, the
+        # pieces are cut again when they are sent if they are longer
+        mss = self.tcp_options.send_mss if self.state == ESTABLISHED else MSS
+        for start_index in range(0, len(data), mss):
+            self.send_buffer.append(data[start_index: start_index + mss])
+        if self.state == ESTABLISHED:
+            self._send_pending()
+
+    # send a fin once all written data has been acked
+    def close(self):
+        self.closing = True
+        self._send_fin_if_done()
+
+    # drop the connection without a teardown
+    def abort(self):
+        self._finish(None)
+
+    def is_closing(self):
+        return self.closing or self.state == CLOSED
+
+    # hold the received data back from the protocol, it stays in the receive buffer
+    # and the advertised window closes as the buffer fills up
+    def pause_reading(self):
+        self.reading_paused = True
+
+    # hand the held data to the protocol, the server learns about the freed space
+    # from a window update
+    def resume_reading(self):
+        if not self.reading_paused:
+            return
+        self.reading_paused = False
+        self._deliver_unread()
+        if self.state != CLOSED and self.receive_buffer.window_update_due(
+                self.ack_num, self.out_of_order.byte_count, self.tcp_options.mss):
+            debug_log("send window update")
+            self._send_ack()
+            self.ip_socket.flush()
+
+    # the acks sent while handling the segments of one wakeup go out together
+    def _on_segment(self, segment):
+        if self.state != CLOSED and segment.src_port == self.dest_port \
+                and segment.dest_port == self.src_port:
+            self._handle_segment(segment)
+
+    def _handle_segment(self, segment):
+        if segment.rst:
+            self._finish(socket.error("connection reset by the server"))
+            return
+        peer_window = self.tcp_options.peer_window(segment)
+        window_changed = peer_window != self.awnd
+        self.awnd = peer_window
+        self.tcp_options.on_segment(segment, self.ack_num)
+        if self.state == SYN_SENT:
+            if segment.syn and segment.ack and segment.ack_num == self.snd_nxt:
+                debug_log("receive ack syn from server")
+                self.snd_una = self.snd_nxt
+                self.ack_num = segment.seq_num + 1
+                self.tcp_options.negotiate(segment)
+                self.congestion = create_congestion_control(self.congestion_control,
+                                                            self.tcp_options.send_mss)
+                self.state = ESTABLISHED
+                # a retransmitted syn gives no sample, its ack may be for either syn
+                if self.retransmissions == 0:
+                    self.rto_estimator.on_sample(self.loop.time() - self.syn_time)
+                self.retransmissions = 0
+                self._stop_retransmit_timer()
+                self._send_ack()
+                self.protocol.connection_made(self)
+                self._send_pending()
+            return
+        if segment.ack:
+            if segment.ack_num == self.snd_una and len(segment.data) == 0 and not segment.fin \
+                    and not window_changed and self.snd_una != self.snd_nxt:
+                self._handle_dup_ack()
+            else:
+                self._handle_ack(segment.ack_num)
+        if len(segment.data) != 0 or segment.fin:
+            self._handle_data(segment)
+
+    def _handle_ack(self, ack_num):
+        if ack_num <= self.snd_una or ack_num > self.snd_nxt:
+            return
+        acked_bytes = ack_num - self.snd_una
+        self.snd_una = ack_num
+        self.dup_acks = 0
+        now = self.loop.time()
+        newest_acked = None
+        retransmitted = False
+        while self.unacked_segments and self.unacked_segments[0].end_seq <= ack_num:
+            newest_acked = self.unacked_segments.popleft()
+            retransmitted = retransmitted or newest_acked.retransmitted
+        # the echoed timestamp times retransmissions as well, without timestamps an ack
+        # covering a retransmission cannot be timed (Karn's rule)
+        echo_rtt = self.tcp_options.echo_rtt(now)
+        if echo_rtt is not None:
+            self.rto_estimator.on_sample(echo_rtt)
+        elif newest_acked is not None and not retransmitted:
+            self.rto_estimator.on_sample(now - newest_acked.sent_time)
+        if self.recover is None:
+            self.congestion.on_ack(acked_bytes, self.loop.time())
+        elif ack_num >= self.recover:
+            debug_log("leave fast recovery")
+            self.recover = None
+            self.congestion.on_recovery_exit()
+        else:
+            # the next hole is known to be lost as well, see RFC 6582
+            self.congestion.on_partial_ack(acked_bytes)
+            self._retransmit_oldest()
+        # new data has been acked, the oldest segment gets a full timeout from now on,
+        # see RFC 6298 5.3
+        self.retransmissions = 0
+        self._stop_retransmit_timer()
+        if self.unacked_segments:
+            oldest = self.unacked_segments[0]
+            oldest.deadline = max(oldest.deadline, now + self.rto_estimator.rto())
+            self._start_retransmit_timer(oldest.deadline)
+        elif self.snd_una != self.snd_nxt:
+            self._start_retransmit_timer()
+        if self.fin_seq is not None and ack_num == self.fin_seq + 1:
+            debug_log("receive ack for fin")
+            if self.state == LAST_ACK or self.eof_delivered:
+                self._finish(None)
+                return
+        self._send_pending()
+        self._send_fin_if_done()
+
+    def _handle_dup_ack(self):
+        self.dup_acks += 1
+        if self.recover is not None:
+            self.congestion.on_recovery_dup_ack()
+            self._send_pending()
+        elif self.dup_acks == DUP_ACK_THRESHOLD and self.unacked_segments:
+            debug_log("fast retransmit at " + str(self.snd_una))
+            self.recover = self.snd_nxt
+            self.congestion.on_fast_retransmit(self.snd_nxt - self.snd_una, self.loop.time())
+            # only the lost segment is sent again
+            self._retransmit_oldest()
+
+    # after a timeout everything in flight is taken as lost and sent again as the
+    # window opens, starting from the oldest unacked byte
+    def _requeue_unacked(self):
+        for in_flight in reversed(self.unacked_segments):
+            data_segment = in_flight.segment
+            data = data_segment.data
+            if data_segment.seq_num < self.snd_una:
+                data = data[self.snd_una - data_segment.seq_num:]
+            self.send_buffer.appendleft(data)
+        self.unacked_segments.clear()
+        self.retransmit_end = max(self.retransmit_end, self.snd_nxt)
+        self.snd_nxt = self.snd_una
+
+    def _retransmit_oldest(self):
+        if self.unacked_segments:
+            oldest = self.unacked_segments[0]
+            oldest.segment.ack_num = self.ack_num
+            self._send_segment(oldest.segment)
+            oldest.resent(self.loop.time(), self.rto_estimator.rto())
+
+    def _handle_data(self, segment):
+        data = segment.data
+        fin = segment.fin
+        seq_num = segment.seq_num
+        ack_num = self.ack_num
+        # a retransmission cut at other boundaries may go on after ack_num
+        if seq_num < self.ack_num < seq_num + len(data):
+            data = data[self.ack_num - seq_num:]
+            seq_num = self.ack_num
+        # the buffer has no room for data beyond the advertised window, drop it
+        window_end = self.receive_buffer.right_edge
+        if window_end is not None and seq_num + len(data) > window_end >= self.ack_num:
+            debug_log("drop data beyond the receive window")
+            data = data[:max(window_end - seq_num, 0)]
+            fin = False
+        if seq_num == self.ack_num and not self.fin_received:
+            self._deliver(_to_bytes(data), fin)
+            # the cached out-of-order data up to the next hole follows now
+            cached_data = self.out_of_order.pop_from(self.ack_num)
+            if cached_data is not None and not self.fin_received:
+                self._deliver(cached_data, self.out_of_order_fin == self.ack_num + len(cached_data))
+            elif self.out_of_order_fin == self.ack_num:
+                self._deliver("", True)
+        elif seq_num > self.ack_num:
+            # the data is copied out of the received buffer
+            self.out_of_order.add(seq_num, data)
+            if fin:
+                self.out_of_order_fin = seq_num + len(data)
+        if self.state == CLOSED:
+            return
+        # out-of-order data, filled gaps, duplicates and fins are acked at once, so that
+        # the server learns about a hole quickly, the ack of in-order data is delayed
+        if fin or self.ack_num - ack_num != len(data) or len(data) == 0:
+            self._send_ack()
+        else:
+            self._delay_ack(len(data) >= self.tcp_options.send_mss)
+
+    def _delay_ack(self, full_sized):
+        now = self.loop.time()
+        self.delayed_ack.on_data(now, full_sized)
+        if not self.delayed_ack.ack_due():
+            deadline = self.delayed_ack.deadline
+        elif self.delayed_ack.coalesce:
+            # sent after the segments received together with this one are handled
+            deadline = now
+        else:
+            self._send_ack()
+            return
+        if self.ack_timer is None or deadline < self.ack_deadline:
+            self._stop_ack_timer()
+            self.ack_deadline = deadline
+            self.ack_timer = self.loop.call_at(deadline, self._on_ack_timer)
+
+    def _on_ack_timer(self):
+        self.ack_timer = None
+        if self.state != CLOSED and self.delayed_ack.ack_waiting():
+            self._send_ack()
+            self.ip_socket.flush()
+
+    def _stop_ack_timer(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+
+    # in-order data is acked at once, and held in the receive buffer until the
+    # protocol takes it
+    def _deliver(self, data, fin):
+        if len(data) != 0:
+            self.ack_num += len(data)
+            now = self.loop.time()
+            self.receive_buffer.measure_rtt(self.ack_num, now, self.tcp_options.echo_rtt(now))
+            self.receive_buffer.on_received(len(data))
+            self.unread_data.append(data)
+        if fin and not self.fin_received:
+            self.ack_num += 1
+            self.fin_received = True
+        self._deliver_unread()
+
+    # pass the held data to the protocol unless reading is paused, the fin of the
+    # server follows the data before it
+    def _deliver_unread(self):
+        while self.unread_data and not self.reading_paused and self.state != CLOSED:
+            data = self.unread_data.popleft()
+            self.receive_buffer.on_consumed(len(data), self.loop.time())
+            self.protocol.data_received(data)
+        if self.fin_received and not self.eof_delivered and not self.unread_data \
+                and not self.reading_paused and self.state != CLOSED:
+            self.eof_delivered = True
+            self.protocol.eof_received()
+            if self.state == ESTABLISHED:
+                # close our side as well, the server does not expect more data
+                self.closing = True
+                self.state = LAST_ACK
+                self._send_fin_if_done()
+            elif self.fin_seq is not None and self.snd_una == self.fin_seq + 1:
+                self._send_ack()
+                self._finish(None)
+
+    def _send_pending(self):
+        if self.state not in (ESTABLISHED, LAST_ACK):
+            return
+        window = min(self.awnd, self.congestion.window())
+        mss = self.tcp_options.send_mss
+        now = self.loop.time()
+        rto = self.rto_estimator.rto()
+        while self.send_buffer and \
+                self.snd_nxt - self.snd_una + min(len(self.send_buffer[0]), mss) <= window:
+            data = self.send_buffer.popleft()
+            if len(data) > mss:
+                self.send_buffer.appendleft(data[mss:])
+                data = data[:mss]
+            data_segment = self.segment_factory.create_psh_ack(self.snd_nxt, self.ack_num, data)
+            self.snd_nxt += len(data)
+            self.unacked_segments.append(InFlightSegment(
+                data_segment, now, rto, retransmitted=self.snd_nxt <= self.retransmit_end))
+            self._send_segment(data_segment, batch=True)
+        self.ip_socket.flush()
+        if self.unacked_segments and self.retransmit_timer is None:
+            self._start_retransmit_timer(self.unacked_segments[0].deadline)
+
+    def _send_fin_if_done(self):
+        if not self.closing or self.fin_seq is not None or self.send_buffer \
+                or self.snd_una != self.snd_nxt or self.state not in (ESTABLISHED, LAST_ACK):
+            return
+        if self.state == ESTABLISHED:
+            self.state = FIN_WAIT
+        self.fin_seq = self.snd_nxt
+        self.snd_nxt += 1
+        debug_log("send fin to server")
+        self._send_fin()
+        self._start_retransmit_timer()
+
+    def _send_fin(self):
+        self._send_segment(self.segment_factory.create_fin_ack(self.fin_seq, self.ack_num))
+
+    # the ack carries sack blocks for the data received after a hole
+    def _send_ack(self):
+        options = None
+        if self.tcp_options.sack_permitted and self.out_of_order:
+            options = [(OPTION_SACK,
+                        self.out_of_order.sack_ranges(self.tcp_options.max_sack_blocks()))]
+        self._send_segment(self.segment_factory.create_ack(self.snd_nxt, self.ack_num, options),
+                           batch=True)
+
+    def _send_segment(self, segment, batch=False):
+        segment.window_size = self.tcp_options.advertised_window(
+            self._receive_window(segment.syn), segment.syn)
+        # any segment with the current ack number acks what the delayed ack waits for
+        if segment.ack and segment.ack_num == self.ack_num:
+            self.delayed_ack.on_ack_sent()
+            self._stop_ack_timer()
+        self.tcp_options.add_timestamp(segment, self.loop.time())
+        frame = self.frame_template.assemble(segment)
+        if batch:
+            self.ip_socket.queue_frame(frame)
+        else:
+            self.ip_socket.send_frame(frame)
+
+    # the free space of the receive buffer, out-of-order data takes room in it
+    def _receive_window(self, syn):
+        return self.receive_buffer.window(None if syn else self.ack_num,
+                                          self.out_of_order.byte_count, self.tcp_options.mss)
+
+    # the timer expires at deadline, or one timeout from now for the syn and the fin
+    def _start_retransmit_timer(self, deadline=None):
+        self._stop_retransmit_timer()
+        if deadline is None:
+            deadline = self.loop.time() + self.rto_estimator.rto()
+        self.retransmit_timer = self.loop.call_at(deadline, self._on_retransmit_timeout)
+
+    def _stop_retransmit_timer(self):
+        if self.retransmit_timer is not None:
+            self.retransmit_timer.cancel()
+            self.retransmit_timer = None
+
+    # the oldest unacked segment has expired, send everything again and back off
+    def _on_retransmit_timeout(self):
+        self.retransmit_timer = None
+        # the oldest segment may have been sent again since the timer was started
+        if self.state != SYN_SENT and self.unacked_segments and \
+                self.unacked_segments[0].deadline > self.loop.time():
+            self._start_retransmit_timer(self.unacked_segments[0].deadline)
+            return
+        self.retransmissions += 1
+        if self.retransmissions > MAX_RETRANSMISSIONS:
+            error_log("too many retransmissions, dead connection!")
+            self._finish(TimeoutError("too many retransmissions"))
+            return
+        self.rto_estimator.on_timeout()
+        debug_log("retransmission timeout, rto is %.3fs" % self.rto_estimator.rto())
+        if self.state == SYN_SENT:
+            syn_segment = self.segment_factory.create_syn(
+                self.tcp_options.syn_options(self.loop.time()))
+            syn_segment.seq_num = self.snd_una
+            self._send_segment(syn_segment)
+        elif self.unacked_segments:
+            self.congestion.on_timeout(self.snd_nxt - self.snd_una, self.loop.time())
+            self.recover = None
+            self.dup_acks = 0
+            self._requeue_unacked()
+            self._send_pending()
+        elif self.fin_seq is not None:
+            self._send_fin()
+        if self.retransmit_timer is None:
+            self._start_retransmit_timer()
+
+    def _finish(self, exc):
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        self._stop_retransmit_timer()
+        self._stop_ack_timer()
+        self.ip_socket.flush()
+        self.ip_socket.stop_reading()
+        self.ip_socket.close()
+        self.protocol.connection_lost(exc)
+
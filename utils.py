@@ -1,18 +1,28 @@
-import commands
 import socket
 import random
 import struct
-import signal
 import fcntl
-import functools
 import sys
 from socket_logger import error_log
+# the checksum engine lives in its own module, keep it importable from utils
+from checksum import calculate_checksum
 
+# ioctl requests for the addresses of an interface, see linux/sockios.h
+SIOCGIFADDR = 0x8915
+SIOCGIFHWADDR = 0x8927
 
-def get_local_ip():
-    ip_line = commands.getoutput("/sbin/ifconfig").split("\n")[1].split()[1]
-    ip = ip_line if ip_line.find(':') == -1 else ip_line[ip_line.find(':') + 1:]
-    return ip
+
+# these look the network up every time they are called, use the cached values of
+# network_context.get_network_context() instead
+def get_local_ip(device=None):
+    if device is None:
+        device = get_default_iface()
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', device[:15]))
+    finally:
+        s.close()
+    return socket.inet_ntoa(ifreq[20:24])
 
 
 def get_default_iface():
@@ -41,12 +51,18 @@ def _get_default_route_entry():
     sys.exit(-1)
 
 
-def get_local_mac(device='eth0'):
+def get_local_mac(device=None):
     # http://stackoverflow.com/questions/159137/getting-mac-address
+    if device is None:
+        device = get_default_iface()
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return fcntl.ioctl(s.fileno(), 0x8927, struct.pack('256s', device[:15]))[18:24]
+    try:
+        return fcntl.ioctl(s.fileno(), SIOCGIFHWADDR, struct.pack('256s', device[:15]))[18:24]
+    finally:
+        s.close()
 
 
+# uncached, connections use dns_resolver.get_resolver() instead
 def get_remote_ip_by_host(host):
     return socket.gethostbyname(host)
 
@@ -55,27 +71,6 @@ def get_random_number(lower_bound=0, upper_bound=1000):
     return random.randint(lower_bound, upper_bound)
 
 
-# calculate checksum for the given data
-# http://en.wikipedia.org/wiki/IPv4_header_checksum
-def calculate_checksum(data):
-    if len(data) % 2 == 1:
-        data += struct.pack('B', 0)
-
-    csum = 0
-    # loop taking 2 characters at a time
-    for i in range(0, len(data), 2):
-        w = ord(data[i]) + (ord(data[i + 1]) << 8)
-        csum += w
-
-    csum = (csum >> 16) + (csum & 0xffff)
-    csum += (csum >> 16)
-
-    # complement and mask to 4 byte short
-    csum = ~csum & 0xffff
-
-    return csum
-
-
 def get_free_port():
     # get free port from creating a new socket, and close it
     sock = socket.socket()
@@ -94,22 +89,3 @@ def get_mac_addr_from_str(addr):
 
 class TimeoutError(Exception):
     pass
-
-# timeout decorator
-def timeout(seconds, error_msg="timeout happens when calling this function"):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_msg)
-
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                func_result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return func_result
-
-        return functools.wraps(func)(wrapper)
-
-    return decorator